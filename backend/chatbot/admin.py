@@ -1,9 +1,115 @@
 from django.contrib import admin
 
-from .models import Message
+from .models import (
+    CachedResponse, ChatwootOutbox, Conversation, ConversationSummary, FAQEntry, Job, LLMRequestLog, Message,
+    TelegramDeadLetter,
+)
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('created_at', 'channel', 'conversation_id', 'sender', 'text')
     list_filter = ('channel', 'sender',)
     search_fields = ('text', 'conversation_id')
+    # Evita um COUNT(*) sobre a tabela inteira a cada página filtrada.
+    show_full_result_count = False
+    actions = ['approve_as_faq']
+
+    @admin.action(description="Aprovar respostas do bot como FAQ")
+    def approve_as_faq(self, request, queryset):
+        """
+        Cria uma entrada de FAQ para cada resposta do bot selecionada, usando como pergunta
+        a mensagem do usuário imediatamente anterior na mesma conversa.
+        """
+        created = 0
+        for message in queryset.filter(sender='bot'):
+            question = Message.objects.filter(
+                channel=message.channel, conversation_id=message.conversation_id,
+                sender='user', id__lt=message.id,
+            ).order_by('-id').first()
+            if question:
+                FAQEntry.objects.create(question=question.text, answer=message.text, source=FAQEntry.SOURCE_APPROVED)
+                created += 1
+        self.message_user(request, f"{created} resposta(s) adicionada(s) ao FAQ.")
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'available_at', 'created_at', 'finished_at')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('created_at', 'locked_at', 'finished_at')
+
+
+@admin.register(ChatwootOutbox)
+class ChatwootOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'conversation_key', 'message_type', 'status', 'attempts', 'available_at', 'created_at')
+    list_filter = ('status', 'channel', 'message_type')
+    search_fields = ('conversation_key', 'text')
+    readonly_fields = ('created_at', 'locked_at')
+
+
+@admin.register(TelegramDeadLetter)
+class TelegramDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('update_id', 'bot_id', 'attempts', 'error', 'created_at')
+    search_fields = ('error',)
+    readonly_fields = ('created_at',)
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = (
+        'channel', 'conversation_id', 'status', 'message_count', 'user_message_count', 'last_message_at',
+        'chatwoot_conversation_id',
+    )
+    list_filter = ('channel', 'status')
+    search_fields = ('conversation_id',)
+    ordering = ('-last_message_at',)
+    show_full_result_count = False
+    readonly_fields = (
+        'message_count', 'user_message_count', 'bot_message_count', 'first_message_at', 'last_message_at',
+        'last_message_id', 'last_user_message_id', 'updated_at',
+    )
+    actions = ['hand_to_human', 'hand_to_bot']
+
+    @admin.action(description="Passar para atendimento humano (o bot para de responder)")
+    def hand_to_human(self, request, queryset):
+        updated = queryset.update(status=Conversation.STATUS_HUMAN)
+        self.message_user(request, f"{updated} conversa(s) com atendente humano.")
+
+    @admin.action(description="Devolver ao bot")
+    def hand_to_bot(self, request, queryset):
+        updated = queryset.update(status=Conversation.STATUS_BOT)
+        self.message_user(request, f"{updated} conversa(s) devolvida(s) ao bot.")
+
+
+@admin.register(ConversationSummary)
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ('channel', 'conversation_id', 'summarized_count', 'updated_at')
+    list_filter = ('channel',)
+    search_fields = ('conversation_id', 'summary')
+
+
+@admin.register(CachedResponse)
+class CachedResponseAdmin(admin.ModelAdmin):
+    list_display = ('question', 'hits', 'last_used_at', 'expires_at')
+    search_fields = ('question', 'response')
+    readonly_fields = ('key', 'prompt_version', 'created_at')
+
+
+@admin.register(FAQEntry)
+class FAQEntryAdmin(admin.ModelAdmin):
+    list_display = ('question', 'source', 'active', 'updated_at')
+    list_filter = ('source', 'active')
+    search_fields = ('question', 'answer')
+
+
+@admin.register(LLMRequestLog)
+class LLMRequestLogAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'model', 'purpose', 'status', 'prompt_tokens', 'completion_tokens', 'queue_ms', 'latency_ms')
+    list_filter = ('status', 'purpose', 'model')
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -1,30 +1,42 @@
-import os
-from openai import OpenAI
+import logging
+
+from django.conf import settings
+
+from .gateway import PURPOSE_CHATWOOT, arequest_completion, request_completion
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_REPLY = "Desculpe, estou reorganizando meus pensamentos. Tente novamente."
+
 
 def gerar_resposta_ia(historico_mensagens):
     """
-    Recebe uma lista de mensagens e retorna a resposta do OpenRouter.
+    Recebe uma lista de mensagens e retorna a resposta do OpenRouter (via chatbot/gateway.py).
     """
-    client = OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=os.environ.get("OPENROUTER_API_KEY"),
-    )
-
     # Prompt do Sistema (A Personalidade)
     mensagens = [
-        {"role": "system", "content": "Você é um assistente útil e direto de uma organização social. Responda com clareza."}
+        {"role": "system", "content": settings.AI_CHATWOOT_PROMPT}
     ]
-    
+
     # Adiciona o histórico da conversa
     mensagens.extend(historico_mensagens)
 
     try:
-        completion = client.chat.completions.create(
-            model=os.environ.get("OPENROUTER_MODEL", "deepseek/deepseek-chat"),
-            messages=mensagens
-        )
-        # Extração segura da resposta
-        return completion.choices[0].message.content
-    except Exception as e:
-        print(f"Erro no OpenRouter: {e}")
-        return "Desculpe, estou reorganizando meus pensamentos. Tente novamente."
+        return request_completion(mensagens, purpose=PURPOSE_CHATWOOT)
+    except Exception:
+        logger.exception("Erro no OpenRouter ao responder o webhook do Chatwoot.")
+        return FALLBACK_REPLY
+
+
+async def agerar_resposta_ia(historico_mensagens):
+    """
+    Versão assíncrona de gerar_resposta_ia.
+    """
+    mensagens = [{"role": "system", "content": settings.AI_CHATWOOT_PROMPT}]
+    mensagens.extend(historico_mensagens)
+
+    try:
+        return await arequest_completion(mensagens, purpose=PURPOSE_CHATWOOT)
+    except Exception:
+        logger.exception("Erro no OpenRouter ao responder o webhook do Chatwoot.")
+        return FALLBACK_REPLY
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Um cliente por event loop: conexões do httpx não podem ser usadas fora do loop que as abriu.
+# Sob uvicorn há um único loop por processo, portanto um único pool.
+_clients = weakref.WeakKeyDictionary()
+
+
+class _TimedTransport(httpx.AsyncHTTPTransport):
+    """
+    Transporte padrão do httpx que mede cada chamada em chatbot_upstream_request_seconds
+    (como o PooledHTTPAdapter da sessão síncrona).
+    """
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            metrics.observe_upstream(request.method, str(request.url), 'error', time.perf_counter() - started)
+            raise
+        metrics.observe_upstream(request.method, str(request.url), response.status_code, time.perf_counter() - started)
+        return response
+
+
+def _build_client():
+    limits = httpx.Limits(
+        max_connections=settings.HTTP_ASYNC_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_ASYNC_MAX_CONNECTIONS,
+    )
+    timeout = httpx.Timeout(settings.HTTP_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(transport=_TimedTransport(limits=limits), timeout=timeout)
+
+
+def get_async_client():
+    """
+    Versão assíncrona de http_client.get_session: retorna o httpx.AsyncClient compartilhado
+    do event loop atual, usado pelas views assíncronas (ASYNC_WEBHOOKS).
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _build_client()
+        _clients[loop] = client
+    return client
+
+
+async def aclose_client():
+    """
+    Fecha o cliente do event loop atual (e suas conexões).
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,7 +1,12 @@
+import httpx
 import requests
 import logging
 from django.conf import settings
 
+from . import identity, outbound
+from .async_http import get_async_client
+from .http_client import get_session
+
 logger = logging.getLogger(__name__)
 
 class ChatwootAPI:
@@ -15,9 +20,10 @@ class ChatwootAPI:
             'api_access_token': settings.CHATWOOT_ACCESS_TOKEN,
         }
 
-    def _request(self, method, endpoint, **kwargs):
+    def _request(self, method, endpoint, priority=outbound.PRIORITY_NORMAL, **kwargs):
         """
-        Método auxiliar para fazer requisições à API do Chatwoot.
+        Método auxiliar para fazer requisições à API do Chatwoot, dentro do limite de
+        requisições por segundo configurado para o provedor 'chatwoot'.
         """
         if not self.base_url or not settings.CHATWOOT_ACCESS_TOKEN:
             logger.error("Configurações da API do Chatwoot (URL ou Token) não definidas.")
@@ -25,7 +31,9 @@ class ChatwootAPI:
 
         url = f"{self.base_url}/{endpoint}"
         try:
-            response = requests.request(method, url, headers=self.headers, **kwargs)
+            response = outbound.send(
+                'chatwoot', None, lambda: get_session().request(method, url, headers=self.headers, **kwargs), priority
+            )
             response.raise_for_status()
             # Retorna None para respostas 204 No Content
             return response.json() if response.status_code != 204 else None
@@ -35,6 +43,28 @@ class ChatwootAPI:
             logger.error(f"Erro de requisição ao chamar API do Chatwoot: {e}")
         return None
 
+    async def _arequest(self, method, endpoint, priority=outbound.PRIORITY_NORMAL, **kwargs):
+        """
+        Versão assíncrona de _request (usada pelas views assíncronas).
+        """
+        if not self.base_url or not settings.CHATWOOT_ACCESS_TOKEN:
+            logger.error("Configurações da API do Chatwoot (URL ou Token) não definidas.")
+            return None
+
+        url = f"{self.base_url}/{endpoint}"
+        try:
+            client = get_async_client()
+            response = await outbound.asend(
+                'chatwoot', None, lambda: client.request(method, url, headers=self.headers, **kwargs), priority
+            )
+            response.raise_for_status()
+            return response.json() if response.status_code != 204 else None
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Erro HTTP ao chamar API do Chatwoot: {e.response.status_code} {e.response.text}")
+        except httpx.HTTPError as e:
+            logger.error(f"Erro de requisição ao chamar API do Chatwoot: {e}")
+        return None
+
     def search_contact(self, query):
         """
         Busca por um contato usando um identificador (source_id).
@@ -48,6 +78,17 @@ class ChatwootAPI:
         logger.info(f"Nenhum contato encontrado para a query: {query}")
         return None
 
+    async def asearch_contact(self, query):
+        """
+        Versão assíncrona de search_contact.
+        """
+        logger.info(f"Buscando contato no Chatwoot com query: {query}")
+        response = await self._arequest('GET', f'contacts/search?q={query}')
+        if response and response.get('payload'):
+            return response['payload'][0]
+        logger.info(f"Nenhum contato encontrado para a query: {query}")
+        return None
+
     def create_contact(self, inbox_id, name, source_id):
         """
         Cria um novo contato associado a um inbox.
@@ -62,6 +103,19 @@ class ChatwootAPI:
         response = self._request('POST', 'contacts', json=payload)
         return response['payload'] if response and response.get('payload') else None
 
+    async def acreate_contact(self, inbox_id, name, source_id):
+        """
+        Versão assíncrona de create_contact.
+        """
+        logger.info(f"Criando contato no Chatwoot para o inbox {inbox_id} com source_id: {source_id}")
+        payload = {
+            "inbox_id": inbox_id,
+            "name": name,
+            "source_id": source_id,
+        }
+        response = await self._arequest('POST', 'contacts', json=payload)
+        return response['payload'] if response and response.get('payload') else None
+
     def get_contact_conversations(self, contact_id):
         """
         Busca as conversas existentes para um contato.
@@ -69,6 +123,13 @@ class ChatwootAPI:
         logger.info(f"Buscando conversas para o contato_id: {contact_id}")
         return self._request('GET', f'contacts/{contact_id}/conversations')
 
+    async def aget_contact_conversations(self, contact_id):
+        """
+        Versão assíncrona de get_contact_conversations.
+        """
+        logger.info(f"Buscando conversas para o contato_id: {contact_id}")
+        return await self._arequest('GET', f'contacts/{contact_id}/conversations')
+
     def create_conversation(self, contact_id, inbox_id, source_id):
         """
         Cria uma nova conversa para um contato em um inbox específico.
@@ -81,7 +142,19 @@ class ChatwootAPI:
         }
         return self._request('POST', 'conversations', json=payload)
 
-    def create_message(self, conversation_id, content, message_type="outgoing"):
+    async def acreate_conversation(self, contact_id, inbox_id, source_id):
+        """
+        Versão assíncrona de create_conversation.
+        """
+        logger.info(f"Criando nova conversa para o contato {contact_id} no inbox {inbox_id}")
+        payload = {
+            "contact_id": contact_id,
+            "inbox_id": inbox_id,
+            "source_id": source_id,
+        }
+        return await self._arequest('POST', 'conversations', json=payload)
+
+    def create_message(self, conversation_id, content, message_type="outgoing", priority=outbound.PRIORITY_NORMAL):
         """
         Cria uma nova mensagem em uma conversa.
         message_type pode ser 'incoming' ou 'outgoing'.
@@ -92,7 +165,19 @@ class ChatwootAPI:
             "message_type": message_type,
             "private": False, # Mensagens não são privadas por padrão
         }
-        return self._request('POST', f'conversations/{conversation_id}/messages', json=payload)
+        return self._request('POST', f'conversations/{conversation_id}/messages', priority=priority, json=payload)
+
+    async def acreate_message(self, conversation_id, content, message_type="outgoing", priority=outbound.PRIORITY_NORMAL):
+        """
+        Versão assíncrona de create_message.
+        """
+        logger.info(f"Criando mensagem do tipo '{message_type}' na conversa {conversation_id}")
+        payload = {
+            "content": content,
+            "message_type": message_type,
+            "private": False,
+        }
+        return await self._arequest('POST', f'conversations/{conversation_id}/messages', priority=priority, json=payload)
 
     def get_or_create_contact(self, inbox_id, name, source_id):
         """
@@ -107,6 +192,18 @@ class ChatwootAPI:
         logger.info(f"Contato não encontrado, criando um novo.")
         return self.create_contact(inbox_id, name, source_id)
 
+    async def aget_or_create_contact(self, inbox_id, name, source_id):
+        """
+        Versão assíncrona de get_or_create_contact.
+        """
+        contact = await self.asearch_contact(query=source_id)
+        if contact:
+            logger.info(f"Contato encontrado: ID {contact['id']}")
+            return contact
+
+        logger.info(f"Contato não encontrado, criando um novo.")
+        return await self.acreate_contact(inbox_id, name, source_id)
+
     def find_or_create_conversation(self, contact, inbox_id, source_id):
         """
         Busca uma conversa 'open' para o contato. Se não encontrar, cria uma nova.
@@ -116,15 +213,32 @@ class ChatwootAPI:
         conversations_data = self.get_contact_conversations(contact_id)
 
         if conversations_data:
-            # Filtra por conversas que estão no mesmo inbox e não estão resolvidas
+            # Filtra por conversas que estão no mesmo inbox e não estão resolvidas.
+            # O inbox_id das configurações vem do ambiente como string; a API devolve inteiro.
             for conv in conversations_data['payload']:
-                if conv['inbox_id'] == inbox_id and conv['status'] != 'resolved':
+                if str(conv['inbox_id']) == str(inbox_id) and conv['status'] != 'resolved':
                     logger.info(f"Conversa aberta encontrada: ID {conv['id']}")
                     return conv
 
         logger.info("Nenhuma conversa aberta encontrada, criando uma nova.")
         return self.create_conversation(contact_id, inbox_id, source_id)
 
+    async def afind_or_create_conversation(self, contact, inbox_id, source_id):
+        """
+        Versão assíncrona de find_or_create_conversation.
+        """
+        contact_id = contact['id']
+        conversations_data = await self.aget_contact_conversations(contact_id)
+
+        if conversations_data:
+            for conv in conversations_data['payload']:
+                if str(conv['inbox_id']) == str(inbox_id) and conv['status'] != 'resolved':
+                    logger.info(f"Conversa aberta encontrada: ID {conv['id']}")
+                    return conv
+
+        logger.info("Nenhuma conversa aberta encontrada, criando uma nova.")
+        return await self.acreate_conversation(contact_id, inbox_id, source_id)
+
     def toggle_conversation_status(self, conversation_id, status="open"):
         """
         Altera o status de uma conversa (ex: 'open', 'resolved', 'bot').
@@ -132,7 +246,10 @@ class ChatwootAPI:
         logger.info(f"Alterando status da conversa {conversation_id} para '{status}'")
         endpoint = f"conversations/{conversation_id}/toggle_status"
         payload = {"status": status}
-        return self._request('POST', endpoint, json=payload)
+        response = self._request('POST', endpoint, json=payload)
+        if response is not None and status == 'resolved':
+            identity.invalidate_conversation(conversation_id)
+        return response
 
     def assign_conversation(self, conversation_id, agent_id=None, team_id=None):
         """
@@ -0,0 +1,117 @@
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+
+from . import history_cache
+from .models import ConversationSummary, Message
+
+logger = logging.getLogger(__name__)
+
+# Uma mensagem do histórico, no formato esperado por get_ai_response (atributos sender/text).
+Turn = namedtuple('Turn', ['sender', 'text'])
+
+# Resultado do montador de contexto: prompt de sistema (com o resumo da conversa, se houver),
+# mensagens recentes em ordem cronológica, tokens estimados (com o prompt) e o resumo usado.
+ContextWindow = namedtuple('ContextWindow', ['system_prompt', 'messages', 'tokens', 'summary'])
+
+# Custo fixo aproximado de cada mensagem no formato de chat (papel, separadores).
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """
+    Estimativa local e rápida de tokens: ~4 caracteres por token, que é a média
+    dos tokenizadores BPE para textos em português e inglês. Não faz chamadas externas.
+    """
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def history_queryset(channel, conversation_id, after_id=0):
+    """
+    Histórico da conversa, do mais novo para o mais antigo. A ordenação casa com
+    o índice chatbot_msg_history_idx, então o banco não precisa ordenar nada.
+    'after_id' descarta as mensagens já incorporadas ao resumo da conversa.
+    """
+    queryset = Message.objects.filter(channel=channel, conversation_id=conversation_id)
+    if after_id:
+        queryset = queryset.filter(id__gt=after_id)
+    return queryset.order_by('-created_at', '-id').values_list('sender', 'text')
+
+
+def with_summary(system_prompt, summary):
+    """
+    Acrescenta o resumo da conversa (se houver) ao prompt de sistema.
+    """
+    if not summary or not summary.summary:
+        return system_prompt
+    return f"{system_prompt}\n\nResumo da conversa até aqui (mensagens mais antigas):\n{summary.summary}"
+
+
+def build_context(channel, conversation_id, system_prompt='', budget=None):
+    """
+    Monta o contexto enviado à IA: prompt de sistema + resumo das mensagens antigas
+    (ConversationSummary) + as mensagens mais recentes que cabem no orçamento de tokens
+    (AI_CONTEXT_TOKEN_BUDGET). Busca do banco apenas as páginas necessárias, da mais nova
+    para a mais antiga. A mensagem mais recente é sempre incluída, mesmo que sozinha
+    estoure o orçamento.
+    """
+    budget = settings.AI_CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+    summary = ConversationSummary.objects.filter(channel=channel, conversation_id=conversation_id).first()
+    system_prompt = with_summary(system_prompt, summary)
+    used = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+
+    selected = []
+    for sender, text in _newest_first(channel, conversation_id, summary.summarized_until_id if summary else 0):
+        cost = estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+        if selected and used + cost > budget:
+            break
+        selected.append(Turn(sender, text))
+        used += cost
+    return _finish(channel, conversation_id, system_prompt, selected, used, summary)
+
+
+def _newest_first(channel, conversation_id, after_id):
+    """
+    Mensagens da conversa depois de 'after_id', da mais nova para a mais antiga: primeiro as do
+    cache do histórico (HISTORY_CACHE_ENABLED) e, se ele não tiver todas, páginas do banco a partir dali.
+    """
+    queryset = history_queryset(channel, conversation_id, after_id)
+    offset = 0
+    if settings.HISTORY_CACHE_ENABLED:
+        cached, complete = _recent_from_cache(channel, conversation_id, after_id, queryset)
+        yield from cached
+        if complete:
+            return
+        offset = len(cached)
+
+    page_size = settings.AI_CONTEXT_PAGE_SIZE
+    while True:
+        page = list(queryset[offset:offset + page_size])
+        yield from page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def _recent_from_cache(channel, conversation_id, after_id, queryset):
+    version = history_cache.current_version(channel, conversation_id)
+    cached = history_cache.lookup(channel, conversation_id, version, after_id)
+    if cached is not None:
+        return cached
+    # Na falta, uma única consulta traz as mensagens que a entrada guarda.
+    limit = settings.HISTORY_CACHE_MAX_MESSAGES
+    rows = list(queryset.values_list('id', 'sender', 'text')[:limit + 1])
+    complete = len(rows) <= limit
+    rows = rows[:limit]
+    history_cache.store(channel, conversation_id, version, after_id, rows, complete)
+    return [(sender, text) for _, sender, text in rows], complete
+
+
+def _finish(channel, conversation_id, system_prompt, selected, used, summary):
+    selected.reverse()
+    logger.info(f"Contexto de {channel}:{conversation_id}: {len(selected)} mensagem(ns), ~{used} tokens.")
+    return ContextWindow(system_prompt, selected, used, summary)
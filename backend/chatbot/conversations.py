@@ -0,0 +1,153 @@
+"""
+Manutenção do agregado Conversation.
+
+Cada Message criada atualiza a linha da sua conversa (sinal post_save, na mesma transação da
+gravação) com um único UPDATE de contadores; a primeira mensagem cria a linha. Os IDs e datas
+da última mensagem só avançam (GREATEST), então gravações concorrentes fora de ordem não voltam
+a linha atrás. Mensagens apagadas ou gravadas com bulk_create não passam pelo sinal: o comando
+`manage.py backfill_conversations` recalcula as linhas a partir do histórico, sem parar o sistema.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import ChatwootIdentity, Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+
+def record_message(message):
+    """
+    Soma a mensagem recém-criada ao agregado da conversa.
+    """
+    conversation = Conversation.objects.filter(channel=message.channel, conversation_id=message.conversation_id)
+    created_at = Value(message.created_at)
+    changes = {
+        'message_count': F('message_count') + 1,
+        # A linha pode ter sido criada sem mensagens (set_chatwoot_conversation), com as datas vazias.
+        'first_message_at': Coalesce(F('first_message_at'), created_at),
+        'last_message_at': Greatest(Coalesce(F('last_message_at'), created_at), created_at),
+        'last_message_id': Greatest(F('last_message_id'), message.id),
+    }
+    if message.sender == 'user':
+        changes['user_message_count'] = F('user_message_count') + 1
+        changes['last_user_message_id'] = Greatest(F('last_user_message_id'), message.id)
+    else:
+        changes['bot_message_count'] = F('bot_message_count') + 1
+    if conversation.update(**changes):
+        return
+
+    identity = ChatwootIdentity.objects.filter(
+        channel=message.channel, source_id=message.conversation_id
+    ).values_list('conversation_id', flat=True).first()
+    is_user = message.sender == 'user'
+    try:
+        # Savepoint próprio: outra gravação pode ter criado a linha ao mesmo tempo.
+        with transaction.atomic():
+            Conversation.objects.create(
+                channel=message.channel, conversation_id=message.conversation_id,
+                message_count=1, user_message_count=int(is_user), bot_message_count=int(not is_user),
+                first_message_at=message.created_at, last_message_at=message.created_at,
+                last_message_id=message.id, last_user_message_id=message.id if is_user else 0,
+                chatwoot_conversation_id=identity,
+            )
+    except IntegrityError:
+        conversation.update(**changes)
+
+
+def get(channel, conversation_id):
+    return Conversation.objects.filter(channel=channel, conversation_id=conversation_id).first()
+
+
+def is_human_handled(channel, conversation_id):
+    """
+    Indica se um atendente humano assumiu a conversa (o bot não deve responder).
+    """
+    return Conversation.objects.filter(
+        channel=channel, conversation_id=conversation_id, status=Conversation.STATUS_HUMAN
+    ).exists()
+
+
+async def ais_human_handled(channel, conversation_id):
+    return await Conversation.objects.filter(
+        channel=channel, conversation_id=conversation_id, status=Conversation.STATUS_HUMAN
+    ).aexists()
+
+
+def set_chatwoot_conversation(channel, conversation_id, chatwoot_conversation_id):
+    """
+    Grava a conversa aberta no Chatwoot. Com CHATWOOT_CONCURRENT_BOOKKEEPING, isso pode acontecer
+    antes da primeira mensagem criar a linha: ela é criada aqui e a mensagem soma a ela.
+    """
+    Conversation.objects.update_or_create(
+        channel=channel, conversation_id=conversation_id,
+        defaults={'chatwoot_conversation_id': chatwoot_conversation_id},
+    )
+
+
+def clear_chatwoot_conversation(chatwoot_conversation_id):
+    Conversation.objects.filter(chatwoot_conversation_id=chatwoot_conversation_id).update(chatwoot_conversation_id=None)
+
+
+def backfill(batch_size=1000, apps=None):
+    """
+    Recalcula os agregados a partir de Message (e a conversa no Chatwoot a partir de ChatwootIdentity),
+    em lotes de 'batch_size' conversas. O status de cada conversa é preservado. Retorna quantas
+    conversas foram gravadas. Pode rodar com o sistema no ar: as mensagens gravadas durante o
+    recálculo de um lote esperam por ele e são somadas depois. Numa migração, 'apps' fornece os
+    modelos históricos.
+    """
+    models = (Conversation, Message, ChatwootIdentity) if apps is None else tuple(
+        apps.get_model('chatbot', name) for name in ('Conversation', 'Message', 'ChatwootIdentity')
+    )
+    keys = models[1].objects.order_by('channel', 'conversation_id').values_list('channel', 'conversation_id').distinct()
+    written = 0
+    batch = []
+    for key in keys.iterator(chunk_size=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            written += _recount(batch, models)
+            batch = []
+    if batch:
+        written += _recount(batch, models)
+    return written
+
+
+def _recount(keys, models):
+    conversation_model, message_model, identity_model = models
+    match = Q()
+    for channel, conversation_id in keys:
+        match |= Q(channel=channel, conversation_id=conversation_id)
+    messages = message_model.objects.filter(
+        channel=OuterRef('channel'), conversation_id=OuterRef('conversation_id')
+    ).order_by().values('channel')
+
+    def of_messages(aggregate):
+        return Subquery(messages.annotate(value=aggregate).values('value'))
+
+    with transaction.atomic():
+        conversation_model.objects.bulk_create(
+            [conversation_model(channel=channel, conversation_id=conversation_id) for channel, conversation_id in keys],
+            ignore_conflicts=True,
+        )
+        rows = conversation_model.objects.filter(match)
+        # Com as linhas travadas, quem grava uma mensagem agora espera para somá-la (record_message)
+        # e o UPDATE abaixo conta exatamente as mensagens já confirmadas: nenhum incremento se perde.
+        list(rows.select_for_update().values_list('id', flat=True))
+        rows.update(
+            message_count=of_messages(Count('id')),
+            user_message_count=of_messages(Count('id', filter=Q(sender='user'))),
+            bot_message_count=of_messages(Count('id', filter=~Q(sender='user'))),
+            first_message_at=of_messages(Min('created_at')),
+            last_message_at=of_messages(Max('created_at')),
+            last_message_id=of_messages(Max('id')),
+            last_user_message_id=Coalesce(of_messages(Max('id', filter=Q(sender='user'))), 0),
+            chatwoot_conversation_id=Subquery(identity_model.objects.filter(
+                channel=OuterRef('channel'), source_id=OuterRef('conversation_id')
+            ).values('conversation_id')[:1]),
+            updated_at=timezone.now(),
+        )
+    return len(keys)
@@ -0,0 +1,30 @@
+"""
+Conexões com o banco durante as esperas de rede do código assíncrono (ASYNC_WEBHOOKS).
+
+Sob ASGI, o ORM de cada requisição roda numa thread da própria requisição, com a sua conexão,
+que o Django só fecha quando a requisição termina. Uma requisição que espera a IA ou um envio
+ao Telegram/Chatwoot seguraria a conexão parada durante toda a espera, e uma rajada de webhooks
+passaria do max_connections do Postgres ("too many clients"). As esperas de rede (gateway._aslot,
+outbound.asend) chamam arelease_connections() antes: a conexão é devolvida e a próxima consulta
+abre outra.
+"""
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+def release_connections():
+    """
+    Fecha as conexões abertas pela thread atual (respeitando CONN_MAX_AGE).
+    """
+    for connection in connections.all(initialized_only=True):
+        # Dentro de uma transação (ex: num TestCase) a conexão não pode ser fechada.
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+async def arelease_connections():
+    """
+    Versão assíncrona de release_connections: fecha as conexões da thread em que o ORM da
+    requisição (ou da tarefa) atual roda.
+    """
+    await sync_to_async(release_connections)()
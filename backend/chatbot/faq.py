@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+import zlib
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import FAQEntry
+from .response_cache import is_cacheable, normalize
+
+logger = logging.getLogger(__name__)
+
+# Reconstrói o índice do zero (recalculando o IDF) quando as alterações incrementais
+# passam desta fração do tamanho do índice.
+REBUILD_RATIO = 0.2
+
+# Margem ao buscar entradas alteradas, para não perder gravações concorrentes.
+SYNC_MARGIN = timedelta(seconds=5)
+
+
+def features(text):
+    """
+    Palavras, pares de palavras e trigramas de caracteres de cada palavra (tolerantes
+    a erros de digitação e variações como "horário"/"horarios").
+    """
+    words = normalize(text).split()
+    feats = list(words)
+    feats.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f" {word} "
+        feats.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return feats
+
+
+def term_frequencies(text, dim):
+    """
+    Vetor de frequências com hashing (sinal aleatório para reduzir o viés das colisões)
+    e escala sublinear.
+    """
+    hashes = np.fromiter((zlib.crc32(f.encode()) for f in features(text)), dtype=np.uint32)
+    if not hashes.size:
+        return np.zeros(dim, dtype=np.float32)
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+    vec = np.bincount(hashes % dim, weights=signs, minlength=dim).astype(np.float32)
+    return np.sign(vec) * np.log1p(np.abs(vec))
+
+
+class FAQIndex:
+    """
+    Índice em memória das perguntas do FAQ. Os vetores (TF-IDF normalizado) ficam numa
+    matriz transposta (dim x capacidade): a busca só lê as linhas das dimensões presentes
+    na consulta. Suporta inclusão, alteração e remoção sem reconstruir tudo.
+    """
+    def __init__(self, dim):
+        self.dim = dim
+        self.ids = []
+        self.questions = []
+        self.answers = []
+        self.positions = {}
+        self.idf = np.ones(dim, dtype=np.float32)
+        self.matrix = np.zeros((dim, 0), dtype=np.float32)
+        self.changes = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def memory_bytes(self):
+        return self.matrix.nbytes + self.idf.nbytes
+
+    def build(self, entries):
+        """
+        Reconstrói o índice a partir de (id, pergunta, resposta), recalculando o IDF.
+        """
+        entries = list(entries)
+        self.ids = [e[0] for e in entries]
+        self.questions = [e[1] for e in entries]
+        self.answers = [e[2] for e in entries]
+        self.positions = {entry_id: pos for pos, entry_id in enumerate(self.ids)}
+        self.changes = 0
+
+        tf = np.zeros((len(entries), self.dim), dtype=np.float32)
+        for pos, question in enumerate(self.questions):
+            tf[pos] = term_frequencies(question, self.dim)
+
+        df = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(entries)) / (1 + df)) + 1).astype(np.float32)
+
+        tf *= self.idf
+        norms = np.linalg.norm(tf, axis=1, keepdims=True)
+        tf /= np.where(norms == 0, 1, norms)
+        self.matrix = np.ascontiguousarray(tf.T)
+
+    def vectorize(self, text):
+        vec = term_frequencies(text, self.dim) * self.idf
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def upsert(self, entry_id, question, answer):
+        vec = self.vectorize(question)
+        pos = self.positions.get(entry_id)
+        if pos is None:
+            pos = len(self.ids)
+            if pos == self.matrix.shape[1]:
+                grown = np.zeros((self.dim, max(2 * pos, 16)), dtype=np.float32)
+                grown[:, :pos] = self.matrix[:, :pos]
+                self.matrix = grown
+            self.ids.append(entry_id)
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.positions[entry_id] = pos
+        else:
+            self.questions[pos] = question
+            self.answers[pos] = answer
+        self.matrix[:, pos] = vec
+        self.changes += 1
+
+    def remove(self, entry_id):
+        pos = self.positions.pop(entry_id, None)
+        if pos is None:
+            return
+        # Move a última entrada para a posição liberada.
+        last = len(self.ids) - 1
+        if pos != last:
+            self.matrix[:, pos] = self.matrix[:, last]
+            for values in (self.ids, self.questions, self.answers):
+                values[pos] = values[last]
+            self.positions[self.ids[pos]] = pos
+        for values in (self.ids, self.questions, self.answers):
+            values.pop()
+        self.changes += 1
+
+    def needs_rebuild(self):
+        return self.changes > max(20, REBUILD_RATIO * len(self.ids))
+
+    def search(self, text, threshold):
+        """
+        Retorna (id, resposta, similaridade) da pergunta mais parecida, ou None se
+        nenhuma passar do limiar.
+        """
+        if not self.ids:
+            return None
+        query = self.vectorize(text)
+        active = np.flatnonzero(query)
+        if not active.size:
+            return None
+        scores = query[active] @ self.matrix[active, :len(self.ids)]
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < threshold:
+            return None
+        return self.ids[best], self.answers[best], score
+
+
+_index = None
+_lock = threading.Lock()
+_last_sync = None
+_last_check = 0.0
+_dirty = False
+
+
+def mark_dirty():
+    """
+    Força a verificação de mudanças no banco na próxima busca (chamado pelos signals de FAQEntry).
+    """
+    global _dirty
+    _dirty = True
+
+
+def _load():
+    global _index, _last_sync
+    started = timezone.now()
+    index = FAQIndex(settings.FAQ_VECTOR_DIM)
+    index.build(FAQEntry.objects.filter(active=True).order_by('id').values_list('id', 'question', 'answer'))
+    _index, _last_sync = index, started
+    logger.info(f"Índice do FAQ construído com {len(index)} entradas.")
+
+
+def _sync():
+    global _last_sync
+    started = timezone.now()
+    changed = FAQEntry.objects.filter(updated_at__gte=_last_sync - SYNC_MARGIN).values_list(
+        'id', 'question', 'answer', 'active'
+    )
+    for entry_id, question, answer, active in changed:
+        if active:
+            _index.upsert(entry_id, question, answer)
+        else:
+            _index.remove(entry_id)
+    _last_sync = started
+
+    # Entradas apagadas não aparecem na consulta acima: a contagem denuncia.
+    if FAQEntry.objects.filter(active=True).count() != len(_index) or _index.needs_rebuild():
+        _load()
+
+
+def _refresh():
+    """
+    Sincroniza o índice do processo com o banco no máximo a cada FAQ_REFRESH_INTERVAL
+    segundos (ou imediatamente após uma alteração feita neste processo). Chamar com _lock.
+    """
+    global _last_check, _dirty
+    if _index is not None and not _dirty and time.monotonic() - _last_check < settings.FAQ_REFRESH_INTERVAL:
+        return
+    _dirty = False
+    if _index is None:
+        _load()
+    else:
+        _sync()
+    _last_check = time.monotonic()
+
+
+def match(messages):
+    """
+    Procura no FAQ uma resposta para o último turno da conversa. Só considera turnos
+    que não dependem da conversa (mesmo critério do cache de respostas).
+    """
+    if not settings.FAQ_MATCHER_ENABLED or not is_cacheable(messages):
+        return None
+    with _lock:
+        _refresh()
+        result = _index.search(messages[-1].text, settings.FAQ_SIMILARITY_THRESHOLD)
+    if result is None:
+        return None
+    entry_id, answer, score = result
+    logger.info(f"Pergunta respondida pelo FAQ (entrada {entry_id}, similaridade {score:.2f}).")
+    return answer
+
+
+def reset():
+    global _index, _last_sync, _last_check, _dirty
+    with _lock:
+        _index, _last_sync, _last_check, _dirty = None, None, 0.0, False
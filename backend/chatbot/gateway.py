@@ -0,0 +1,568 @@
+"""
+Gateway único das chamadas à IA (Chat Completions do OpenRouter).
+
+Todas as gerações (respostas aos canais, resumos, webhook do Chatwoot) passam por aqui:
+- conexões: a sessão requests compartilhada (http_client) e o cliente httpx do event loop
+  (async_http), ambos com pool keep-alive; nenhum cliente é criado por chamada;
+- retentativas, circuit breaker e modelos de reserva (resilience);
+- limite de gerações simultâneas, global (AI_MAX_CONCURRENCY) e por modelo
+  (AI_MODEL_CONCURRENCY), com fila de espera limitada (AI_QUEUE_MAX_WAITING, AI_QUEUE_TIMEOUT):
+  com a fila cheia o pedido é recusado na hora em vez de se acumular;
+- registro de cada tentativa em chatbot_llmrequestlog (modelo, finalidade, tokens, tempo na
+  fila, tempo até o primeiro pedaço e latência), resumido por `manage.py llm_report`, e nos
+  histogramas de chatbot/metrics.py (rota /metrics).
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from . import db, metrics, resilience
+from .async_http import get_async_client
+from .context import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from .http_client import get_session
+
+logger = logging.getLogger(__name__)
+
+PURPOSE_REPLY = 'reply'
+PURPOSE_SUMMARY = 'summary'
+PURPOSE_CHATWOOT = 'chatwoot'
+
+
+class AIServiceError(Exception):
+    """
+    Falha ao obter uma resposta do OpenRouter. 'user_message' é o texto amigável
+    que get_ai_response devolve ao usuário nesse caso.
+    """
+    def __init__(self, detail, user_message):
+        super().__init__(detail)
+        self.user_message = user_message
+
+
+# --- Limites de concorrência ---
+
+class _Limiter:
+    """
+    Semáforo com fila FIFO limitada, que serve tanto a threads quanto a corrotinas.
+    Ao liberar uma vaga, ela passa direto para o primeiro da fila.
+    """
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _enter(self, notify):
+        """
+        Retorna None se a vaga foi concedida na hora; senão, o registro de espera na fila.
+        """
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                self.peak = max(self.peak, self.in_use)
+                return None
+            if len(self._waiters) >= settings.AI_QUEUE_MAX_WAITING:
+                self.rejected += 1
+                raise self._saturated("fila cheia")
+            waiter = {'notify': notify, 'granted': False}
+            self._waiters.append(waiter)
+            return waiter
+
+    def _leave_queue(self, waiter):
+        """
+        Desiste da espera. Retorna False se a vaga já tinha sido concedida (e agora é do chamador).
+        """
+        with self._lock:
+            if waiter['granted']:
+                return False
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return True
+
+    def _saturated(self, reason):
+        return AIServiceError(
+            f"Limite de gerações simultâneas atingido ({self.name}: {reason}).",
+            "Estou atendendo muitas conversas agora. Pode me mandar a mensagem de novo em instantes?"
+        )
+
+    def acquire(self):
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is not None and not event.wait(settings.AI_QUEUE_TIMEOUT) and self._leave_queue(waiter):
+            raise self._saturated("tempo de espera esgotado")
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(lambda: loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None)))
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(future), settings.AI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self._leave_queue(waiter):
+                raise self._saturated("tempo de espera esgotado")
+        except asyncio.CancelledError:
+            if not self._leave_queue(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.in_use -= 1
+                return
+            waiter = self._waiters.popleft()
+            waiter['granted'] = True
+        waiter['notify']()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit, 'in_use': self.in_use, 'waiting': len(self._waiters),
+                'peak': self.peak, 'rejected': self.rejected,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _limiters_for(model):
+    """
+    Limitadores a ocupar, na ordem: o do modelo (se houver limite para ele) e o global.
+    Pegar primeiro a vaga do modelo evita segurar uma vaga global esperando um modelo saturado.
+    """
+    wanted = []
+    if settings.AI_MODEL_CONCURRENCY.get(model):
+        wanted.append((model, settings.AI_MODEL_CONCURRENCY[model]))
+    if settings.AI_MAX_CONCURRENCY:
+        wanted.append(('global', settings.AI_MAX_CONCURRENCY))
+    with _limiters_lock:
+        for name, limit in wanted:
+            if name not in _limiters or _limiters[name].limit != limit:
+                _limiters[name] = _Limiter(name, limit)
+        return [_limiters[name] for name, _ in wanted]
+
+
+def concurrency_stats():
+    """
+    Por limitador ('global' e cada modelo com limite): vagas, em uso, na fila, pico e recusas.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def reset():
+    """
+    Descarta os limitadores e suas métricas (usado nos testes).
+    """
+    with _limiters_lock:
+        _limiters.clear()
+
+
+# --- Registro das chamadas ---
+
+class _CallRecord:
+    """
+    Medições de uma tentativa, gravadas em LLMRequestLog ao fim da chamada.
+    """
+    def __init__(self, model, purpose, prompt_tokens, streamed):
+        self.model = model
+        self.purpose = purpose
+        self.prompt_tokens = prompt_tokens
+        self.streamed = streamed
+        self.created_at = timezone.now()
+        self.created = time.monotonic()
+        self.started = None
+        self.first_token_at = None
+        self.status = None
+        self.http_status = None
+        self.error = ''
+        self.usage = {}
+        self.generated = []
+
+    def begin(self):
+        self.started = time.monotonic()
+
+    def chunk(self, content):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.generated.append(content)
+
+    def fail(self, error, http_status=None):
+        self.status = 'error'
+        self.http_status = http_status
+        self.error = str(error)[:500]
+
+    def finish(self, exc_type=None):
+        if self.status is None:
+            if exc_type is None:
+                self.status = 'ok'
+            elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+                self.status = 'cancelled'
+            elif issubclass(exc_type, AIServiceError) and self.started is None:
+                self.status = 'rejected'
+            else:
+                self.status = 'error'
+        if self.status == 'ok' and self.http_status is None:
+            self.http_status = 200
+
+    def fields(self):
+        now = time.monotonic()
+        started = self.started or now
+        completion = self.usage.get('completion_tokens')
+        if completion is None and self.generated:
+            completion = estimate_tokens(''.join(self.generated))
+        return {
+            'created_at': self.created_at,
+            'model': self.model,
+            'purpose': self.purpose,
+            'streamed': self.streamed,
+            'status': self.status,
+            'http_status': self.http_status,
+            'prompt_tokens': self.usage.get('prompt_tokens') or self.prompt_tokens,
+            'completion_tokens': completion,
+            'queue_ms': int((started - self.created) * 1000),
+            'first_token_ms': int((self.first_token_at - started) * 1000) if self.first_token_at else None,
+            'latency_ms': int((now - started) * 1000),
+            'error': self.error,
+        }
+
+
+def _save(record):
+    if not settings.AI_REQUEST_LOG_ENABLED:
+        return
+    from .models import LLMRequestLog
+    try:
+        LLMRequestLog.objects.create(**record.fields())
+    except Exception as e:
+        # O registro é só para medição: nunca derruba a geração.
+        logger.warning(f"Não foi possível registrar a chamada à IA: {e}")
+
+
+async def _asave(record):
+    if not settings.AI_REQUEST_LOG_ENABLED:
+        return
+    from .models import LLMRequestLog
+    try:
+        await LLMRequestLog.objects.acreate(**record.fields())
+    except Exception as e:
+        logger.warning(f"Não foi possível registrar a chamada à IA: {e}")
+
+
+@contextmanager
+def _slot(model, purpose, prompt_tokens, streamed=False):
+    """
+    Ocupa as vagas de concorrência do modelo durante a tentativa e registra a chamada ao sair.
+    """
+    record = _CallRecord(model, purpose, prompt_tokens, streamed)
+    held = []
+    exc_type = None
+    try:
+        for limiter in _limiters_for(model):
+            limiter.acquire()
+            held.append(limiter)
+        record.begin()
+        yield record
+    except BaseException as e:
+        exc_type = type(e)
+        raise
+    finally:
+        for limiter in reversed(held):
+            limiter.release()
+        record.finish(exc_type)
+        metrics.observe_llm_call(record.fields())
+        _save(record)
+
+
+@asynccontextmanager
+async def _aslot(model, purpose, prompt_tokens, streamed=False):
+    # Não segura a conexão com o banco enquanto espera a vaga e a resposta do modelo (chatbot/db.py).
+    await db.arelease_connections()
+    record = _CallRecord(model, purpose, prompt_tokens, streamed)
+    held = []
+    exc_type = None
+    try:
+        for limiter in _limiters_for(model):
+            await limiter.aacquire()
+            held.append(limiter)
+        record.begin()
+        yield record
+    except BaseException as e:
+        exc_type = type(e)
+        raise
+    finally:
+        for limiter in reversed(held):
+            limiter.release()
+        record.finish(exc_type)
+        metrics.observe_llm_call(record.fields())
+        await _asave(record)
+
+
+# --- Chamadas ao OpenRouter ---
+
+def _completion_request(messages, temperature, stream=False):
+    """
+    Monta URL, headers e payload de uma chamada de Chat Completions ao OpenRouter. O modelo
+    entra no payload a cada tentativa (resilience.model_chain, a partir de OPENROUTER_MODEL).
+    """
+    api_key = os.environ.get('OPENROUTER_API_KEY')
+    url = f"{settings.OPENROUTER_BASE_URL}/chat/completions"
+
+    if not api_key:
+        raise AIServiceError("API Key do OpenRouter não configurada.", "Erro de configuração: Chave da API ausente.")
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "http://localhost:8000", # Necessário para OpenRouter
+    }
+
+    payload = {
+        "messages": messages,
+        "temperature": temperature
+    }
+    if stream:
+        payload["stream"] = True
+        # Pede a contagem de tokens no último evento do stream.
+        payload["stream_options"] = {"include_usage": True}
+    return url, headers, payload
+
+
+def request_completion(messages, temperature=0.7, models=None, purpose=PURPOSE_REPLY):
+    """
+    Faz uma chamada de Chat Completions ao OpenRouter e retorna o texto gerado.
+    Erros transitórios são repetidos e, se preciso, o pedido vai para os modelos de reserva
+    (chatbot/resilience.py); 'models' substitui a cadeia de modelos padrão. Levanta
+    AIServiceError se nenhuma tentativa der certo (útil para tarefas que não devem gravar
+    uma mensagem de desculpas como se fosse resposta).
+    """
+    url, headers, payload = _completion_request(messages, temperature)
+    estimated_tokens = _log_completion_request(messages)
+
+    plan = resilience.RetryPlan(models)
+    while (attempt := plan.next_attempt()) is not None:
+        try:
+            time.sleep(attempt.delay)
+            with _slot(attempt.model, purpose, estimated_tokens) as record:
+                attempt.start()
+                try:
+                    response = get_session().post(url, headers=headers, json={**payload, 'model': attempt.model}, timeout=30)
+                except requests.exceptions.RequestException as e:
+                    record.fail(e)
+                    plan.failed(attempt, f"Erro de conexão com o OpenRouter: {e}", retryable=True)
+                    continue
+                if _attempt_failed(plan, attempt, response, record):
+                    continue
+                plan.succeeded(attempt)
+                return _completion_text(response, estimated_tokens, record)
+        finally:
+            # Cancelada (ex: perdedora do hedging), recusada pela fila de gerações ou com erro inesperado.
+            plan.release(attempt)
+    raise _unavailable(plan)
+
+
+async def arequest_completion(messages, temperature=0.7, models=None, purpose=PURPOSE_REPLY):
+    """
+    Versão assíncrona de request_completion (cliente httpx compartilhado do event loop).
+    """
+    url, headers, payload = _completion_request(messages, temperature)
+    estimated_tokens = _log_completion_request(messages)
+
+    plan = resilience.RetryPlan(models)
+    while (attempt := plan.next_attempt()) is not None:
+        try:
+            await asyncio.sleep(attempt.delay)
+            async with _aslot(attempt.model, purpose, estimated_tokens) as record:
+                attempt.start()
+                try:
+                    response = await get_async_client().post(
+                        url, headers=headers, json={**payload, 'model': attempt.model}, timeout=30
+                    )
+                except httpx.HTTPError as e:
+                    record.fail(e)
+                    plan.failed(attempt, f"Erro de conexão com o OpenRouter: {e}", retryable=True)
+                    continue
+                if _attempt_failed(plan, attempt, response, record):
+                    continue
+                plan.succeeded(attempt)
+                return _completion_text(response, estimated_tokens, record)
+        finally:
+            plan.release(attempt)
+    raise _unavailable(plan)
+
+
+def stream_completion(messages, temperature=0.7, models=None, purpose=PURPOSE_REPLY):
+    """
+    Versão em streaming de request_completion: consome o stream SSE do OpenRouter
+    e produz os pedaços de texto à medida que chegam. A vaga de concorrência fica
+    ocupada até o fim do stream.
+    As retentativas e os modelos de reserva valem até o stream abrir; uma queda no meio
+    do stream não é repetida. Levanta AIServiceError se a chamada falhar antes do primeiro pedaço.
+    """
+    url, headers, payload = _completion_request(messages, temperature, stream=True)
+    estimated_tokens = _log_completion_request(messages)
+
+    plan = resilience.RetryPlan(models)
+    while (attempt := plan.next_attempt()) is not None:
+        try:
+            time.sleep(attempt.delay)
+            with _slot(attempt.model, purpose, estimated_tokens, streamed=True) as record:
+                attempt.start()
+                try:
+                    response = get_session().post(
+                        url, headers=headers, json={**payload, 'model': attempt.model}, timeout=30, stream=True
+                    )
+                except requests.exceptions.RequestException as e:
+                    record.fail(e)
+                    plan.failed(attempt, f"Erro de conexão com o OpenRouter: {e}", retryable=True)
+                    continue
+                if _attempt_failed(plan, attempt, response, record):
+                    response.close()
+                    continue
+                plan.succeeded(attempt)
+
+                try:
+                    for line in response.iter_lines(decode_unicode=True):
+                        done, content = _sse_event(line, record)
+                        if done:
+                            break
+                        if content:
+                            record.chunk(content)
+                            yield content
+                finally:
+                    response.close()
+                return
+        finally:
+            plan.release(attempt)
+    raise _unavailable(plan)
+
+
+async def astream_completion(messages, temperature=0.7, models=None, purpose=PURPOSE_REPLY):
+    """
+    Versão assíncrona de stream_completion.
+    """
+    url, headers, payload = _completion_request(messages, temperature, stream=True)
+    estimated_tokens = _log_completion_request(messages)
+
+    client = get_async_client()
+    plan = resilience.RetryPlan(models)
+    while (attempt := plan.next_attempt()) is not None:
+        try:
+            await asyncio.sleep(attempt.delay)
+            async with _aslot(attempt.model, purpose, estimated_tokens, streamed=True) as record:
+                attempt.start()
+                request = client.build_request(
+                    'POST', url, headers=headers, json={**payload, 'model': attempt.model}, timeout=30
+                )
+                try:
+                    response = await client.send(request, stream=True)
+                except httpx.HTTPError as e:
+                    record.fail(e)
+                    plan.failed(attempt, f"Erro de conexão com o OpenRouter: {e}", retryable=True)
+                    continue
+                if response.status_code != 200:
+                    await response.aread()
+                    await response.aclose()
+                    _attempt_failed(plan, attempt, response, record)
+                    continue
+                plan.succeeded(attempt)
+
+                try:
+                    async for line in response.aiter_lines():
+                        done, content = _sse_event(line, record)
+                        if done:
+                            break
+                        if content:
+                            record.chunk(content)
+                            yield content
+                finally:
+                    await response.aclose()
+                return
+        finally:
+            plan.release(attempt)
+    raise _unavailable(plan)
+
+
+def _attempt_failed(plan, attempt, response, record):
+    """
+    Registra no plano de tentativas uma resposta de erro do OpenRouter (requests ou httpx).
+    """
+    if response.status_code == 200:
+        return False
+    error = f"Erro na API da IA: {response.status_code} - {response.text}"
+    record.fail(error, http_status=response.status_code)
+    plan.failed(
+        attempt,
+        error,
+        retryable=response.status_code in resilience.RETRYABLE_STATUS,
+        retry_after=resilience.retry_after_seconds(response.headers),
+    )
+    return True
+
+
+def _unavailable(plan):
+    return AIServiceError(
+        plan.last_error or "Nenhum modelo do OpenRouter disponível.",
+        "Desculpe, meu cérebro está temporariamente fora do ar."
+    )
+
+
+def _log_completion_request(messages):
+    estimated_tokens = sum(estimate_tokens(m['content']) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    logger.info(f"Enviando request para OpenRouter ({len(messages)} mensagens, ~{estimated_tokens} tokens)...")
+    return estimated_tokens
+
+
+def _completion_text(response, estimated_tokens, record):
+    """
+    Extrai o texto de uma resposta do OpenRouter (requests ou httpx).
+    """
+    response_json = response.json()
+
+    usage = response_json.get('usage') or {}
+    if usage:
+        record.usage = usage
+        logger.info(
+            f"Tokens enviados ao OpenRouter: {usage.get('prompt_tokens')} "
+            f"(estimados: {estimated_tokens}), gerados: {usage.get('completion_tokens')}."
+        )
+
+    # Extração manual e segura do JSON
+    if 'choices' in response_json and len(response_json['choices']) > 0:
+        text = response_json['choices'][0]['message']['content']
+        record.generated.append(text or '')
+        return text
+    raise AIServiceError(f"Formato inesperado do OpenRouter: {response_json}", "Recebi uma resposta vazia da IA.")
+
+
+def _sse_event(line, record):
+    """
+    Interpreta uma linha do stream SSE. Retorna (terminou, texto do pedaço ou None) e guarda
+    no registro a contagem de tokens, que vem no último evento.
+    """
+    # Linhas vazias separam eventos; linhas iniciadas com ':' são comentários (keep-alive).
+    if not line or not line.startswith('data:'):
+        return False, None
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return True, None
+    chunk = json.loads(data)
+    if chunk.get('usage'):
+        record.usage = chunk['usage']
+    choices = chunk.get('choices') or []
+    return False, choices[0].get('delta', {}).get('content') if choices else None
@@ -0,0 +1,220 @@
+"""
+Pedidos "hedged" à IA, para cortar a cauda de latência do OpenRouter.
+
+Com AI_HEDGING_ENABLED, se o pedido principal não trouxer resposta (ou o primeiro pedaço,
+em streaming) dentro do percentil AI_HEDGE_PERCENTILE das latências recentes do modelo, um
+segundo pedido vai para o modelo alternativo (AI_HEDGE_MODEL, ou o primeiro de reserva, ou o
+mesmo modelo, que o OpenRouter pode encaminhar a outro provedor). Vale o primeiro que responder;
+o outro é cancelado. Cada pedido extra custa de novo os tokens do prompt, por isso há contadores
+de quantas vezes o hedge disparou, quantas ganhou e quantos tokens extras foram enviados.
+
+Cada "perna" é uma função que recebe a lista de modelos (None = a cadeia normal, com modelos de
+reserva) e retorna um iterável com os pedaços da resposta (um só, se não for streaming).
+"""
+import asyncio
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from . import resilience
+from .context import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CHUNK = 'chunk'
+DONE = 'done'
+ERROR = 'error'
+
+PRIMARY = 0
+HEDGE = 1
+
+_counters = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'extra_prompt_tokens': 0}
+_counters_lock = threading.Lock()
+
+
+def _count(**increments):
+    with _counters_lock:
+        for name, value in increments.items():
+            _counters[name] += value
+
+
+def hedge_model():
+    if settings.AI_HEDGE_MODEL:
+        return settings.AI_HEDGE_MODEL
+    chain = resilience.model_chain()
+    return chain[1] if len(chain) > 1 else chain[0]
+
+
+def hedge_delay():
+    """
+    Quanto esperar pelo pedido principal antes de disparar o segundo: o percentil configurado
+    das latências recentes do modelo principal, ou AI_HEDGE_DELAY enquanto houver poucas amostras.
+    """
+    latency, samples = resilience.latency_percentile(resilience.model_chain()[0], settings.AI_HEDGE_PERCENTILE)
+    if samples < settings.AI_HEDGE_MIN_SAMPLES:
+        return settings.AI_HEDGE_DELAY
+    return latency
+
+
+class _Race:
+    """
+    Decide, a partir dos eventos das pernas, quando disparar o hedge e quem venceu.
+    Compartilhado pelas versões síncrona (threads) e assíncrona (tasks).
+    """
+    def __init__(self, messages):
+        self.prompt_tokens = sum(estimate_tokens(m['content']) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+        self.delay = hedge_delay()
+        self.hedge_fired = False
+        self.winner = None
+        self.errors = {}
+        _count(requests=1)
+
+    def timeout(self):
+        return None if self.hedge_fired else self.delay
+
+    def fire(self):
+        self.hedge_fired = True
+        model = hedge_model()
+        logger.info(f"Sem resposta do OpenRouter em {self.delay:.2f}s; disparando pedido extra para {model}.")
+        _count(hedged=1, extra_prompt_tokens=self.prompt_tokens)
+        return [model]
+
+    def event(self, leg, kind, value):
+        """
+        Retorna True quando 'leg' vence (primeiro pedaço ou fim sem pedaços). Levanta o erro do
+        pedido principal se nenhuma perna puder mais responder.
+        """
+        if kind != ERROR:
+            self.winner = leg
+            if leg == HEDGE:
+                _count(hedge_wins=1)
+            return True
+        self.errors[leg] = value
+        if not self.hedge_fired or len(self.errors) == 2:
+            raise self.errors.get(PRIMARY, value)
+        return False
+
+
+def hedged(start, messages):
+    """
+    Versão síncrona: cada perna roda numa thread. Uma perna perdedora não pode ser interrompida
+    no meio da requisição; ela é descartada e o stream é fechado ao chegar o primeiro pedaço.
+    """
+    events = queue.Queue()
+    cancelled = {PRIMARY: threading.Event(), HEDGE: threading.Event()}
+
+    def run(leg, models):
+        iterator = None
+        try:
+            iterator = iter(start(models))
+            for item in iterator:
+                if cancelled[leg].is_set():
+                    return
+                events.put((leg, CHUNK, item))
+            events.put((leg, DONE, None))
+        except Exception as e:
+            events.put((leg, ERROR, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            # A thread pode ter aberto uma conexão com o banco (registro da chamada em LLMRequestLog).
+            connection.close()
+
+    def launch(leg, models):
+        threading.Thread(target=run, args=(leg, models), name='llm-hedge', daemon=True).start()
+
+    race = _Race(messages)
+    launch(PRIMARY, None)
+    try:
+        while True:
+            try:
+                leg, kind, value = events.get(timeout=race.timeout())
+            except queue.Empty:
+                launch(HEDGE, race.fire())
+                continue
+            if leg != race.winner and race.winner is not None:
+                continue
+            if race.winner is None:
+                if not race.event(leg, kind, value):
+                    continue
+                cancelled[HEDGE if leg == PRIMARY else PRIMARY].set()
+            if kind == DONE:
+                return
+            if kind == ERROR:
+                raise value
+            yield value
+    finally:
+        for event in cancelled.values():
+            event.set()
+
+
+async def ahedged(start, messages):
+    """
+    Versão assíncrona: cada perna é uma task, e a perdedora é cancelada de fato. Ao terminar,
+    espera as tasks canceladas encerrarem, para que a tentativa cancelada devolva a vaga de
+    teste do circuit breaker (resilience.RetryPlan.release) antes de a chamada retornar.
+    """
+    events = asyncio.Queue()
+    tasks = {}
+
+    async def run(leg, models):
+        try:
+            async for item in start(models):
+                await events.put((leg, CHUNK, item))
+            await events.put((leg, DONE, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await events.put((leg, ERROR, e))
+
+    race = _Race(messages)
+    tasks[PRIMARY] = asyncio.create_task(run(PRIMARY, None))
+    try:
+        while True:
+            try:
+                leg, kind, value = await asyncio.wait_for(events.get(), timeout=race.timeout())
+            except asyncio.TimeoutError:
+                tasks[HEDGE] = asyncio.create_task(run(HEDGE, race.fire()))
+                continue
+            if leg != race.winner and race.winner is not None:
+                continue
+            if race.winner is None:
+                if not race.event(leg, kind, value):
+                    continue
+                for other, task in tasks.items():
+                    if other != leg:
+                        task.cancel()
+            if kind == DONE:
+                return
+            if kind == ERROR:
+                raise value
+            yield value
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+async def single(awaitable):
+    """
+    Adapta uma chamada sem streaming (corrotina) ao formato de perna assíncrona.
+    """
+    yield await awaitable
+
+
+def stats():
+    """
+    Pedidos elegíveis, quantos dispararam o hedge, quantos o hedge venceu e os tokens de prompt
+    (estimados) gastos com pedidos extras.
+    """
+    with _counters_lock:
+        return dict(_counters)
+
+
+def reset():
+    with _counters_lock:
+        for name in _counters:
+            _counters[name] = 0
@@ -0,0 +1,202 @@
+"""
+Cache em memória do histórico recente de cada conversa (HISTORY_CACHE_ENABLED).
+
+Cada entrada guarda as últimas HISTORY_CACHE_MAX_MESSAGES mensagens de uma conversa e a versão
+do agregado Conversation que elas representam: (last_message_id, message_count). As mensagens
+gravadas pelo próprio processo são acrescentadas pelo sinal post_save de Message, então o turno
+seguinte monta o contexto sem consultar o histórico: só confere a versão na linha da conversa
+(uma busca pela chave única). Se a versão não bate (mensagem gravada por outro processo,
+transação desfeita, backfill), a entrada é descartada e o histórico é buscado de novo no banco.
+
+A memória é limitada em bytes (HISTORY_CACHE_MAX_BYTES, estimada pelo tamanho dos textos), com
+descarte da conversa usada há mais tempo. O cache é por processo; dentro dele, as mensagens
+ficam na ordem dos IDs.
+"""
+import os
+import sys
+import threading
+from bisect import insort
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+from .models import Conversation
+
+# Custo aproximado de cada mensagem guardada além do texto (tupla, ID, remetente).
+MESSAGE_OVERHEAD_BYTES = 120
+
+
+def _message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + sys.getsizeof(message[2])
+
+
+class _Entry:
+    __slots__ = ('version', 'after_id', 'messages', 'complete', 'size')
+
+    def __init__(self, version, after_id, messages, complete):
+        self.version = version
+        self.after_id = after_id
+        # (id, sender, text), da mais antiga para a mais nova.
+        self.messages = messages
+        # Se 'messages' tem todas as mensagens da conversa depois de 'after_id'.
+        self.complete = complete
+        self.size = sum(_message_size(message) for message in messages)
+
+
+class HistoryCache:
+    """
+    LRU, seguro para threads, limitado pela memória estimada das entradas.
+    """
+    def __init__(self, max_bytes, max_messages):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(('hits', 'misses', 'stale', 'appends', 'evictions'), 0)
+
+    def lookup(self, key, version, after_id):
+        """
+        Mensagens depois de 'after_id', da mais nova para a mais antiga, e se são todas; None se
+        não houver entrada na versão 'version'.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                result = 'miss'
+            elif entry.version != version or after_id < entry.after_id:
+                self._discard(key)
+                result = 'stale'
+            else:
+                if after_id > entry.after_id:
+                    # O resumo da conversa avançou: as mensagens resumidas saem da entrada.
+                    self._trim(entry, after_id)
+                self._data.move_to_end(key)
+                result = 'hit'
+                messages = [(sender, text) for _, sender, text in reversed(entry.messages)]
+                complete = entry.complete
+            self._counters[{'hit': 'hits', 'miss': 'misses', 'stale': 'stale'}[result]] += 1
+            size = self.size
+        metrics.HISTORY_CACHE_LOOKUPS.inc(result=result)
+        metrics.HISTORY_CACHE_BYTES.set(size)
+        return (messages, complete) if result == 'hit' else None
+
+    def store(self, key, version, after_id, messages, complete):
+        """
+        Guarda as mensagens lidas do banco ('messages' da mais nova para a mais antiga, como (id, sender, text)).
+        """
+        entry = _Entry(version, after_id, list(reversed(messages)), complete)
+        with self._lock:
+            self._discard(key)
+            self._data[key] = entry
+            self.size += entry.size
+            self._evict()
+            size = self.size
+        metrics.HISTORY_CACHE_BYTES.set(size)
+
+    def append(self, key, message):
+        """
+        Acrescenta uma mensagem recém-gravada (id, sender, text) à entrada da conversa, se houver.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return
+            last_id, count = entry.version
+            entry.version = (max(last_id, message[0]), count + 1)
+            # Gravações concorrentes podem chegar fora de ordem; a entrada continua ordenada pelo ID.
+            insort(entry.messages, message)
+            added = _message_size(message)
+            entry.size += added
+            self.size += added
+            if len(entry.messages) > self.max_messages:
+                removed = _message_size(entry.messages.pop(0))
+                entry.size -= removed
+                self.size -= removed
+                entry.complete = False
+            self._data.move_to_end(key)
+            self._counters['appends'] += 1
+            self._evict()
+            size = self.size
+        metrics.HISTORY_CACHE_BYTES.set(size)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            for name in self._counters:
+                self._counters[name] = 0
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['entries'] = len(self._data)
+            data['bytes'] = self.size
+        lookups = data['hits'] + data['misses'] + data['stale']
+        data['hit_rate'] = data['hits'] / lookups if lookups else 0.0
+        return data
+
+    def _trim(self, entry, after_id):
+        removed = sum(_message_size(message) for message in entry.messages if message[0] <= after_id)
+        entry.messages = [message for message in entry.messages if message[0] > after_id]
+        entry.after_id = after_id
+        entry.size -= removed
+        self.size -= removed
+
+    def _discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._data:
+            _, entry = self._data.popitem(last=False)
+            self.size -= entry.size
+            self._counters['evictions'] += 1
+
+
+_cache = HistoryCache(settings.HISTORY_CACHE_MAX_BYTES, settings.HISTORY_CACHE_MAX_MESSAGES)
+
+
+def current_version(channel, conversation_id):
+    """
+    Versão atual da conversa no banco: (last_message_id, message_count), ou None sem agregado.
+    """
+    return Conversation.objects.filter(channel=channel, conversation_id=conversation_id).values_list(
+        'last_message_id', 'message_count'
+    ).first()
+
+
+def lookup(channel, conversation_id, version, after_id):
+    return _cache.lookup((channel, conversation_id), version, after_id)
+
+
+def store(channel, conversation_id, version, after_id, messages, complete):
+    # Sem agregado (mensagens anteriores ao backfill), não há versão para conferir depois.
+    if version is not None:
+        _cache.store((channel, conversation_id), version, after_id, messages, complete)
+
+
+def append(message):
+    _cache.append((message.channel, message.conversation_id), (message.id, message.sender, message.text))
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    """
+    Contadores deste processo, a taxa de acerto e a memória estimada ocupada.
+    """
+    return _cache.stats()
+
+
+def _reset_in_child():
+    global _cache
+    _cache = HistoryCache(settings.HISTORY_CACHE_MAX_BYTES, settings.HISTORY_CACHE_MAX_MESSAGES)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_in_child)
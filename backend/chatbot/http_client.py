@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter com pool de conexões keep-alive e timeout padrão
+    (o requests não aplica nenhum timeout se o chamador esquecer de passar um).
+    Cada chamada é medida em chatbot_upstream_request_seconds (chatbot/metrics.py).
+    """
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            metrics.observe_upstream(request.method, request.url, 'error', time.perf_counter() - started)
+            raise
+        metrics.observe_upstream(request.method, request.url, response.status_code, time.perf_counter() - started)
+        return response
+
+
+def _build_session():
+    timeout = (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+    session = requests.Session()
+
+    default_adapter = PooledHTTPAdapter(timeout=timeout, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+    session.mount('http://', default_adapter)
+    session.mount('https://', default_adapter)
+
+    # Pools dedicados (e dimensionados) para os hosts mais usados.
+    for host, size in settings.HTTP_POOL_SIZES.items():
+        adapter = PooledHTTPAdapter(timeout=timeout, pool_maxsize=size)
+        session.mount(f'http://{host}/', adapter)
+        session.mount(f'https://{host}/', adapter)
+    return session
+
+
+def get_session():
+    """
+    Retorna a sessão HTTP compartilhada do processo. Todos os clientes de APIs externas
+    (Chatwoot, Telegram, OpenRouter) devem usá-la para reaproveitar conexões TCP/TLS.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def reset_session():
+    """
+    Descarta a sessão atual (e suas conexões). Usado após um fork e nos testes.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def pool_stats():
+    """
+    Retorna, por host, quantas conexões foram abertas, quantas requisições foram feitas
+    e quantas reaproveitaram uma conexão já aberta.
+    """
+    stats = {}
+    if _session is None:
+        return stats
+
+    for adapter in {id(a): a for a in _session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            entry = stats.setdefault(host, {'connections': 0, 'requests': 0, 'reused': 0})
+            entry['connections'] += pool.num_connections
+            entry['requests'] += pool.num_requests
+            entry['reused'] += max(pool.num_requests - pool.num_connections, 0)
+    return stats
+
+
+def _reset_session_in_child():
+    # Conexões abertas antes de um fork não podem ser compartilhadas com o processo filho.
+    global _session
+    _session = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session_in_child)
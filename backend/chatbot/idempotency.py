@@ -0,0 +1,165 @@
+"""
+Deduplicação das reentregas de webhook dos provedores.
+
+O Telegram reenvia a mesma atualização (mesmo update_id) e o Twilio repete o webhook (mesmo
+MessageSid) quando o handler demora ou responde 500. Cada repetição geraria outra mensagem no
+histórico, outra no Chatwoot e outra chamada à IA. Antes de processar, a view "reserva" o ID de
+entrega: primeiro num conjunto em memória dos IDs recentes (LRU por processo) e depois na tabela
+chatbot_webhookdelivery, com restrição de unicidade, compartilhada entre processos. Repetições
+são respondidas na hora, sem passar pelo pipeline. Os registros expiram após WEBHOOK_DEDUP_TTL.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import jobs
+from .lru import LRUCache
+from .models import WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+# De quanto em quanto tempo (segundos) a própria reserva apaga os registros expirados,
+# para que a tabela não cresça mesmo sem o worker (`run_worker` também chama prune()).
+PRUNE_INTERVAL = 3600
+
+_recent = LRUCache(settings.WEBHOOK_DEDUP_MEMORY_SIZE, ttl=settings.WEBHOOK_DEDUP_TTL)
+_counters = {'claimed': 0, 'memory_duplicates': 0, 'db_duplicates': 0, 'released': 0}
+_counters_lock = threading.Lock()
+_last_prune = time.monotonic()
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def _seen_recently(provider, delivery_id):
+    if _recent.get((provider, delivery_id)) is None:
+        return False
+    _count('memory_duplicates')
+    logger.info(f"Reentrega {provider}:{delivery_id} ignorada (já recebida).")
+    return True
+
+
+def _claim_in_db(provider, delivery_id):
+    global _last_prune
+    if time.monotonic() - _last_prune >= PRUNE_INTERVAL:
+        _last_prune = time.monotonic()
+        prune()
+    try:
+        # Savepoint próprio: o IntegrityError não pode invalidar a transação de quem chamou.
+        with transaction.atomic():
+            WebhookDelivery.objects.create(provider=provider, delivery_id=delivery_id)
+    except IntegrityError:
+        _recent.set((provider, delivery_id), True)
+        _count('db_duplicates')
+        logger.info(f"Reentrega {provider}:{delivery_id} ignorada (já recebida por outro processo).")
+        return False
+    _recent.set((provider, delivery_id), True)
+    _count('claimed')
+    return True
+
+
+def claim(provider, delivery_id):
+    """
+    Reserva o ID de entrega. Retorna True na primeira vez e False nas reentregas.
+    Sem ID (ou com WEBHOOK_DEDUP_ENABLED desligado) a entrega é sempre processada.
+    """
+    if not settings.WEBHOOK_DEDUP_ENABLED or delivery_id in (None, ''):
+        return True
+    delivery_id = str(delivery_id)
+    if _seen_recently(provider, delivery_id):
+        return False
+    return _claim_in_db(provider, delivery_id)
+
+
+async def aclaim(provider, delivery_id):
+    """
+    Versão assíncrona de claim: reentregas vistas por este processo nem chegam a usar uma thread.
+    """
+    if not settings.WEBHOOK_DEDUP_ENABLED or delivery_id in (None, ''):
+        return True
+    delivery_id = str(delivery_id)
+    if _seen_recently(provider, delivery_id):
+        return False
+    return await sync_to_async(_claim_in_db)(provider, delivery_id)
+
+
+def claim_and_enqueue(provider, delivery_id, kind, payload, ordering_key=''):
+    """
+    Reserva o ID de entrega e grava a tarefa na mesma transação: se a gravação da tarefa falhar,
+    a reserva é desfeita junto e a reentrega do provedor é processada. Retorna False nas reentregas.
+    """
+    try:
+        with transaction.atomic():
+            if not claim(provider, delivery_id):
+                return False
+            jobs.enqueue(kind, payload, ordering_key=ordering_key)
+    except Exception:
+        # O rollback já apagou a reserva no banco; falta esquecê-la na memória.
+        if delivery_id not in (None, ''):
+            _recent.delete((provider, str(delivery_id)))
+            _count('released')
+        raise
+    return True
+
+
+async def aclaim_and_enqueue(provider, delivery_id, kind, payload, ordering_key=''):
+    """
+    Versão assíncrona de claim_and_enqueue.
+    """
+    if settings.WEBHOOK_DEDUP_ENABLED and delivery_id not in (None, '') and _seen_recently(provider, str(delivery_id)):
+        return False
+    return await sync_to_async(claim_and_enqueue)(provider, delivery_id, kind, payload, ordering_key)
+
+
+def release(provider, delivery_id):
+    """
+    Desfaz a reserva quando o processamento falhou, para que a reentrega do provedor seja
+    processada de novo em vez de descartada.
+    """
+    if not settings.WEBHOOK_DEDUP_ENABLED or delivery_id in (None, ''):
+        return
+    delivery_id = str(delivery_id)
+    _recent.delete((provider, delivery_id))
+    WebhookDelivery.objects.filter(provider=provider, delivery_id=delivery_id).delete()
+    _count('released')
+
+
+async def arelease(provider, delivery_id):
+    await sync_to_async(release)(provider, delivery_id)
+
+
+def prune():
+    """
+    Apaga os registros mais antigos que WEBHOOK_DEDUP_TTL. Retorna quantos foram apagados.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.WEBHOOK_DEDUP_TTL)
+    deleted, _ = WebhookDelivery.objects.filter(received_at__lt=cutoff).delete()
+    return deleted
+
+
+def stats():
+    """
+    Entregas aceitas, reentregas barradas pela memória e pelo banco, e reservas desfeitas.
+    """
+    with _counters_lock:
+        data = dict(_counters)
+    data['memory_size'] = len(_recent)
+    return data
+
+
+def reset():
+    """
+    Esquece os IDs recentes e zera os contadores (usado nos testes).
+    """
+    _recent.clear()
+    with _counters_lock:
+        for name in _counters:
+            _counters[name] = 0
@@ -0,0 +1,108 @@
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import conversations
+from .lru import LRUCache
+from .models import ChatwootIdentity
+
+logger = logging.getLogger(__name__)
+
+# Cache em memória na frente da tabela ChatwootIdentity: (channel, source_id) -> (contact_id, conversation_id).
+# O TTL limita por quanto tempo outros processos podem usar uma conversa já resolvida.
+_cache = LRUCache(settings.CHATWOOT_IDENTITY_CACHE_SIZE, ttl=settings.CHATWOOT_IDENTITY_CACHE_TTL)
+
+
+def resolve_conversation(chatwoot_api, channel, inbox_id, user_name, source_id):
+    """
+    Retorna o ID da conversa aberta no Chatwoot para o usuário do canal.
+    No caminho comum (usuário já conhecido) não faz nenhuma chamada à API:
+    consulta o cache em memória e, na falta dele, a tabela ChatwootIdentity.
+    """
+    key = (channel, source_id)
+    cached = _cache.get(key)
+    if cached and cached[1]:
+        return cached[1]
+
+    identity = ChatwootIdentity.objects.filter(channel=channel, source_id=source_id).first()
+    if identity and identity.conversation_id:
+        _cache.set(key, (identity.contact_id, identity.conversation_id))
+        return identity.conversation_id
+
+    # Contato já conhecido: só precisa de uma nova conversa.
+    if identity:
+        contact = {'id': identity.contact_id}
+    else:
+        contact = chatwoot_api.get_or_create_contact(inbox_id, user_name, source_id)
+        if not contact:
+            logger.error(f"Não foi possível criar ou encontrar contato com source_id {source_id}")
+            return None
+
+    conversation = chatwoot_api.find_or_create_conversation(contact, inbox_id, source_id)
+    if not conversation:
+        logger.error(f"Não foi possível criar ou encontrar conversa para o contato {contact['id']}")
+        return None
+
+    ChatwootIdentity.objects.update_or_create(
+        channel=channel, source_id=source_id,
+        defaults={'contact_id': contact['id'], 'conversation_id': conversation['id']},
+    )
+    conversations.set_chatwoot_conversation(channel, source_id, conversation['id'])
+    _cache.set(key, (contact['id'], conversation['id']))
+    return conversation['id']
+
+
+async def aresolve_conversation(chatwoot_api, channel, inbox_id, user_name, source_id):
+    """
+    Versão assíncrona de resolve_conversation: as chamadas ao Chatwoot não ocupam a thread
+    (nem a conexão com o banco) da requisição.
+    """
+    key = (channel, source_id)
+    cached = _cache.get(key)
+    if cached and cached[1]:
+        return cached[1]
+
+    identity = await ChatwootIdentity.objects.filter(channel=channel, source_id=source_id).afirst()
+    if identity and identity.conversation_id:
+        _cache.set(key, (identity.contact_id, identity.conversation_id))
+        return identity.conversation_id
+
+    if identity:
+        contact = {'id': identity.contact_id}
+    else:
+        contact = await chatwoot_api.aget_or_create_contact(inbox_id, user_name, source_id)
+        if not contact:
+            logger.error(f"Não foi possível criar ou encontrar contato com source_id {source_id}")
+            return None
+
+    conversation = await chatwoot_api.afind_or_create_conversation(contact, inbox_id, source_id)
+    if not conversation:
+        logger.error(f"Não foi possível criar ou encontrar conversa para o contato {contact['id']}")
+        return None
+
+    await ChatwootIdentity.objects.aupdate_or_create(
+        channel=channel, source_id=source_id,
+        defaults={'contact_id': contact['id'], 'conversation_id': conversation['id']},
+    )
+    await sync_to_async(conversations.set_chatwoot_conversation)(channel, source_id, conversation['id'])
+    _cache.set(key, (contact['id'], conversation['id']))
+    return conversation['id']
+
+
+def invalidate_conversation(conversation_id):
+    """
+    Esquece a conversa (ex: foi resolvida no Chatwoot). O contato continua mapeado,
+    então a próxima mensagem só precisa criar/buscar uma nova conversa.
+    """
+    identities = list(ChatwootIdentity.objects.filter(conversation_id=conversation_id))
+    for identity in identities:
+        _cache.delete((identity.channel, identity.source_id))
+    if identities:
+        ChatwootIdentity.objects.filter(conversation_id=conversation_id).update(conversation_id=None)
+        conversations.clear_chatwoot_conversation(conversation_id)
+        logger.info(f"Conversa {conversation_id} removida do mapa de identidades.")
+
+
+def cache_stats():
+    return _cache.stats()
@@ -0,0 +1,132 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+from .ordering import partition_for
+
+logger = logging.getLogger(__name__)
+
+# Mapeia o tipo da tarefa para a função que a processa (recebe o payload).
+JOB_HANDLERS = {
+    'telegram_update': 'chatbot.pipeline.process_telegram_update',
+    'twilio_message': 'chatbot.pipeline.process_twilio_message',
+    'respond_to_message': 'chatbot.pipeline.process_scheduled_response',
+    'summarize_conversation': 'chatbot.summarizer.summarize_conversation',
+}
+
+
+def enqueue(kind, payload, delay=0, ordering_key=''):
+    """
+    Grava uma nova tarefa na fila. 'delay' (em segundos) adia a primeira execução.
+    Tarefas com o mesmo 'ordering_key' (ver ordering.ordering_key) são executadas uma
+    de cada vez, na ordem em que foram enfileiradas.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Tipo de tarefa desconhecido: {kind}")
+    available_at = timezone.now() + timedelta(seconds=delay)
+    job = Job.objects.create(
+        kind=kind, payload=payload, available_at=available_at,
+        ordering_key=ordering_key, partition=partition_for(ordering_key) if ordering_key else 0,
+    )
+    logger.info(f"Tarefa {job.pk} ({kind}) enfileirada.")
+    return job
+
+
+def claim_jobs(limit, partitions=None):
+    """
+    Reserva até 'limit' tarefas pendentes para este worker.
+    Usa SELECT ... FOR UPDATE SKIP LOCKED para que vários workers possam
+    disputar a mesma fila sem pegar a mesma tarefa.
+
+    Uma tarefa com ordering_key só é reservada quando não há outra mais antiga da mesma
+    chave pendente ou em execução: cada conversa é processada em ordem, por um worker de
+    cada vez, enquanto conversas diferentes rodam em paralelo. 'partitions' restringe a
+    reserva às partições deste worker (run_worker --shard).
+    """
+    now = timezone.now()
+    earlier_unfinished = Job.objects.filter(
+        ordering_key=OuterRef('ordering_key'),
+        status__in=[Job.STATUS_PENDING, Job.STATUS_RUNNING],
+        id__lt=OuterRef('id'),
+    )
+    queryset = Job.objects.filter(status=Job.STATUS_PENDING, available_at__lte=now).filter(
+        Q(ordering_key='') | ~Exists(earlier_unfinished)
+    )
+    if partitions is not None:
+        queryset = queryset.filter(partition__in=partitions)
+
+    with transaction.atomic():
+        ids = list(
+            queryset.select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        Job.objects.filter(id__in=ids).update(
+            status=Job.STATUS_RUNNING, locked_at=now, attempts=F('attempts') + 1
+        )
+    return list(Job.objects.filter(id__in=ids).order_by('id'))
+
+
+def run_job(job):
+    """
+    Executa uma tarefa já reservada e registra o resultado.
+    Em caso de erro, a tarefa volta para a fila com backoff até atingir JOB_MAX_ATTEMPTS.
+    """
+    try:
+        handler = import_string(JOB_HANDLERS[job.kind])
+        handler(job.payload)
+    except Exception as e:
+        logger.error(f"Erro ao executar a tarefa {job.pk} ({job.kind}): {e}", exc_info=True)
+        job.last_error = str(e)
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            job.status = Job.STATUS_FAILED
+            job.finished_at = timezone.now()
+        else:
+            job.status = Job.STATUS_PENDING
+            job.available_at = timezone.now() + timedelta(seconds=2 ** job.attempts)
+        job.locked_at = None
+        job.save(update_fields=['status', 'last_error', 'available_at', 'locked_at', 'finished_at'])
+        return False
+
+    job.status = Job.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.locked_at = None
+    job.save(update_fields=['status', 'finished_at', 'locked_at'])
+    return True
+
+
+def requeue_stale_jobs(timeout=None):
+    """
+    Devolve para a fila tarefas presas em 'running' por mais de 'timeout' segundos
+    (ex: o worker morreu no meio do processamento).
+    """
+    timeout = settings.JOB_LOCK_TIMEOUT if timeout is None else timeout
+    limit = timezone.now() - timedelta(seconds=timeout)
+    count = Job.objects.filter(status=Job.STATUS_RUNNING, locked_at__lt=limit).update(
+        status=Job.STATUS_PENDING, locked_at=None
+    )
+    if count:
+        logger.warning(f"{count} tarefa(s) presa(s) devolvida(s) para a fila.")
+    return count
+
+
+def queue_depth():
+    """
+    Retorna a quantidade de tarefas por status e a idade (em segundos)
+    da tarefa pendente mais antiga.
+    """
+    depth = {status: 0 for status, _ in Job.STATUS_CHOICES}
+    for row in Job.objects.values('status').annotate(total=Count('id')).order_by():
+        depth[row['status']] = row['total']
+
+    oldest = Job.objects.filter(status=Job.STATUS_PENDING).aggregate(oldest=Min('available_at'))['oldest']
+    depth['oldest_pending_age'] = max((timezone.now() - oldest).total_seconds(), 0) if oldest else 0
+    return depth
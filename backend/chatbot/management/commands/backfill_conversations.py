@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot import conversations
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalcula a tabela Conversation (contadores, última mensagem, conversa no Chatwoot) a partir '
+        'do histórico de mensagens. Use depois de migrar ou de apagar mensagens em massa; o status '
+        '(bot/humano) de cada conversa é preservado.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Conversas gravadas por lote.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        written = conversations.backfill(batch_size=max(options['batch_size'], 1))
+        self.stdout.write(f"{written} conversa(s) recalculada(s) em {time.perf_counter() - start:.1f}s.")
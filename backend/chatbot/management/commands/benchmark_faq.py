@@ -0,0 +1,67 @@
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.faq import FAQIndex
+
+TOPICS = [
+    'horário de funcionamento', 'endereço da clínica', 'convênios aceitos', 'valor da consulta',
+    'resultado de exames', 'agendamento de consulta', 'cancelamento de consulta', 'estacionamento',
+    'vacinas disponíveis', 'especialidades atendidas', 'preparo para exame de sangue', 'atendimento aos sábados',
+]
+TEMPLATES = [
+    'Qual {} da unidade {}?', 'Como funciona {} no setor {}?', 'Gostaria de saber sobre {} na filial {}',
+    'Vocês informam {} do ambulatório {}?',
+]
+
+
+def synthetic_questions(count):
+    for i in range(count):
+        yield random.choice(TEMPLATES).format(random.choice(TOPICS), i)
+
+
+class Command(BaseCommand):
+    help = (
+        'Mede o índice do FAQ em memória com perguntas sintéticas: tempo de construção, '
+        'buscas por segundo e memória ocupada pelos vetores. Não acessa o banco.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entries', type=int, nargs='+', default=[10_000, 100_000], help='Tamanhos de índice a medir.'
+        )
+        parser.add_argument('--queries', type=int, default=1_000, help='Buscas por medição.')
+        parser.add_argument('--dim', type=int, default=settings.FAQ_VECTOR_DIM, help='Dimensão dos vetores.')
+
+    def handle(self, *args, **options):
+        for entries in options['entries']:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n== {entries} entradas, dim {options['dim']} =="))
+            self.measure(entries, options['queries'], options['dim'])
+
+    def measure(self, entries, queries, dim):
+        questions = list(synthetic_questions(entries))
+        index = FAQIndex(dim)
+
+        start = time.perf_counter()
+        index.build((i, question, f"Resposta {i}") for i, question in enumerate(questions))
+        self.stdout.write(f"Construção: {time.perf_counter() - start:.2f}s")
+        self.stdout.write(f"Memória dos vetores: {index.memory_bytes / 1024 / 1024:.1f} MB")
+
+        sample = [random.choice(questions).lower().rstrip('?') for _ in range(queries)]
+        threshold = settings.FAQ_SIMILARITY_THRESHOLD
+        timings = []
+        matched = 0
+        for text in sample:
+            start = time.perf_counter()
+            matched += index.search(text, threshold) is not None
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+        self.stdout.write(
+            f"{queries} buscas: {1000 * queries / sum(timings):.0f}/s, p50 {statistics.median(timings):.2f}ms, "
+            f"p95 {p95:.2f}ms, {matched} acima do limiar ({threshold})"
+        )
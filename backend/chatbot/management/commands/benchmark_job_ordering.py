@@ -0,0 +1,89 @@
+import io
+import threading
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from chatbot import jobs
+from chatbot.models import Job
+from chatbot.ordering import ordering_key
+
+BENCH_KIND = 'benchmark_sleep'
+
+_records = []
+_records_lock = threading.Lock()
+
+
+def record_job(payload):
+    """
+    Tarefa sintética: simula o processamento de uma mensagem e registra quando rodou.
+    """
+    start = time.perf_counter()
+    time.sleep(payload['work_ms'] / 1000)
+    with _records_lock:
+        _records.append((payload['conversation'], payload['seq'], start, time.perf_counter()))
+
+
+class Command(BaseCommand):
+    help = (
+        'Mede a vazão do run_worker com várias mensagens por conversa, para diferentes '
+        'concorrências, e confere se cada conversa foi processada em ordem e sem sobreposição. '
+        'Por fim repete a maior concorrência sem ordering_key, para comparação.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=5, help='Mensagens por conversa.')
+        parser.add_argument('--work-ms', type=int, default=50, help='Duração simulada de cada tarefa.')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+
+    def handle(self, *args, **options):
+        jobs.JOB_HANDLERS[BENCH_KIND] = f'{__name__}.record_job'
+        try:
+            for concurrency in options['concurrency']:
+                self.run(concurrency, ordered=True, options=options)
+            self.run(max(options['concurrency']), ordered=False, options=options)
+        finally:
+            Job.objects.filter(kind=BENCH_KIND).delete()
+            del jobs.JOB_HANDLERS[BENCH_KIND]
+
+    def run(self, concurrency, ordered, options):
+        Job.objects.filter(kind=BENCH_KIND).delete()
+        _records.clear()
+
+        # Cada conversa manda suas mensagens em rajada, como costuma acontecer no WhatsApp/Telegram.
+        for conversation in range(options['conversations']):
+            for seq in range(options['messages']):
+                key = ordering_key('benchmark', conversation) if ordered else ''
+                jobs.enqueue(BENCH_KIND, {
+                    'conversation': conversation, 'seq': seq, 'work_ms': options['work_ms'],
+                }, ordering_key=key)
+
+        start = time.perf_counter()
+        call_command(
+            'run_worker', concurrency=concurrency, once=True, poll_interval=0.05,
+            stats_interval=3600, stdout=io.StringIO(),
+        )
+        elapsed = time.perf_counter() - start
+
+        label = 'com ordem' if ordered else 'sem chave'
+        self.stdout.write(
+            f"{label}, concorrência {concurrency}: {len(_records)} tarefas em {elapsed:.2f}s "
+            f"({len(_records) / elapsed:.1f}/s), {self.violations()} conversa(s) fora de ordem"
+        )
+
+    def violations(self):
+        """
+        Conversas em que uma mensagem começou antes da anterior terminar.
+        """
+        by_conversation = {}
+        for conversation, seq, start, end in _records:
+            by_conversation.setdefault(conversation, []).append((seq, start, end))
+
+        broken = 0
+        for runs in by_conversation.values():
+            runs.sort()
+            if any(later[1] < earlier[2] for earlier, later in zip(runs, runs[1:])):
+                broken += 1
+        return broken
@@ -0,0 +1,97 @@
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from chatbot.context import history_queryset
+from chatbot.models import Message
+
+BENCH_PREFIX = 'bench-'
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Mede a latência da busca de histórico de uma conversa e mostra o plano (EXPLAIN) '
+        'com e sem os índices de Message. ATENÇÃO: a medição "sem índice" remove os índices '
+        'dentro de uma transação (desfeita no final), o que bloqueia a tabela; não rode em produção.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Quantidade de mensagens a gerar.')
+        parser.add_argument('--conversations', type=int, default=10_000, help='Quantidade de conversas distintas.')
+        parser.add_argument('--queries', type=int, default=200, help='Buscas de histórico por medição.')
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--skip-seed', action='store_true', help='Reaproveita as mensagens de uma execução anterior.')
+        parser.add_argument('--cleanup', action='store_true', help='Apaga as mensagens geradas ao final.')
+
+    def handle(self, *args, **options):
+        conversations = [f"{BENCH_PREFIX}{i}" for i in range(options['conversations'])]
+        if not options['skip_seed']:
+            self.seed(options['rows'], conversations, options['batch_size'])
+
+        sample = [random.choice(conversations) for _ in range(options['queries'])]
+
+        self.stdout.write(self.style.MIGRATE_HEADING("\n== Sem os índices (antes) =="))
+        try:
+            with transaction.atomic():
+                schema_editor = connection.schema_editor()
+                with connection.cursor() as cursor:
+                    for index in Message._meta.indexes:
+                        cursor.execute(str(index.remove_sql(Message, schema_editor)))
+                self.measure(sample)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        self.stdout.write(self.style.MIGRATE_HEADING("\n== Com os índices (depois) =="))
+        self.measure(sample)
+
+        if options['cleanup']:
+            deleted, _ = Message.objects.filter(conversation_id__startswith=BENCH_PREFIX).delete()
+            self.stdout.write(f"\n{deleted} mensagens de benchmark removidas.")
+
+    def seed(self, rows, conversations, batch_size):
+        self.stdout.write(f"Gerando {rows} mensagens em {len(conversations)} conversas...")
+        start = time.perf_counter()
+        created = 0
+        while created < rows:
+            size = min(batch_size, rows - created)
+            Message.objects.bulk_create([
+                Message(
+                    channel='telegram', conversation_id=random.choice(conversations),
+                    sender='user' if (created + i) % 2 == 0 else 'bot',
+                    text=f"Mensagem de benchmark número {created + i}.",
+                )
+                for i in range(size)
+            ], batch_size=batch_size)
+            created += size
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {Message._meta.db_table}")
+        self.stdout.write(f"Mensagens geradas em {time.perf_counter() - start:.1f}s.")
+
+    def measure(self, sample):
+        page_size = settings.AI_CONTEXT_PAGE_SIZE
+        timings = []
+        for conversation_id in sample:
+            start = time.perf_counter()
+            list(history_queryset('telegram', conversation_id)[:page_size])
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+        self.stdout.write(
+            f"{len(timings)} buscas: p50 {statistics.median(timings):.2f}ms, "
+            f"p95 {p95:.2f}ms, máx {timings[-1]:.2f}ms"
+        )
+
+        queryset = history_queryset('telegram', sample[0])[:page_size]
+        explain_options = {'analyze': True} if connection.vendor == 'postgresql' else {}
+        self.stdout.write(queryset.explain(**explain_options))
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import Message
+from chatbot.stub_servers import OpenRouterStubHandler, StubServer
+
+BENCH_PREFIX = 'whatsapp:bench-'
+
+
+class PeakTrackingOpenRouterHandler(OpenRouterStubHandler):
+    """
+    Registra quantas chamadas ao OpenRouter o servidor testado manteve em andamento ao mesmo tempo.
+    """
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        try:
+            super().do_POST()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara quantas conversas simultâneas o webhook do Twilio aguenta sob WSGI (gunicorn com '
+        'workers síncronos, como no entrypoint) e sob ASGI (uvicorn com ASYNC_WEBHOOKS). '
+        'O OpenRouter é simulado localmente com latência fixa; o Chatwoot fica desligado. '
+        'Usa o banco configurado e grava mensagens de conversas com prefixo "whatsapp:bench-".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=['wsgi', 'asgi', 'both'], default='both')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 300],
+                            help='Requisições simultâneas por medição.')
+        parser.add_argument('--latency', type=float, default=1.0, help='Latência simulada do OpenRouter (segundos).')
+        parser.add_argument('--workers', type=int, default=3, help='Workers do gunicorn (WSGI).')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--timeout', type=float, default=120, help='Timeout de cada requisição (segundos).')
+        parser.add_argument('--cleanup', action='store_true', help='Apaga as mensagens geradas ao final.')
+
+    def handle(self, *args, **options):
+        servers = ['wsgi', 'asgi'] if options['server'] == 'both' else [options['server']]
+        with StubServer(PeakTrackingOpenRouterHandler, latency=options['latency'], reply='Resposta simulada.') as stub:
+            stub.httpd.lock = threading.Lock()
+            for server in servers:
+                self.stdout.write(self.style.MIGRATE_HEADING(f"\n== {server.upper()} =="))
+                process = self.start_server(server, stub.url, options)
+                try:
+                    for concurrency in options['concurrency']:
+                        stub.httpd.in_flight = stub.httpd.peak = 0
+                        self.measure(concurrency, options)
+                        self.stdout.write(f"  pico de chamadas simultâneas ao OpenRouter: {stub.httpd.peak}")
+                finally:
+                    process.terminate()
+                    process.wait(timeout=10)
+
+        if options['cleanup']:
+            deleted, _ = Message.objects.filter(conversation_id__startswith=BENCH_PREFIX).delete()
+            self.stdout.write(f"\n{deleted} mensagens de benchmark removidas.")
+
+    def start_server(self, server, openrouter_url, options):
+        env = dict(
+            os.environ,
+            OPENROUTER_BASE_URL=openrouter_url,
+            OPENROUTER_API_KEY=os.environ.get('OPENROUTER_API_KEY', 'benchmark'),
+            ASYNC_WEBHOOKS='True' if server == 'asgi' else 'False',
+            WEBHOOK_ASYNC_MODE='False',
+            AI_CACHE_ENABLED='False',
+            FAQ_MATCHER_ENABLED='False',
+            AI_SUMMARY_ENABLED='False',
+            TWILIO_INBOX_ID='',
+            DEBUG='False',
+            HTTP_POOL_SIZES=f"127.0.0.1={max(options['concurrency'])}",
+            HTTP_ASYNC_MAX_CONNECTIONS=str(max(options['concurrency'])),
+        )
+        port = str(options['port'])
+        if server == 'wsgi':
+            command = [sys.executable, '-m', 'gunicorn', 'core.wsgi:application', '--bind', f'127.0.0.1:{port}',
+                       '--workers', str(options['workers']), '--timeout', str(int(options['timeout']))]
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'core.asgi:application', '--host', '127.0.0.1',
+                       '--port', port, '--log-level', 'warning']
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', options['port']), timeout=1).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError(f"O servidor {server} não subiu na porta {port}.")
+
+    def measure(self, concurrency, options):
+        url = f"http://127.0.0.1:{options['port']}/api/v1/twilio/webhook/"
+        timings, errors, elapsed = asyncio.run(self.fire(url, concurrency, options['timeout']))
+
+        completed = len(timings)
+        line = f"{concurrency} simultâneas: {completed} ok, {errors} erro(s) em {elapsed:.1f}s"
+        if timings:
+            timings.sort()
+            p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+            line += (
+                f" ({completed / elapsed:.1f} req/s), p50 {statistics.median(timings):.2f}s, "
+                f"p95 {p95:.2f}s, máx {timings[-1]:.2f}s"
+            )
+        self.stdout.write(line)
+
+    async def fire(self, url, concurrency, timeout):
+        """
+        Dispara 'concurrency' mensagens ao mesmo tempo, cada uma de uma conversa diferente.
+        """
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            async def send(i):
+                data = {'From': f"{BENCH_PREFIX}{i}", 'Body': f"Mensagem de benchmark {i}", 'ProfileName': 'Bench'}
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, data=data)
+                except httpx.HTTPError:
+                    return None
+                return time.perf_counter() - start if response.status_code == 200 else None
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(send(i) for i in range(concurrency)))
+            elapsed = time.perf_counter() - start
+
+        timings = [r for r in results if r is not None]
+        return timings, len(results) - len(timings), elapsed
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chatbot.models import LLMRequestLog
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Resume as chamadas à IA registradas pelo gateway (chatbot_llmrequestlog): por modelo e '
+        'finalidade, volume, erros, tokens, espera na fila, latência, e o pico de gerações simultâneas.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=60, help='Janela analisada (minutos até agora).')
+        parser.add_argument('--prune-days', type=int, help='Apaga os registros mais antigos que N dias.')
+
+    def handle(self, *args, **options):
+        if options['prune_days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['prune_days'])
+            deleted, _ = LLMRequestLog.objects.filter(created_at__lt=cutoff).delete()
+            self.stdout.write(f"{deleted} registro(s) anteriores a {cutoff:%Y-%m-%d %H:%M} apagado(s).")
+
+        since = timezone.now() - timedelta(minutes=options['minutes'])
+        rows = list(LLMRequestLog.objects.filter(created_at__gte=since).values(
+            'created_at', 'model', 'purpose', 'status', 'prompt_tokens', 'completion_tokens',
+            'queue_ms', 'first_token_ms', 'latency_ms',
+        ))
+        if not rows:
+            self.stdout.write(f"Nenhuma chamada à IA nos últimos {options['minutes']} minuto(s).")
+            return
+
+        groups = {}
+        for row in rows:
+            groups.setdefault((row['model'], row['purpose']), []).append(row)
+
+        for (model, purpose), calls in sorted(groups.items()):
+            ok = [c for c in calls if c['status'] == 'ok']
+            latencies = [c['latency_ms'] for c in ok]
+            first_tokens = [c['first_token_ms'] for c in ok if c['first_token_ms'] is not None]
+            queues = [c['queue_ms'] for c in calls]
+            self.stdout.write(
+                f"{model} [{purpose}]: {len(calls)} chamada(s), {len(ok)} ok, "
+                f"{sum(c['status'] == 'error' for c in calls)} erro(s), "
+                f"{sum(c['status'] == 'cancelled' for c in calls)} cancelada(s), "
+                f"{sum(c['status'] == 'rejected' for c in calls)} recusada(s)."
+            )
+            self.stdout.write(
+                f"  tokens: {sum(c['prompt_tokens'] or 0 for c in calls)} de prompt, "
+                f"{sum(c['completion_tokens'] or 0 for c in calls)} gerados. "
+                f"Fila: média {sum(queues) / len(queues):.0f} ms, p95 {percentile(queues, 95)} ms. "
+                f"Latência: p50 {percentile(latencies, 50)} ms, p95 {percentile(latencies, 95)} ms"
+                + (f". Primeiro pedaço: p50 {percentile(first_tokens, 50)} ms." if first_tokens else ".")
+            )
+
+        self.stdout.write(f"Pico de gerações simultâneas: {self.peak_concurrency(rows)}.")
+
+    def peak_concurrency(self, rows):
+        """
+        Maior número de chamadas em andamento ao mesmo tempo (a latência não inclui a fila).
+        """
+        events = []
+        for row in rows:
+            start = row['created_at'] + timedelta(milliseconds=row['queue_ms'])
+            events.append((start, 1))
+            events.append((start + timedelta(milliseconds=row['latency_ms']), -1))
+        peak = current = 0
+        for _, delta in sorted(events):
+            current += delta
+            peak = max(peak, current)
+        return peak
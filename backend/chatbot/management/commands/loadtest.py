@@ -0,0 +1,304 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import ChatwootIdentity, Message
+from chatbot.stub_servers import (
+    ChatwootStubHandler, OpenRouterStubHandler, StubServer, TelegramStubHandler, TwilioStubHandler,
+)
+
+ENDPOINTS = ['telegram', 'twilio', 'chatwoot']
+PATHS = {
+    'telegram': '/api/v1/telegram/webhook/',
+    'twilio': '/api/v1/twilio/webhook/',
+    'chatwoot': '/api/v1/webhook/chatwoot/',
+}
+# Stub em que a resposta de cada endpoint chega ao usuário.
+DELIVERY_STUB = {'telegram': 'telegram', 'twilio': 'twilio', 'chatwoot': 'chatwoot'}
+
+
+def percentiles(values):
+    """
+    p50/p95/p99/máximo em milissegundos (None sem amostras).
+    """
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def pick(pct):
+        return round(values[min(int(len(values) * pct / 100), len(values) - 1)] * 1000, 1)
+
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': round(values[-1] * 1000, 1)}
+
+
+class Command(BaseCommand):
+    help = (
+        'Teste de carga sem rede: sobe stubs locais do OpenRouter, da Bot API do Telegram, do Chatwoot e do '
+        'Twilio, sobe o servidor (gunicorn ou uvicorn) apontando para eles e dispara webhooks reais do '
+        'Telegram, do Twilio e do Chatwoot numa taxa fixa (RPS). Mede a latência da resposta HTTP e a de ponta '
+        'a ponta (até a resposta chegar ao stub do canal), a vazão e as taxas de erro, e grava tudo em JSON '
+        '(--output) para comparar versões. Usa o banco configurado; cada requisição é uma conversa nova.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS,
+                            help='Webhooks exercitados, em rodízio.')
+        parser.add_argument('--rps', type=float, default=10, help='Requisições por segundo (taxa fixa, malha aberta).')
+        parser.add_argument('--duration', type=float, default=30, help='Duração do disparo (segundos).')
+        parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+        parser.add_argument('--workers', type=int, default=3, help='Workers do gunicorn (WSGI).')
+        parser.add_argument('--queue', action='store_true',
+                            help='Webhooks só enfileiram (WEBHOOK_ASYNC_MODE) e um `run_worker` processa.')
+        parser.add_argument('--worker-concurrency', type=int, default=settings.WORKER_CONCURRENCY)
+        parser.add_argument('--ai-latency', type=float, default=1.0, help='Latência do OpenRouter simulado (segundos).')
+        parser.add_argument('--chunk-delay', type=float, default=0.05, help='Intervalo entre pedaços no streaming.')
+        parser.add_argument('--stream', action='store_true', help='Liga AI_STREAMING_ENABLED (Telegram).')
+        parser.add_argument('--chatwoot-latency', type=float, default=0.1)
+        parser.add_argument('--channel-latency', type=float, default=0.05, help='Latência dos stubs do Telegram e do Twilio.')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Mantém OUTBOUND_RATE_LIMITS (por padrão os limites de envio são desligados).')
+        parser.add_argument('--env', action='append', default=[], metavar='CHAVE=VALOR',
+                            help='Configuração extra para o servidor (ex: --env CHATWOOT_OUTBOX_ENABLED=True).')
+        parser.add_argument('--port', type=int, default=8766)
+        parser.add_argument('--timeout', type=float, default=60, help='Timeout de cada requisição (segundos).')
+        parser.add_argument('--drain', type=float, default=30,
+                            help='Quanto esperar, após o disparo, pelas respostas ainda não entregues (segundos).')
+        parser.add_argument('--output', help='Arquivo JSON com o resultado (padrão: só o resumo na tela).')
+        parser.add_argument('--cleanup', action='store_true', help='Apaga as mensagens e identidades geradas ao final.')
+
+    def handle(self, *args, **options):
+        # Base única por execução: IDs de conversa e de entrega não colidem com execuções anteriores no mesmo banco.
+        self.base = int(time.time() * 1000)
+        stubs = {
+            'openrouter': StubServer(OpenRouterStubHandler, latency=options['ai_latency'],
+                                     chunk_delay=options['chunk_delay'], reply='Resposta simulada do teste de carga.'),
+            'telegram': StubServer(TelegramStubHandler, latency=options['channel_latency']),
+            'twilio': StubServer(TwilioStubHandler, latency=options['channel_latency']),
+            'chatwoot': StubServer(ChatwootStubHandler, latency=options['chatwoot_latency']),
+        }
+        for stub in stubs.values():
+            stub.start()
+        processes = []
+        try:
+            env = self.server_env(stubs, options)
+            processes.append(self.start_server(env, options))
+            if options['queue']:
+                processes.append(subprocess.Popen(
+                    [sys.executable, 'manage.py', 'run_worker', '--concurrency', str(options['worker_concurrency'])],
+                    cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL,
+                ))
+            results, started = asyncio.run(self.drive(options))
+            self.wait_deliveries(stubs, results, options['drain'])
+            report = self.report(stubs, results, started, options)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(timeout=10)
+            for stub in stubs.values():
+                stub.stop()
+
+        self.print_summary(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Resultado gravado em {options['output']}.")
+        if options['cleanup']:
+            self.cleanup(results)
+
+    # --- Servidor ---
+
+    def server_env(self, stubs, options):
+        env = dict(
+            os.environ,
+            OPENROUTER_BASE_URL=stubs['openrouter'].url,
+            OPENROUTER_API_KEY='loadtest',
+            TELEGRAM_API_BASE_URL=stubs['telegram'].url,
+            TELEGRAM_BOT_TOKEN='loadtest',
+            TELEGRAM_INBOX_ID='1',
+            TWILIO_API_BASE_URL=stubs['twilio'].url,
+            TWILIO_ACCOUNT_SID='ACloadtest',
+            TWILIO_AUTH_TOKEN='loadtest',
+            TWILIO_WHATSAPP_NUMBER='+15550000000',
+            TWILIO_INBOX_ID='2',
+            CHATWOOT_BASE_URL=stubs['chatwoot'].url,
+            CHATWOOT_ACCOUNT_ID='1',
+            CHATWOOT_ACCESS_TOKEN='loadtest',
+            CHATWOOT_API_TOKEN='loadtest',
+            ASYNC_WEBHOOKS='True' if options['server'] == 'asgi' else 'False',
+            WEBHOOK_ASYNC_MODE='True' if options['queue'] else 'False',
+            AI_STREAMING_ENABLED='True' if options['stream'] else 'False',
+            AI_CACHE_ENABLED='False',
+            FAQ_MATCHER_ENABLED='False',
+            AI_SUMMARY_ENABLED='False',
+            DEBUG='False',
+            HTTP_POOL_SIZES='127.0.0.1=100',
+            HTTP_ASYNC_MAX_CONNECTIONS='500',
+        )
+        if not options['rate_limits']:
+            env.update(OUTBOUND_RATE_LIMITS='', OUTBOUND_RECIPIENT_RATE_LIMITS='')
+        for item in options['env']:
+            key, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f"--env inválido: {item} (use CHAVE=VALOR).")
+            env[key] = value
+        return env
+
+    def start_server(self, env, options):
+        port = str(options['port'])
+        if options['server'] == 'wsgi':
+            command = [sys.executable, '-m', 'gunicorn', 'core.wsgi:application', '--bind', f'127.0.0.1:{port}',
+                       '--workers', str(options['workers']), '--timeout', str(int(options['timeout']))]
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'core.asgi:application', '--host', '127.0.0.1',
+                       '--port', port, '--log-level', 'warning']
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', options['port']), timeout=1).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError(f"O servidor {options['server']} não subiu na porta {port}.")
+
+    # --- Disparo ---
+
+    def request_for(self, endpoint, n):
+        """
+        Webhook da requisição n e o destinatário em que a resposta deve chegar.
+        """
+        key = self.base + n
+        if endpoint == 'telegram':
+            payload = {'update_id': key, 'message': {
+                'chat': {'id': key}, 'from': {'first_name': 'Carga'}, 'text': f"Mensagem de carga {n}",
+            }}
+            return {'json': payload}, str(key)
+        if endpoint == 'twilio':
+            recipient = f"whatsapp:+{key}"
+            data = {'From': recipient, 'Body': f"Mensagem de carga {n}", 'ProfileName': 'Carga', 'MessageSid': f"SM{key}"}
+            return {'data': data}, recipient
+        payload = {'event': 'message_created', 'message_type': 'incoming',
+                   'conversation': {'id': key}, 'content': f"Mensagem de carga {n}"}
+        return {'json': payload}, str(key)
+
+    async def drive(self, options):
+        """
+        Malha aberta: a requisição n sai em started + n / rps, responda o servidor ou não.
+        """
+        total = int(options['rps'] * options['duration'])
+        endpoints = options['endpoints']
+        base_url = f"http://127.0.0.1:{options['port']}"
+        limits = httpx.Limits(max_connections=min(max(int(options['rps'] * options['timeout']), 10), 1000))
+
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=options['timeout']) as client:
+            async def send(n, endpoint):
+                kwargs, recipient = self.request_for(endpoint, n)
+                result = {'endpoint': endpoint, 'recipient': recipient, 'sent_at': time.monotonic(), 'status': None}
+                try:
+                    response = await client.post(PATHS[endpoint], **kwargs)
+                    result['status'] = response.status_code
+                except httpx.HTTPError as e:
+                    result['error'] = type(e).__name__
+                result['http_latency'] = time.monotonic() - result['sent_at']
+                return result
+
+            started = time.monotonic()
+            tasks = []
+            for n in range(total):
+                delay = started + n / options['rps'] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(send(n, endpoints[n % len(endpoints)])))
+            results = await asyncio.gather(*tasks)
+        return results, started
+
+    def wait_deliveries(self, stubs, results, drain):
+        pending = {(DELIVERY_STUB[r['endpoint']], r['recipient']) for r in results if self.ok(r)}
+        deadline = time.monotonic() + drain
+        while time.monotonic() < deadline:
+            delivered = {(name, recipient) for name in set(DELIVERY_STUB.values())
+                         for recipient, _ in list(stubs[name].deliveries)}
+            if pending <= delivered:
+                return
+            time.sleep(0.2)
+
+    @staticmethod
+    def ok(result):
+        return result['status'] is not None and 200 <= result['status'] < 300
+
+    # --- Relatório ---
+
+    def report(self, stubs, results, started, options):
+        first_delivery = {}
+        for name in set(DELIVERY_STUB.values()):
+            for recipient, at in stubs[name].deliveries:
+                first_delivery.setdefault((name, recipient), at)
+
+        endpoints = {}
+        for endpoint in options['endpoints']:
+            rows = [r for r in results if r['endpoint'] == endpoint]
+            ok = [r for r in rows if self.ok(r)]
+            delivered_at = [first_delivery.get((DELIVERY_STUB[endpoint], r['recipient'])) for r in ok]
+            e2e = [at - r['sent_at'] for r, at in zip(ok, delivered_at) if at is not None]
+            elapsed = max(max((at for at in delivered_at if at is not None), default=started) - started, 1e-9)
+            endpoints[endpoint] = {
+                'requests': len(rows),
+                'http_errors': len(rows) - len(ok),
+                'undelivered': len(ok) - len(e2e),
+                'error_rate': round((len(rows) - len(e2e)) / len(rows), 4) if rows else 0.0,
+                'throughput_rps': round(len(e2e) / elapsed, 2) if e2e else 0.0,
+                'http_latency_ms': percentiles([r['http_latency'] for r in ok]),
+                'e2e_latency_ms': percentiles(e2e),
+                'status_codes': self.status_codes(rows),
+            }
+
+        return {
+            'config': {
+                key: options[key] for key in (
+                    'endpoints', 'rps', 'duration', 'server', 'workers', 'queue', 'worker_concurrency', 'ai_latency',
+                    'chunk_delay', 'stream', 'chatwoot_latency', 'channel_latency', 'rate_limits', 'env',
+                )
+            },
+            'endpoints': endpoints,
+            'upstream_requests': {name: len(stub.requests) for name, stub in stubs.items()},
+        }
+
+    @staticmethod
+    def status_codes(rows):
+        codes = {}
+        for r in rows:
+            key = str(r['status']) if r['status'] is not None else r.get('error', 'erro')
+            codes[key] = codes.get(key, 0) + 1
+        return codes
+
+    def print_summary(self, report):
+        config = report['config']
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{config['server'].upper()}{' + fila' if config['queue'] else ''}, {config['rps']} req/s por "
+            f"{config['duration']}s, IA com {config['ai_latency']}s"
+        ))
+        for endpoint, data in report['endpoints'].items():
+            e2e, http = data['e2e_latency_ms'], data['http_latency_ms']
+            self.stdout.write(
+                f"{endpoint}: {data['requests']} req, {data['http_errors']} erro(s) HTTP, "
+                f"{data['undelivered']} sem resposta, {data['throughput_rps']} resp/s. "
+                f"Ponta a ponta p50/p95/p99: {e2e['p50']}/{e2e['p95']}/{e2e['p99']} ms; "
+                f"HTTP p50/p95: {http['p50']}/{http['p95']} ms."
+            )
+        self.stdout.write(f"Chamadas recebidas pelos stubs: {report['upstream_requests']}")
+
+    def cleanup(self, results):
+        sources = [r['recipient'] for r in results if r['endpoint'] != 'chatwoot']
+        deleted, _ = Message.objects.filter(conversation_id__in=sources).delete()
+        ChatwootIdentity.objects.filter(source_id__in=sources).delete()
+        self.stdout.write(f"{deleted} mensagem(ns) do teste de carga removida(s).")
@@ -0,0 +1,41 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from chatbot import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        'Envia ao Chatwoot as mensagens gravadas no outbox (chatbot_chatwootoutbox), em ordem dentro '
+        'de cada conversa. O `run_worker` já faz isso com CHATWOOT_OUTBOX_ENABLED; use este comando '
+        'quando não houver worker (webhooks processados na hora) ou para esvaziar o outbox.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Envia o que estiver pendente e encerra.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            total = 0
+            while True:
+                sent, claimed = outbox.relay_once()
+                total += sent
+                if not claimed or sent < claimed:
+                    break
+            self.report(total)
+            return
+
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+        self.stdout.write("Relay do outbox do Chatwoot iniciado.")
+        outbox.run_relay(stopping)
+        self.stdout.write("Relay encerrado.")
+
+    def report(self, sent):
+        stats = outbox.stats()
+        self.stdout.write(
+            f"{sent} mensagem(ns) espelhada(s). Restam {stats['pending']} pendente(s) e {stats['failed']} com falha."
+        )
@@ -0,0 +1,160 @@
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from chatbot import gateway, hedging, history_cache, idempotency, jobs, outbound, outbox, resilience, response_cache
+from chatbot.http_client import pool_stats
+from chatbot.ordering import shard_partitions
+
+
+class Command(BaseCommand):
+    help = 'Processa as tarefas da fila de webhooks (tabela chatbot_job) com um pool de threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.WORKER_CONCURRENCY,
+            help='Quantidade de tarefas processadas em paralelo.'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=settings.WORKER_POLL_INTERVAL,
+            help='Segundos de espera quando a fila está vazia.'
+        )
+        parser.add_argument(
+            '--stats-interval', type=float, default=30,
+            help='De quanto em quanto tempo (segundos) o tamanho da fila é reportado.'
+        )
+        parser.add_argument(
+            '--shard', default=None,
+            help="Atende só uma parte das conversas, no formato i/N (ex: 0/3, 1/3, 2/3 em três processos)."
+        )
+        parser.add_argument('--once', action='store_true', help='Processa a fila até esvaziar e encerra.')
+        parser.add_argument('--stats', action='store_true', help='Apenas mostra o tamanho da fila e encerra.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.report_depth()
+            return
+
+        partitions = None
+        if options['shard']:
+            try:
+                partitions = shard_partitions(options['shard'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        concurrency = max(options['concurrency'], 1)
+        self.stopping = threading.Event()
+        # Acordado ao fim de cada tarefa: a próxima mensagem da mesma conversa pode ter sido liberada.
+        self.wakeup = threading.Event()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        shard = f", shard {options['shard']}" if partitions is not None else ''
+        self.stdout.write(f"Worker iniciado com concorrência {concurrency}{shard}.")
+        slots = threading.Semaphore(concurrency)
+        last_stats = 0
+
+        # Relay do outbox do Chatwoot numa thread própria: o espelhamento não ocupa vagas do pool.
+        relay = None
+        if settings.CHATWOOT_OUTBOX_ENABLED:
+            relay = threading.Thread(target=outbox.run_relay, args=(self.stopping,), name='outbox-relay', daemon=True)
+            relay.start()
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job') as executor:
+            while not self.stopping.is_set():
+                close_old_connections()
+                if time.monotonic() - last_stats >= options['stats_interval']:
+                    jobs.requeue_stale_jobs()
+                    response_cache.prune()
+                    idempotency.prune()
+                    self.report_depth()
+                    last_stats = time.monotonic()
+
+                # Só reserva tantas tarefas quanto houver threads livres.
+                self.wakeup.clear()
+                free = 0
+                while slots.acquire(blocking=False):
+                    free += 1
+                claimed = jobs.claim_jobs(free, partitions) if free else []
+                for _ in range(free - len(claimed)):
+                    slots.release()
+
+                for job in claimed:
+                    executor.submit(self.run_job, job, slots)
+
+                if not claimed:
+                    if options['once'] and free == concurrency:
+                        break
+                    self.wakeup.wait(options['poll_interval'])
+
+        if relay is not None:
+            relay.join()
+        self.report_depth()
+        self.stdout.write("Worker encerrado.")
+
+    def run_job(self, job, slots):
+        try:
+            jobs.run_job(job)
+        finally:
+            # Cada thread tem sua própria conexão com o banco; fecha ao terminar a tarefa.
+            connection.close()
+            slots.release()
+            self.wakeup.set()
+
+    def report_depth(self):
+        depth = jobs.queue_depth()
+        self.stdout.write(
+            f"Fila: {depth['pending']} pendente(s), {depth['running']} em execução, "
+            f"{depth['done']} concluída(s), {depth['failed']} com falha. "
+            f"Pendente mais antiga: {depth['oldest_pending_age']:.1f}s."
+        )
+        if settings.CHATWOOT_OUTBOX_ENABLED:
+            stats = outbox.stats()
+            self.stdout.write(
+                f"Outbox do Chatwoot: {stats['pending']} pendente(s), {stats['sending']} em envio, "
+                f"{stats['failed']} com falha. Atraso: {stats['oldest_pending_age']:.1f}s."
+            )
+        for host, stats in pool_stats().items():
+            self.stdout.write(
+                f"HTTP {host}: {stats['requests']} requisição(ões), "
+                f"{stats['connections']} conexão(ões) aberta(s), {stats['reused']} reaproveitada(s)."
+            )
+        for provider, stats in outbound.stats().items():
+            self.stdout.write(
+                f"Envios {provider}: {stats['sent']} liberado(s), {stats['queued']} na fila, "
+                f"{stats['throttled']} recusado(s) com 429. Espera na fila: média {stats['wait_avg']:.2f}s, "
+                f"p95 {stats['wait_p95']:.2f}s, máxima {stats['wait_max']:.2f}s."
+            )
+        for model, stats in resilience.stats().items():
+            self.stdout.write(
+                f"Modelo {model}: circuit breaker {stats['breaker']}, {stats['successes']} sucesso(s), "
+                f"{stats['failures']} falha(s). Latência: média {stats['latency_avg']:.2f}s, p95 {stats['latency_p95']:.2f}s."
+            )
+        for name, stats in gateway.concurrency_stats().items():
+            self.stdout.write(
+                f"Gerações ({name}): {stats['in_use']}/{stats['limit']} em uso, {stats['waiting']} na fila, "
+                f"pico {stats['peak']}, {stats['rejected']} recusada(s)."
+            )
+        if settings.HISTORY_CACHE_ENABLED:
+            stats = history_cache.stats()
+            self.stdout.write(
+                f"Cache do histórico: {stats['entries']} conversa(s), {stats['bytes'] / 1024 / 1024:.1f} MB, "
+                f"acerto {stats['hit_rate']:.0%} ({stats['hits']} acerto(s), {stats['misses']} falta(s), "
+                f"{stats['stale']} desatualizada(s)), {stats['evictions']} descartada(s)."
+            )
+        if settings.AI_HEDGING_ENABLED:
+            stats = hedging.stats()
+            self.stdout.write(
+                f"Hedging: disparado em {stats['hedged']} de {stats['requests']} pedido(s), "
+                f"{stats['hedge_wins']} vencido(s) pelo pedido extra, ~{stats['extra_prompt_tokens']} token(s) extra(s)."
+            )
+
+    def request_stop(self, signum, frame):
+        self.stdout.write("Sinal de parada recebido, aguardando as tarefas em andamento...")
+        self.stopping.set()
+        self.wakeup.set()
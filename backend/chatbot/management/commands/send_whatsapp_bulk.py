@@ -0,0 +1,60 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chatbot.async_http import aclose_client
+from chatbot.stub_servers import StubServer, TwilioStubHandler
+from twilio_bridge.services import asend_bulk_whatsapp
+
+
+class Command(BaseCommand):
+    help = (
+        'Envia a mesma mensagem de WhatsApp (via Twilio) para vários destinatários ao mesmo tempo, '
+        'na vazão máxima permitida por OUTBOUND_RATE_LIMITS, e mostra o relatório do lote. '
+        'Com --stub, os envios vão para um Twilio simulado localmente (medição sem custo).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('recipients', nargs='*', help="Destinatários no formato 'whatsapp:+55...'.")
+        parser.add_argument('--file', help='Arquivo com um destinatário por linha.')
+        parser.add_argument('--text', required=True)
+        parser.add_argument('--concurrency', type=int, help='Envios simultâneos (padrão: TWILIO_BULK_CONCURRENCY).')
+        parser.add_argument('--stub', type=float, metavar='LATENCIA',
+                            help='Usa um Twilio simulado com esta latência (segundos) por envio.')
+
+    def handle(self, *args, **options):
+        recipients = list(options['recipients'])
+        if options['file']:
+            with open(options['file']) as f:
+                recipients.extend(line.strip() for line in f if line.strip())
+        if not recipients:
+            raise CommandError('Informe ao menos um destinatário (argumentos ou --file).')
+        messages = [(recipient, options['text']) for recipient in recipients]
+
+        if options['stub'] is None:
+            report = asyncio.run(self.send(messages, options['concurrency']))
+        else:
+            with StubServer(TwilioStubHandler, latency=options['stub']) as stub:
+                with override_settings(
+                    TWILIO_API_BASE_URL=stub.url,
+                    TWILIO_ACCOUNT_SID=settings.TWILIO_ACCOUNT_SID or 'ACstub',
+                    TWILIO_AUTH_TOKEN=settings.TWILIO_AUTH_TOKEN or 'stub-token',
+                    TWILIO_WHATSAPP_NUMBER=settings.TWILIO_WHATSAPP_NUMBER or '+15550000000',
+                ):
+                    report = asyncio.run(self.send(messages, options['concurrency']))
+
+        self.stdout.write(
+            f"{report['sent']} enviada(s), {report['failed']} falha(s) em {report['elapsed']:.2f}s "
+            f"({report['throughput']:.1f} msg/s; limite configurado: "
+            f"{settings.OUTBOUND_RATE_LIMITS.get('twilio', 'sem limite')} msg/s)."
+        )
+        for recipient, error in report['errors'].items():
+            self.stdout.write(self.style.ERROR(f"  {recipient}: {error}"))
+
+    async def send(self, messages, concurrency):
+        try:
+            return await asend_bulk_whatsapp(messages, concurrency)
+        finally:
+            await aclose_client()
@@ -0,0 +1,416 @@
+"""
+Métricas de latência e volume no formato de exposição do Prometheus (rota /metrics).
+
+Medições (todas em segundos, com METRICS_ENABLED):
+- chatbot_stage_seconds{channel, stage}: etapas do pipeline (Chatwoot, contexto, geração, envio...);
+- chatbot_upstream_request_seconds{host, endpoint, method, status}: cada chamada HTTP às APIs
+  externas, até os cabeçalhos da resposta, medida na sessão requests e no cliente httpx compartilhados;
+  IDs e tokens no caminho viram ':id' (ex: /api/v1/accounts/:id/contacts/search);
+- chatbot_db_query_seconds{operation}: cada consulta ao banco (select, insert, update...);
+- chatbot_llm_*{model}: latência, fila e primeiro pedaço de cada tentativa do gateway, tokens e tokens/s;
+- chatbot_outbound_*{provider}: espera pela vazão (outbound) e duração total do envio a cada provedor;
+- chatbot_history_cache_*: consultas ao cache do histórico (por resultado) e memória ocupada por ele.
+
+O custo é o de um dicionário e um lock por medição (alguns microssegundos). As métricas ficam em
+memória por processo; com METRICS_MULTIPROC_DIR, cada processo grava um retrato em <pid>.json e a
+rota soma os contadores e histogramas dos processos vivos (os retratos de processos encerrados são
+apagados). Os gauges não são somados: cada processo aparece com o rótulo 'pid'.
+"""
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 500)
+
+_registry = []
+
+
+def enabled():
+    if not settings.METRICS_ENABLED:
+        return False
+    if _flusher is None and settings.METRICS_MULTIPROC_DIR:
+        _start_flusher()
+    return True
+
+
+class _Metric:
+    type = None
+    # Com METRICS_MULTIPROC_DIR, a série de cada processo é exposta à parte (rótulo 'pid') em vez de somada.
+    per_process = False
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def merge(value, other):
+        return value + other
+
+    def lines(self, key, value):
+        yield f"{self.name}{self._label_text(key)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Contagem por faixa (a última é +Inf) seguida da soma dos valores.
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def lines(self, key, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value[:-1]):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _number(bound)
+            yield f"{self.name}_bucket{self._label_text(key, [('le', le)])} {cumulative}"
+        yield f"{self.name}_sum{self._label_text(key)} {_number(value[-1])}"
+        yield f"{self.name}_count{self._label_text(key)} {cumulative}"
+
+
+class Gauge(Counter):
+    """
+    Valor atual (ex: memória ocupada). Com METRICS_MULTIPROC_DIR, a rota mostra o valor de cada
+    processo com o rótulo 'pid' (a soma de valores atuais de processos diferentes não significa nada).
+    """
+    type = 'gauge'
+    per_process = True
+
+    def set(self, value, **labels):
+        if not enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def lines(self, key, value):
+        # Com METRICS_MULTIPROC_DIR, a chave termina com o pid do processo (ver render()).
+        extra = [('pid', key[-1])] if len(key) > len(self.labelnames) else []
+        yield f"{self.name}{self._label_text(key[:len(self.labelnames)], extra)} {_number(value)}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- Métricas ---
+
+STAGE_SECONDS = Histogram(
+    'chatbot_stage_seconds', 'Duração de cada etapa do pipeline de mensagens.', ['channel', 'stage']
+)
+TURNS = Counter('chatbot_turns_total', 'Turnos processados, pelo status retornado pelo pipeline.', ['channel', 'status'])
+UPSTREAM_SECONDS = Histogram(
+    'chatbot_upstream_request_seconds', 'Chamadas HTTP às APIs externas, até os cabeçalhos da resposta.',
+    ['host', 'endpoint', 'method', 'status'],
+)
+DB_QUERY_SECONDS = Histogram('chatbot_db_query_seconds', 'Consultas ao banco de dados.', ['operation'], DB_BUCKETS)
+LLM_REQUEST_SECONDS = Histogram(
+    'chatbot_llm_request_seconds', 'Tentativas de geração no OpenRouter (sem a espera na fila do gateway).',
+    ['model', 'purpose', 'status'],
+)
+LLM_QUEUE_SECONDS = Histogram('chatbot_llm_queue_seconds', 'Espera por uma vaga de concorrência do gateway.', ['model'])
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    'chatbot_llm_first_token_seconds', 'Tempo até o primeiro pedaço das gerações em streaming.', ['model']
+)
+LLM_TOKENS = Counter('chatbot_llm_tokens_total', 'Tokens das gerações bem-sucedidas.', ['model', 'kind'])
+LLM_TOKENS_PER_SECOND = Histogram(
+    'chatbot_llm_tokens_per_second', 'Velocidade de geração (tokens de saída por segundo de geração).',
+    ['model'], TOKENS_PER_SECOND_BUCKETS,
+)
+OUTBOUND_WAIT_SECONDS = Histogram(
+    'chatbot_outbound_wait_seconds', 'Espera pelo controle de vazão antes de cada envio.', ['provider']
+)
+OUTBOUND_SEND_SECONDS = Histogram(
+    'chatbot_outbound_send_seconds', 'Envios aos provedores, com esperas e reenvios após 429.', ['provider', 'status']
+)
+HISTORY_CACHE_LOOKUPS = Counter(
+    'chatbot_history_cache_lookups_total', 'Consultas ao cache do histórico (hit, miss, stale).', ['result']
+)
+HISTORY_CACHE_BYTES = Gauge('chatbot_history_cache_bytes', 'Memória estimada ocupada pelo cache do histórico.')
+
+
+def stage(channel, name):
+    """
+    Mede uma etapa do pipeline: `with metrics.stage('telegram', 'generate'): ...` (vale também em código async).
+    """
+    return STAGE_SECONDS.time(channel=channel, stage=name)
+
+
+def endpoint_label(url):
+    """
+    (host, caminho) de uma URL com IDs numéricos, SIDs e tokens trocados por ':id', para que o
+    rótulo não tenha um valor por conversa (nem exponha o token do bot do Telegram).
+    """
+    parts = urlsplit(url)
+    segments = [
+        ':id' if segment.isdigit() or ':' in segment or len(segment) >= 20 else segment
+        for segment in parts.path.split('/')
+    ]
+    return parts.netloc, '/'.join(segments) or '/'
+
+
+def observe_upstream(method, url, status, seconds):
+    if not enabled():
+        return
+    host, endpoint = endpoint_label(url)
+    UPSTREAM_SECONDS.observe(seconds, host=host, endpoint=endpoint, method=method, status=status)
+
+
+def observe_llm_call(fields):
+    """
+    Registra uma tentativa do gateway a partir dos campos de LLMRequestLog (gateway._CallRecord.fields).
+    """
+    if not enabled():
+        return
+    model = fields['model']
+    LLM_REQUEST_SECONDS.observe(fields['latency_ms'] / 1000, model=model, purpose=fields['purpose'], status=fields['status'])
+    LLM_QUEUE_SECONDS.observe(fields['queue_ms'] / 1000, model=model)
+    if fields['first_token_ms'] is not None:
+        LLM_FIRST_TOKEN_SECONDS.observe(fields['first_token_ms'] / 1000, model=model)
+    if fields['status'] != 'ok':
+        return
+    LLM_TOKENS.inc(fields['prompt_tokens'] or 0, model=model, kind='prompt')
+    completion = fields['completion_tokens'] or 0
+    LLM_TOKENS.inc(completion, model=model, kind='completion')
+    # No streaming, a geração começa no primeiro pedaço; o tempo até ele é fila do provedor e prompt.
+    generation_ms = fields['latency_ms'] - (fields['first_token_ms'] or 0)
+    if completion and generation_ms > 0:
+        LLM_TOKENS_PER_SECOND.observe(completion / (generation_ms / 1000), model=model)
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    """
+    Wrapper de consultas do Django (connection.execute_wrappers), instalado pelo sinal
+    connection_created em cada conexão aberta.
+    """
+    if not settings.METRICS_ENABLED:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        operation = sql.lstrip().split(None, 1)[0].lower() if sql.strip() else ''
+        if operation not in ('select', 'insert', 'update', 'delete'):
+            operation = 'other'
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+
+# --- Exposição ---
+
+def _snapshot():
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # O processo existe, mas é de outro usuário.
+        return True
+    return True
+
+
+def _read_other_processes():
+    """
+    Retratos gravados pelos outros processos em METRICS_MULTIPROC_DIR, como (pid, retrato). Os
+    retratos de processos que já terminaram (worker reiniciado pelo gunicorn) são apagados.
+    """
+    directory = settings.METRICS_MULTIPROC_DIR
+    own = f"{os.getpid()}.json"
+    snapshots = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return snapshots
+    for name in names:
+        if name == own or not name.endswith('.json') or not name[:-5].isdigit():
+            continue
+        path = os.path.join(directory, name)
+        if not _alive(int(name[:-5])):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        snapshots.append((name[:-5], {
+            metric: {tuple(key): value for key, value in series} for metric, series in data.items()
+        }))
+    return snapshots
+
+
+def render():
+    """
+    Texto da rota /metrics: as métricas deste processo somadas às dos outros (METRICS_MULTIPROC_DIR).
+    """
+    merged = _snapshot()
+    if settings.METRICS_MULTIPROC_DIR:
+        by_name = {metric.name: metric for metric in _registry}
+        own = str(os.getpid())
+        for metric in _registry:
+            if metric.per_process:
+                merged[metric.name] = {key + (own,): value for key, value in merged[metric.name].items()}
+        for pid, snapshot in _read_other_processes():
+            for name, series in snapshot.items():
+                metric = by_name.get(name)
+                if metric is None:
+                    continue
+                target = merged[name]
+                for key, value in series.items():
+                    if metric.per_process:
+                        target[key + (pid,)] = value
+                    else:
+                        target[key] = metric.merge(target[key], value) if key in target else value
+
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for key, value in sorted(merged[metric.name].items()):
+            lines.extend(metric.lines(key, value))
+    return '\n'.join(lines) + '\n'
+
+
+def flush():
+    """
+    Grava o retrato deste processo em METRICS_MULTIPROC_DIR/<pid>.json (troca atômica do arquivo).
+    """
+    directory = settings.METRICS_MULTIPROC_DIR
+    if not directory:
+        return
+    data = {name: [[list(key), value] for key, value in series.items()] for name, series in _snapshot().items()}
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    try:
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Não foi possível gravar as métricas em {directory}: {e}")
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        flush()
+
+
+def _start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+            _flusher.start()
+            atexit.register(flush)
+
+
+def reset():
+    """
+    Zera todas as métricas deste processo (usado nos testes).
+    """
+    for metric in _registry:
+        metric.clear()
+
+
+def _reset_in_child():
+    # O processo filho começa do zero (senão somaria de novo o que o pai já gravou) e sem a
+    # thread de gravação, que não existe nele.
+    global _flusher, _flusher_lock
+    _flusher = None
+    _flusher_lock = threading.Lock()
+    for metric in _registry:
+        metric._values = {}
+        metric._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_in_child)
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.14 on 2026-10-18 18:57
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_alter_message_channel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(help_text="Tipo da tarefa (ex: 'telegram_update', 'twilio_message').", max_length=50)),
+                ('payload', models.JSONField(help_text='Dados brutos recebidos pelo webhook.')),
+                ('status', models.CharField(choices=[('pending', 'Pendente'), ('running', 'Em execução'), ('done', 'Concluída'), ('failed', 'Falhou')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, help_text='Quantas vezes a tarefa já foi executada.')),
+                ('last_error', models.TextField(blank=True, default='', help_text='Último erro registrado.')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='A partir de quando a tarefa pode ser executada.')),
+                ('locked_at', models.DateTimeField(blank=True, help_text='Quando um worker pegou a tarefa.', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='chatbot_job_claim_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-18 18:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatwootIdentity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')], max_length=20)),
+                ('source_id', models.CharField(help_text='Identificador do usuário no canal (ex: chat_id do Telegram).', max_length=255)),
+                ('contact_id', models.BigIntegerField(help_text='ID do contato no Chatwoot.')),
+                ('conversation_id', models.BigIntegerField(blank=True, help_text='ID da conversa aberta no Chatwoot. Vazio quando a conversa foi resolvida.', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation_id'], name='chatbot_identity_conv_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='chatwootidentity',
+            constraint=models.UniqueConstraint(fields=('channel', 'source_id'), name='chatbot_identity_unique_source'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_chatwootidentity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'conversation_id', 'created_at', 'id'], name='chatbot_msg_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at'], name='chatbot_msg_created_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_message_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')], max_length=20)),
+                ('conversation_id', models.CharField(max_length=255)),
+                ('summary', models.TextField(blank=True, default='', help_text='Resumo das mensagens já compactadas.')),
+                ('summarized_until_id', models.BigIntegerField(default=0, help_text='ID da última Message incluída no resumo.')),
+                ('summarized_count', models.PositiveIntegerField(default=0, help_text='Quantas mensagens já foram resumidas.')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('channel', 'conversation_id'), name='chatbot_summary_unique_conv'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash da versão do prompt + pergunta normalizada (+ contexto).', max_length=64, unique=True)),
+                ('prompt_version', models.CharField(help_text='Hash do prompt de sistema usado na resposta.', max_length=16)),
+                ('question', models.TextField(help_text='Pergunta normalizada (para consulta no admin).')),
+                ('response', models.TextField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='chatbot_cache_lru_idx')],
+            },
+        ),
+    ]
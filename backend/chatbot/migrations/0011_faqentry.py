@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_cachedresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FAQEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question', models.TextField(help_text='Pergunta (ou variação de pergunta) do usuário.')),
+                ('answer', models.TextField(help_text='Resposta enviada quando a pergunta for reconhecida.')),
+                ('source', models.CharField(choices=[('curated', 'Curada'), ('approved', 'Resposta do bot aprovada')], default='curated', max_length=10)),
+                ('active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'FAQ',
+                'verbose_name_plural': 'FAQ',
+            },
+        ),
+    ]
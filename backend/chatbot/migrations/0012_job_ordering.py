@@ -0,0 +1,27 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_faqentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='ordering_key',
+            field=models.CharField(blank=True, default='', help_text="Tarefas com a mesma chave (ex: 'telegram:123') rodam uma de cada vez, na ordem de criação. Vazia = sem ordem.", max_length=255),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='partition',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Partição da chave, usada para dividir a fila entre workers (--shard).'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['ordering_key', 'status'], name='chatbot_job_ordering_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_job_ordering'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMRequestLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Quando o pedido entrou no gateway.')),
+                ('model', models.CharField(max_length=100)),
+                ('purpose', models.CharField(help_text='Finalidade: reply, summary ou chatwoot.', max_length=20)),
+                ('streamed', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('ok', 'Concluída'), ('error', 'Erro'), ('cancelled', 'Cancelada'), ('rejected', 'Recusada (fila cheia)')], max_length=10)),
+                ('http_status', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('prompt_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('completion_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('queue_ms', models.PositiveIntegerField(default=0, help_text='Espera por uma vaga de concorrência.')),
+                ('first_token_ms', models.PositiveIntegerField(blank=True, help_text='Até o primeiro pedaço (streaming).', null=True)),
+                ('latency_ms', models.PositiveIntegerField(default=0, help_text='Da requisição ao fim da resposta.')),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='chatbot_llmlog_created_idx')],
+            },
+        ),
+    ]
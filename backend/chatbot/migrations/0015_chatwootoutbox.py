@@ -0,0 +1,38 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:37
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_webhookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatwootOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')], max_length=20)),
+                ('source_id', models.CharField(help_text='Identificador do usuário no canal (ex: chat_id do Telegram).', max_length=255)),
+                ('inbox_id', models.CharField(help_text='Inbox do Chatwoot do canal.', max_length=20)),
+                ('user_name', models.CharField(blank=True, default='', help_text='Nome usado se o contato ainda não existir.', max_length=255)),
+                ('message_type', models.CharField(choices=[('incoming', 'Recebida'), ('outgoing', 'Enviada')], max_length=10)),
+                ('text', models.TextField()),
+                ('conversation_key', models.CharField(help_text='Registros com a mesma chave são enviados em ordem.', max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pendente'), ('sending', 'Enviando'), ('failed', 'Falhou')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Outbox do Chatwoot',
+                'verbose_name_plural': 'Outbox do Chatwoot',
+                'indexes': [models.Index(fields=['status', 'available_at'], name='chatbot_outbox_claim_idx'), models.Index(fields=['conversation_key', 'status'], name='chatbot_outbox_conv_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.14 on 2026-10-18 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0016_telegrampolloffset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')], max_length=20)),
+                ('conversation_id', models.CharField(help_text='ID da conversa no canal de origem.', max_length=255)),
+                ('status', models.CharField(choices=[('bot', 'Bot'), ('human', 'Atendente humano')], default='bot', help_text="Com 'Atendente humano', o bot registra as mensagens mas não responde.", max_length=10)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('user_message_count', models.PositiveIntegerField(default=0)),
+                ('bot_message_count', models.PositiveIntegerField(default=0)),
+                ('first_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_message_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('last_message_id', models.BigIntegerField(default=0, help_text='ID da Message mais recente.')),
+                ('last_user_message_id', models.BigIntegerField(default=0, help_text='ID da Message mais recente do usuário.')),
+                ('chatwoot_conversation_id', models.BigIntegerField(blank=True, help_text='Conversa aberta no Chatwoot.', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('channel', 'conversation_id'), name='chatbot_conversation_unique'),
+        ),
+    ]
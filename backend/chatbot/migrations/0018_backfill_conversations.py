@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def backfill_conversations(apps, schema_editor):
+    # As conversas anteriores ao agregado não têm linha: sem ela, a primeira mensagem nova criaria a
+    # linha com message_count=1 e o resumo (summarized_count) passaria do total.
+    from chatbot import conversations
+
+    conversations.backfill(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0017_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.14 on 2026-10-18 21:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0018_backfill_conversations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramDeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.CharField(max_length=32)),
+                ('update_id', models.BigIntegerField()),
+                ('payload', models.JSONField()),
+                ('error', models.TextField(blank=True, default='')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Atualização do Telegram descartada',
+                'verbose_name_plural': 'Atualizações do Telegram descartadas',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='telegramdeadletter',
+            constraint=models.UniqueConstraint(fields=('bot_id', 'update_id'), name='chatbot_deadletter_unique'),
+        ),
+    ]
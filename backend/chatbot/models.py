@@ -1,4 +1,7 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.utils import timezone
+
+CHANNEL_CHOICES = [('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')]
 
 class Message(models.Model):
     """
@@ -6,7 +9,7 @@ class Message(models.Model):
     """
     channel = models.CharField(
         max_length=20,
-        choices=[('telegram', 'Telegram'), ('twilio_whatsapp', 'Twilio WhatsApp'), ('chatwoot', 'Chatwoot')],
+        choices=CHANNEL_CHOICES,
         help_text="Canal de origem da mensagem."
     )
     conversation_id = models.CharField(
@@ -21,8 +24,329 @@ class Message(models.Model):
     text = models.TextField(help_text="O conteúdo da mensagem.")
     created_at = models.DateTimeField(auto_now_add=True, help_text="Data e hora de criação.")
 
+    def save(self, *args, **kwargs):
+        # O sinal post_save soma a mensagem ao agregado Conversation: gravação e contadores na mesma
+        # transação, para que o backfill (que trava a linha da conversa) não a conte duas vezes.
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(Message, instance=self)):
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Msg de {self.sender} no canal {self.channel} ({self.conversation_id}) em {self.created_at.strftime('%d/%m %H:%M')}"
 
     class Meta:
-        ordering = ['created_at']
\ No newline at end of file
+        ordering = ['created_at']
+        indexes = [
+            # Histórico de uma conversa: filtro por canal + conversa, ordenado por data (e id para desempate).
+            models.Index(fields=['channel', 'conversation_id', 'created_at', 'id'], name='chatbot_msg_history_idx'),
+            # Listagens gerais (ex: admin), que usam a ordenação padrão por data.
+            models.Index(fields=['created_at'], name='chatbot_msg_created_idx'),
+        ]
+
+class Conversation(models.Model):
+    """
+    Agregado de uma conversa, mantido a cada Message gravada (chatbot/conversations.py): contadores,
+    datas e IDs da última mensagem, a conversa no Chatwoot e quem está atendendo. Quem precisa de
+    fatos da conversa lê esta linha em vez de percorrer o histórico.
+    """
+    STATUS_BOT = 'bot'
+    STATUS_HUMAN = 'human'
+    STATUS_CHOICES = [
+        (STATUS_BOT, 'Bot'),
+        (STATUS_HUMAN, 'Atendente humano'),
+    ]
+
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    conversation_id = models.CharField(max_length=255, help_text="ID da conversa no canal de origem.")
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_BOT,
+        help_text="Com 'Atendente humano', o bot registra as mensagens mas não responde."
+    )
+    message_count = models.PositiveIntegerField(default=0)
+    user_message_count = models.PositiveIntegerField(default=0)
+    bot_message_count = models.PositiveIntegerField(default=0)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_message_id = models.BigIntegerField(default=0, help_text="ID da Message mais recente.")
+    last_user_message_id = models.BigIntegerField(default=0, help_text="ID da Message mais recente do usuário.")
+    chatwoot_conversation_id = models.BigIntegerField(null=True, blank=True, help_text="Conversa aberta no Chatwoot.")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.channel}:{self.conversation_id} ({self.message_count} mensagens)"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'conversation_id'], name='chatbot_conversation_unique'),
+        ]
+
+
+class Job(models.Model):
+    """
+    Tarefa persistida na fila de processamento assíncrono (sem broker externo).
+    Os webhooks gravam a atualização bruta aqui e o comando `run_worker` a processa.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendente'),
+        (STATUS_RUNNING, 'Em execução'),
+        (STATUS_DONE, 'Concluída'),
+        (STATUS_FAILED, 'Falhou'),
+    ]
+
+    kind = models.CharField(max_length=50, help_text="Tipo da tarefa (ex: 'telegram_update', 'twilio_message').")
+    payload = models.JSONField(help_text="Dados brutos recebidos pelo webhook.")
+    ordering_key = models.CharField(
+        max_length=255, blank=True, default='',
+        help_text="Tarefas com a mesma chave (ex: 'telegram:123') rodam uma de cada vez, na ordem de criação. Vazia = sem ordem."
+    )
+    partition = models.PositiveSmallIntegerField(default=0, help_text="Partição da chave, usada para dividir a fila entre workers (--shard).")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Quantas vezes a tarefa já foi executada.")
+    last_error = models.TextField(blank=True, default='', help_text="Último erro registrado.")
+    available_at = models.DateTimeField(default=timezone.now, help_text="A partir de quando a tarefa pode ser executada.")
+    locked_at = models.DateTimeField(null=True, blank=True, help_text="Quando um worker pegou a tarefa.")
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.pk} ({self.kind}) - {self.status}"
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='chatbot_job_claim_idx'),
+            models.Index(fields=['ordering_key', 'status'], name='chatbot_job_ordering_idx'),
+        ]
+
+
+class ChatwootIdentity(models.Model):
+    """
+    Mapeia o usuário de um canal (channel, source_id) para o contato e a conversa
+    correspondentes no Chatwoot, evitando buscas na API a cada mensagem.
+    """
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    source_id = models.CharField(max_length=255, help_text="Identificador do usuário no canal (ex: chat_id do Telegram).")
+    contact_id = models.BigIntegerField(help_text="ID do contato no Chatwoot.")
+    conversation_id = models.BigIntegerField(
+        null=True, blank=True,
+        help_text="ID da conversa aberta no Chatwoot. Vazio quando a conversa foi resolvida."
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.channel}:{self.source_id} -> contato {self.contact_id}, conversa {self.conversation_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'source_id'], name='chatbot_identity_unique_source'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation_id'], name='chatbot_identity_conv_idx'),
+        ]
+
+
+class ConversationSummary(models.Model):
+    """
+    Resumo acumulado das mensagens antigas de uma conversa. O prompt enviado à IA passa a ser
+    prompt de sistema + resumo + mensagens posteriores a 'summarized_until_id'.
+    """
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    conversation_id = models.CharField(max_length=255)
+    summary = models.TextField(blank=True, default='', help_text="Resumo das mensagens já compactadas.")
+    summarized_until_id = models.BigIntegerField(default=0, help_text="ID da última Message incluída no resumo.")
+    summarized_count = models.PositiveIntegerField(default=0, help_text="Quantas mensagens já foram resumidas.")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Resumo de {self.channel}:{self.conversation_id} ({self.summarized_count} mensagens)"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'conversation_id'], name='chatbot_summary_unique_conv'),
+        ]
+
+
+class CachedResponse(models.Model):
+    """
+    Camada compartilhada (entre workers) do cache de respostas da IA para perguntas repetidas.
+    """
+    key = models.CharField(max_length=64, unique=True, help_text="Hash da versão do prompt + pergunta normalizada (+ contexto).")
+    prompt_version = models.CharField(max_length=16, help_text="Hash do prompt de sistema usado na resposta.")
+    question = models.TextField(help_text="Pergunta normalizada (para consulta no admin).")
+    response = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Cache '{self.question[:40]}' ({self.hits} acertos)"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_used_at'], name='chatbot_cache_lru_idx'),
+        ]
+
+
+class LLMRequestLog(models.Model):
+    """
+    Uma tentativa de chamada à IA feita pelo gateway (chatbot/gateway.py): base para medir
+    quantas gerações simultâneas o sistema aguenta e onde o tempo é gasto.
+    """
+    STATUS_CHOICES = [
+        ('ok', 'Concluída'),
+        ('error', 'Erro'),
+        ('cancelled', 'Cancelada'),
+        ('rejected', 'Recusada (fila cheia)'),
+    ]
+
+    created_at = models.DateTimeField(default=timezone.now, help_text="Quando o pedido entrou no gateway.")
+    model = models.CharField(max_length=100)
+    purpose = models.CharField(max_length=20, help_text="Finalidade: reply, summary ou chatwoot.")
+    streamed = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    http_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+    queue_ms = models.PositiveIntegerField(default=0, help_text="Espera por uma vaga de concorrência.")
+    first_token_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Até o primeiro pedaço (streaming).")
+    latency_ms = models.PositiveIntegerField(default=0, help_text="Da requisição ao fim da resposta.")
+    error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f"{self.model} ({self.purpose}) {self.status} em {self.latency_ms} ms"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='chatbot_llmlog_created_idx'),
+        ]
+
+
+class FAQEntry(models.Model):
+    """
+    Pergunta frequente com resposta pronta, usada pelo buscador semântico local
+    (chatbot/faq.py) para responder sem chamar a IA.
+    """
+    SOURCE_CURATED = 'curated'
+    SOURCE_APPROVED = 'approved'
+    SOURCE_CHOICES = [
+        (SOURCE_CURATED, 'Curada'),
+        (SOURCE_APPROVED, 'Resposta do bot aprovada'),
+    ]
+
+    question = models.TextField(help_text="Pergunta (ou variação de pergunta) do usuário.")
+    answer = models.TextField(help_text="Resposta enviada quando a pergunta for reconhecida.")
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default=SOURCE_CURATED)
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.question[:60]
+
+    class Meta:
+        verbose_name = "FAQ"
+        verbose_name_plural = "FAQ"
+
+
+class WebhookDelivery(models.Model):
+    """
+    ID de entrega de um webhook já recebido (update_id do Telegram, MessageSid do Twilio),
+    usado para descartar as reentregas do provedor (chatbot/idempotency.py).
+    """
+    provider = models.CharField(max_length=20)
+    delivery_id = models.CharField(max_length=64)
+    received_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.provider}:{self.delivery_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'delivery_id'], name='chatbot_delivery_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['received_at'], name='chatbot_delivery_received_idx'),
+        ]
+
+
+class ChatwootOutbox(models.Model):
+    """
+    Mensagem a espelhar no Chatwoot, gravada na mesma transação que a Message correspondente
+    e enviada depois pelo relay (chatbot/outbox.py), em ordem dentro de cada conversa.
+    Registros enviados são apagados; os que esgotaram as tentativas ficam como 'failed'.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendente'),
+        (STATUS_SENDING, 'Enviando'),
+        (STATUS_FAILED, 'Falhou'),
+    ]
+
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    source_id = models.CharField(max_length=255, help_text="Identificador do usuário no canal (ex: chat_id do Telegram).")
+    inbox_id = models.CharField(max_length=20, help_text="Inbox do Chatwoot do canal.")
+    user_name = models.CharField(max_length=255, blank=True, default='', help_text="Nome usado se o contato ainda não existir.")
+    message_type = models.CharField(max_length=10, choices=[('incoming', 'Recebida'), ('outgoing', 'Enviada')])
+    text = models.TextField()
+    conversation_key = models.CharField(max_length=255, help_text="Registros com a mesma chave são enviados em ordem.")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Outbox {self.pk} ({self.conversation_key}, {self.message_type}) - {self.status}"
+
+    class Meta:
+        verbose_name = "Outbox do Chatwoot"
+        verbose_name_plural = "Outbox do Chatwoot"
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='chatbot_outbox_claim_idx'),
+            models.Index(fields=['conversation_key', 'status'], name='chatbot_outbox_conv_idx'),
+        ]
+
+
+class TelegramPollOffset(models.Model):
+    """
+    Próximo update_id a pedir ao getUpdates (long polling, `manage.py poll_telegram`), por bot.
+    O Telegram só descarta as atualizações anteriores ao offset na chamada seguinte; guardá-lo no
+    banco permite reiniciar o comando sem perder nem repetir um lote inteiro.
+    """
+    bot_id = models.CharField(max_length=32, unique=True)  # Parte numérica do token (antes do ':')
+    offset = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"bot {self.bot_id}: offset {self.offset}"
+
+
+class TelegramDeadLetter(models.Model):
+    """
+    Atualização do long polling que falhou TELEGRAM_POLL_MAX_ATTEMPTS vezes seguidas: fica aqui
+    (com o payload, para reprocessar ou investigar) e o offset passa por ela, para não travar as
+    atualizações que vêm depois.
+    """
+    bot_id = models.CharField(max_length=32)
+    update_id = models.BigIntegerField()
+    payload = models.JSONField()
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"bot {self.bot_id}: atualização {self.update_id}"
+
+    class Meta:
+        verbose_name = "Atualização do Telegram descartada"
+        verbose_name_plural = "Atualizações do Telegram descartadas"
+        constraints = [
+            models.UniqueConstraint(fields=['bot_id', 'update_id'], name='chatbot_deadletter_unique'),
+        ]
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import threading
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Separa a conversa da "faixa" de ordenação na chave (ex: 'telegram:123#reply').
+LANE_SEPARATOR = '#'
+
+_thread_locks = {}
+_async_locks = {}
+_registry_lock = threading.Lock()
+
+
+def ordering_key(channel, conversation_id, lane=''):
+    """
+    Chave que identifica a conversa para fins de ordenação (tarefas da fila e locks).
+    'lane' cria uma fila de ordenação à parte para a mesma conversa (ex: 'reply', para que as
+    respostas agendadas não segurem a gravação das próximas mensagens).
+    """
+    key = f"{channel}:{conversation_id}"
+    return f"{key}{LANE_SEPARATOR}{lane}" if lane else key
+
+
+def partition_for(key):
+    """
+    Partição fixa (0..JOB_PARTITIONS-1) da conversa da chave. Estável entre processos e
+    reinícios, ao contrário de hash(), que muda a cada execução do Python. A faixa não entra
+    no cálculo: todas as tarefas de uma conversa caem na mesma partição (e no mesmo --shard).
+    """
+    conversation = key.split(LANE_SEPARATOR, 1)[0]
+    return zlib.crc32(conversation.encode()) % settings.JOB_PARTITIONS
+
+
+def shard_partitions(shard):
+    """
+    Converte '--shard i/N' nas partições atendidas pelo worker i de N. As partições são
+    fixas, então mudar N só redistribui partições inteiras: cada conversa continua indo
+    sempre para um único worker.
+    """
+    index, _, total = shard.partition('/')
+    index, total = int(index), int(total)
+    if not 0 <= index < total:
+        raise ValueError(f"Shard inválido: {shard} (use i/N com 0 <= i < N).")
+    return [p for p in range(settings.JOB_PARTITIONS) if p % total == index]
+
+
+@contextmanager
+def conversation_lock(key):
+    """
+    Serializa o processamento de uma conversa quando os webhooks são tratados na hora
+    (sem a fila). No PostgreSQL usa um advisory lock, que vale entre todos os processos;
+    nos outros bancos, um lock local do processo.
+    """
+    if connection.vendor == 'postgresql':
+        lock_id = zlib.crc32(key.encode())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", [lock_id])
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+        return
+
+    with _registry_lock:
+        entry = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        _release(_thread_locks, key, entry)
+
+
+@asynccontextmanager
+async def aconversation_lock(key):
+    """
+    Versão assíncrona de conversation_lock, local ao processo (um asyncio.Lock por conversa).
+    Com mais de um processo uvicorn, use a fila (WEBHOOK_ASYNC_MODE) para garantir a ordem.
+    """
+    registry_key = (asyncio.get_running_loop(), key)
+    with _registry_lock:
+        entry = _async_locks.setdefault(registry_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        _release(_async_locks, registry_key, entry)
+
+
+def _release(registry, key, entry):
+    # Os locks só existem enquanto alguém usa a conversa: o dicionário não cresce sem limite.
+    with _registry_lock:
+        entry[1] -= 1
+        if not entry[1]:
+            del registry[key]
@@ -0,0 +1,394 @@
+"""
+Controle de vazão das mensagens enviadas aos provedores (Telegram, Twilio, Chatwoot).
+
+Cada envio pede passagem com acquire()/aacquire() antes de fazer a chamada HTTP. A passagem
+depende de dois token buckets: o do provedor (ex: ~30 msg/s do Telegram) e, se configurado,
+o do destinatário (ex: 1 msg/s por chat do Telegram). Quem não pode passar espera numa fila
+de prioridade: respostas ao usuário passam na frente de edições intermediárias e espelhamentos.
+Um 429 do provedor bloqueia o bucket pelo tempo pedido (retry_after) e o envio é repetido.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import db, metrics
+from .lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0      # Resposta final ao usuário
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2       # Edições intermediárias de streaming, espelhamento no Chatwoot
+
+# Quantas esperas recentes entram no cálculo do p95 por provedor.
+WAIT_SAMPLES = 1000
+
+
+class Throttled(Exception):
+    """
+    Levantada (ou sinalizada com um status 429) quando o provedor recusa o envio por excesso de
+    mensagens. 'retry_after' é o tempo pedido pelo provedor, em segundos.
+    """
+    def __init__(self, retry_after=None):
+        super().__init__(f"Limite do provedor atingido (retry_after={retry_after}).")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """
+        Segundos até haver uma ficha disponível (0 = pode passar agora).
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # Durante o bloqueio por retry_after as fichas não se acumulam.
+        elapsed = now - max(self.updated, self.blocked_until)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+
+class _Waiter:
+    def __init__(self, provider, recipient, priority, notify):
+        self.provider = provider
+        self.recipient = recipient
+        self.priority = priority
+        self.notify = notify
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundDispatcher:
+    def __init__(self, provider_rates, recipient_rates, max_recipients=10000):
+        self.provider_rates = provider_rates
+        self.recipient_rates = recipient_rates
+        self._providers = {}
+        self._recipients = LRUCache(max_recipients)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats = {}
+
+    # --- Buckets ---
+
+    def _buckets(self, provider, recipient):
+        buckets = []
+        rate = self.provider_rates.get(provider)
+        if rate:
+            if provider not in self._providers:
+                self._providers[provider] = TokenBucket(rate)
+            buckets.append(self._providers[provider])
+        rate = self.recipient_rates.get(provider)
+        if rate and recipient is not None:
+            key = (provider, str(recipient))
+            bucket = self._recipients.get(key)
+            if bucket is None:
+                # Sem rajada por destinatário: o limite do Telegram por chat não tolera picos.
+                bucket = TokenBucket(rate, capacity=1)
+                self._recipients.set(key, bucket)
+            buckets.append(bucket)
+        return buckets
+
+    def _try_take(self, provider, recipient, now):
+        """
+        Consome uma ficha de cada bucket se todos tiverem; senão retorna quanto falta esperar.
+        """
+        buckets = self._buckets(provider, recipient)
+        wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    # --- Fila ---
+
+    def acquire(self, provider, recipient=None, priority=PRIORITY_NORMAL):
+        """
+        Bloqueia até o envio poder ser feito sem estourar os limites do provedor e do destinatário.
+        """
+        event = threading.Event()
+        if self._enqueue(provider, recipient, priority, event.set) is not None:
+            event.wait()
+
+    async def aacquire(self, provider, recipient=None, priority=PRIORITY_NORMAL):
+        """
+        Versão assíncrona de acquire: espera sem bloquear o event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(provider, recipient, priority, notify)
+        if waiter is None:
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+
+    def _enqueue(self, provider, recipient, priority, notify):
+        """
+        Libera na hora se não houver fila e houver fichas; senão entra na fila de prioridade.
+        Retorna o registro de espera, ou None se o chamador já pode enviar.
+        """
+        with self._cond:
+            stats = self._provider_stats(provider)
+            if not self._waiters and self._try_take(provider, recipient, time.monotonic()) <= 0:
+                stats['sent'] += 1
+                stats['waits'].append(0.0)
+                return None
+            waiter = _Waiter(provider, recipient, priority, notify)
+            heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+            self._ensure_thread()
+            self._cond.notify()
+            return waiter
+
+    def _cancel(self, waiter):
+        """
+        Desiste de uma espera (envio cancelado): sai da fila ou, se a passagem já tinha sido
+        liberada, devolve as fichas consumidas para o próximo envio.
+        """
+        with self._cond:
+            remaining = [entry for entry in self._waiters if entry[2] is not waiter]
+            if len(remaining) < len(self._waiters):
+                self._waiters = remaining
+                heapq.heapify(self._waiters)
+                return
+            for bucket in self._buckets(waiter.provider, waiter.recipient):
+                bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+            self._provider_stats(waiter.provider)['sent'] -= 1
+            self._cond.notify()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='outbound-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                timeout = self._dispatch()
+                self._cond.wait(timeout)
+
+    def _dispatch(self):
+        """
+        Percorre a fila em ordem de prioridade liberando quem já tem fichas. Um envio parado
+        pelo limite do seu destinatário não segura os envios para outros destinatários.
+        Retorna quanto tempo dormir até a próxima liberação possível (None = até chegar alguém).
+        """
+        now = time.monotonic()
+        remaining = []
+        next_wake = None
+        for entry in sorted(self._waiters):
+            waiter = entry[2]
+            wait = self._try_take(waiter.provider, waiter.recipient, now)
+            if wait <= 0:
+                stats = self._provider_stats(waiter.provider)
+                stats['sent'] += 1
+                stats['waits'].append(now - waiter.enqueued_at)
+                waiter.notify()
+            else:
+                remaining.append(entry)
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+        self._waiters = remaining
+        heapq.heapify(self._waiters)
+        return next_wake
+
+    # --- Respostas 429 ---
+
+    def throttled(self, provider, recipient=None, retry_after=None):
+        """
+        Registra um 429: bloqueia o bucket do destinatário (ou o do provedor, se o envio não tem
+        destinatário) pelo tempo pedido. Sem retry_after, espera 1 segundo. Retorna quanto o
+        chamador deve esperar por conta própria antes de repetir: 0 se um bucket foi bloqueado
+        (a próxima passagem já espera), ou o retry_after se o provedor não tem limite configurado.
+        """
+        retry_after = retry_after if retry_after is not None else 1.0
+        logger.warning(f"Limite do {provider} atingido (destinatário {recipient}); aguardando {retry_after}s.")
+        with self._cond:
+            self._provider_stats(provider)['throttled'] += 1
+            buckets = self._buckets(provider, recipient)
+            until = time.monotonic() + retry_after
+            if recipient is not None and len(buckets) > 1:
+                buckets[-1].block(until)
+            elif buckets:
+                buckets[0].block(until)
+            else:
+                # Provedor sem limite configurado: os envios passam direto, sem criar estado;
+                # só o envio recusado espera o retry_after.
+                return retry_after
+            self._cond.notify()
+            return 0.0
+
+    # --- Métricas ---
+
+    def _provider_stats(self, provider):
+        if provider not in self._stats:
+            self._stats[provider] = {'sent': 0, 'throttled': 0, 'waits': deque(maxlen=WAIT_SAMPLES)}
+        return self._stats[provider]
+
+    def stats(self):
+        """
+        Por provedor: envios liberados, 429 recebidos, envios esperando agora e o tempo de
+        espera na fila (médio, p95 e máximo das últimas WAIT_SAMPLES liberações, em segundos).
+        """
+        with self._cond:
+            queued = {}
+            for _, _, waiter in self._waiters:
+                queued[waiter.provider] = queued.get(waiter.provider, 0) + 1
+            result = {}
+            for provider, data in self._stats.items():
+                waits = sorted(data['waits'])
+                result[provider] = {
+                    'sent': data['sent'],
+                    'throttled': data['throttled'],
+                    'queued': queued.get(provider, 0),
+                    'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_p95': waits[min(int(len(waits) * 0.95), len(waits) - 1)] if waits else 0.0,
+                    'wait_max': waits[-1] if waits else 0.0,
+                }
+            return result
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OutboundDispatcher(
+                    settings.OUTBOUND_RATE_LIMITS, settings.OUTBOUND_RECIPIENT_RATE_LIMITS
+                )
+    return _dispatcher
+
+
+def reset():
+    """
+    Descarta o dispatcher (e seus buckets e métricas). Usado após um fork e nos testes.
+    """
+    global _dispatcher
+    _dispatcher = None
+
+
+def stats():
+    return get_dispatcher().stats() if _dispatcher is not None else {}
+
+
+def retry_after_seconds(response):
+    """
+    Extrai o tempo de espera de um 429: 'parameters.retry_after' (Telegram) ou o header Retry-After.
+    """
+    try:
+        retry_after = (response.json().get('parameters') or {}).get('retry_after')
+        if retry_after is not None:
+            return float(retry_after)
+    except (ValueError, AttributeError):
+        pass
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _status(response):
+    return getattr(response, 'status_code', None) or 'ok'
+
+
+def send(provider, recipient, call, priority=PRIORITY_NORMAL):
+    """
+    Faz a chamada 'call' (sem argumentos) respeitando os limites do provedor. Se o provedor
+    responder 429 (ou 'call' levantar Throttled), espera o retry_after e tenta de novo, até
+    OUTBOUND_MAX_RETRIES vezes. Retorna o que 'call' retornar.
+    """
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = _send(provider, recipient, call, priority)
+        status = _status(response)
+        return response
+    finally:
+        metrics.OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - started, provider=provider, status=status)
+
+
+def _send(provider, recipient, call, priority):
+    dispatcher = get_dispatcher()
+    for attempt in range(settings.OUTBOUND_MAX_RETRIES + 1):
+        with metrics.OUTBOUND_WAIT_SECONDS.time(provider=provider):
+            dispatcher.acquire(provider, recipient, priority)
+        try:
+            response = call()
+        except Throttled as e:
+            if attempt == settings.OUTBOUND_MAX_RETRIES:
+                raise
+            time.sleep(dispatcher.throttled(provider, recipient, e.retry_after))
+            continue
+        if getattr(response, 'status_code', None) != 429 or attempt == settings.OUTBOUND_MAX_RETRIES:
+            return response
+        time.sleep(dispatcher.throttled(provider, recipient, retry_after_seconds(response)))
+
+
+async def asend(provider, recipient, call, priority=PRIORITY_NORMAL):
+    """
+    Versão assíncrona de send: 'call' é uma função sem argumentos que retorna uma corrotina.
+    A conexão com o banco da requisição é devolvida antes da espera (chatbot/db.py).
+    """
+    await db.arelease_connections()
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = await _asend(provider, recipient, call, priority)
+        status = _status(response)
+        return response
+    finally:
+        metrics.OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - started, provider=provider, status=status)
+
+
+async def _asend(provider, recipient, call, priority):
+    dispatcher = get_dispatcher()
+    for attempt in range(settings.OUTBOUND_MAX_RETRIES + 1):
+        with metrics.OUTBOUND_WAIT_SECONDS.time(provider=provider):
+            await dispatcher.aacquire(provider, recipient, priority)
+        try:
+            response = await call()
+        except Throttled as e:
+            if attempt == settings.OUTBOUND_MAX_RETRIES:
+                raise
+            await asyncio.sleep(dispatcher.throttled(provider, recipient, e.retry_after))
+            continue
+        if getattr(response, 'status_code', None) != 429 or attempt == settings.OUTBOUND_MAX_RETRIES:
+            return response
+        await asyncio.sleep(dispatcher.throttled(provider, recipient, retry_after_seconds(response)))
+
+
+if hasattr(os, 'register_at_fork'):
+    # A thread do dispatcher não sobrevive a um fork; o filho cria o seu.
+    os.register_at_fork(after_in_child=reset)
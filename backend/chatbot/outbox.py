@@ -0,0 +1,222 @@
+"""
+Outbox transacional do espelhamento no Chatwoot.
+
+Com CHATWOOT_OUTBOX_ENABLED, o pipeline não chama o Chatwoot: cada mensagem a espelhar vira um
+registro em chatbot_chatwootoutbox, gravado na mesma transação que a Message (ou os dois ficam
+gravados, ou nenhum). O relay lê a tabela em lotes e faz as chamadas (resolver contato/conversa
+e criar a mensagem), fora do caminho da resposta: com o Chatwoot lento ou fora do ar, o bot
+responde no mesmo tempo e o espelhamento só atrasa.
+
+Ordem: as mensagens de uma conversa são enviadas na ordem em que foram gravadas. Um lote reserva
+o registro mais antigo ainda não enviado de cada conversa (com SELECT ... FOR UPDATE SKIP LOCKED,
+como a fila de tarefas) e, junto com ele, os seguintes da mesma conversa; enquanto estão com o
+relay, nenhum outro processo pega registros dessa conversa. Uma falha devolve o registro (e os
+seguintes) para a fila com backoff exponencial, até CHATWOOT_OUTBOX_MAX_ATTEMPTS tentativas.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, Exists, Min, OuterRef
+from django.utils import timezone
+
+from . import identity
+from .chatwoot_services import ChatwootAPI
+from .models import ChatwootOutbox
+from .ordering import ordering_key
+from .outbound import PRIORITY_LOW
+
+logger = logging.getLogger(__name__)
+
+# Inbox do Chatwoot de cada canal.
+INBOX_SETTINGS = {'telegram': 'TELEGRAM_INBOX_ID', 'twilio_whatsapp': 'TWILIO_INBOX_ID'}
+
+# Espera máxima (segundos) entre as tentativas de um registro.
+MAX_BACKOFF = 300
+
+
+def inbox_for(channel):
+    return getattr(settings, INBOX_SETTINGS.get(channel, ''), None)
+
+
+def record(channel, inbox_id, source_id, user_name, text, message_type):
+    """
+    Grava a mensagem a espelhar. Deve ser chamada dentro da transação que grava a Message.
+    """
+    return ChatwootOutbox.objects.create(
+        channel=channel, source_id=source_id, inbox_id=str(inbox_id), user_name=user_name or '',
+        message_type=message_type, text=text, conversation_key=ordering_key(channel, source_id),
+    )
+
+
+def claim_batch(limit=None):
+    """
+    Reserva os registros pendentes de até 'limit' (CHATWOOT_OUTBOX_BATCH_SIZE) conversas.
+    Retorna {conversation_key: [registros em ordem]}.
+    """
+    limit = limit or settings.CHATWOOT_OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    earlier_unsent = ChatwootOutbox.objects.filter(
+        conversation_key=OuterRef('conversation_key'),
+        status__in=[ChatwootOutbox.STATUS_PENDING, ChatwootOutbox.STATUS_SENDING],
+        id__lt=OuterRef('id'),
+    )
+    heads = ChatwootOutbox.objects.filter(status=ChatwootOutbox.STATUS_PENDING, available_at__lte=now).filter(
+        ~Exists(earlier_unsent)
+    )
+
+    with transaction.atomic():
+        # Quem trava o registro mais antigo de uma conversa fica com a conversa inteira.
+        keys = list(
+            heads.select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('conversation_key', flat=True)[:limit]
+        )
+        if not keys:
+            return {}
+        ids = list(
+            ChatwootOutbox.objects.filter(conversation_key__in=keys, status=ChatwootOutbox.STATUS_PENDING)
+            .values_list('id', flat=True)
+        )
+        ChatwootOutbox.objects.filter(id__in=ids).update(status=ChatwootOutbox.STATUS_SENDING, locked_at=now)
+
+    batches = {}
+    for row in ChatwootOutbox.objects.filter(id__in=ids).order_by('id'):
+        batches.setdefault(row.conversation_key, []).append(row)
+    return batches
+
+
+def _send(chatwoot_api, row):
+    """
+    Espelha um registro no Chatwoot. Retorna None se deu certo, ou a descrição do erro.
+    """
+    conversation_id = identity.resolve_conversation(
+        chatwoot_api, row.channel, row.inbox_id, row.user_name or 'Usuário', row.source_id
+    )
+    if not conversation_id:
+        return "Não foi possível resolver a conversa no Chatwoot."
+    if chatwoot_api.create_message(
+        conversation_id, row.text, message_type=row.message_type, priority=PRIORITY_LOW
+    ) is None:
+        # A conversa pode ter sido apagada; na próxima tentativa é buscada de novo.
+        identity.invalidate_conversation(conversation_id)
+        return f"Falha ao criar a mensagem na conversa {conversation_id}."
+    return None
+
+
+def _failed(row, error):
+    attempts = row.attempts + 1
+    if attempts >= settings.CHATWOOT_OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"Espelhamento {row.pk} ({row.conversation_key}) desistido após {attempts} tentativa(s): {error}")
+        ChatwootOutbox.objects.filter(pk=row.pk).update(
+            status=ChatwootOutbox.STATUS_FAILED, attempts=attempts, last_error=error, locked_at=None
+        )
+        return
+    logger.warning(f"Espelhamento {row.pk} ({row.conversation_key}) falhou (tentativa {attempts}): {error}")
+    ChatwootOutbox.objects.filter(pk=row.pk).update(
+        status=ChatwootOutbox.STATUS_PENDING, attempts=attempts, last_error=error, locked_at=None,
+        available_at=timezone.now() + timedelta(seconds=min(2 ** attempts, MAX_BACKOFF)),
+    )
+
+
+def relay_conversation(chatwoot_api, rows):
+    """
+    Envia os registros de uma conversa, em ordem. Na primeira falha, devolve à fila esse
+    registro (com backoff) e os seguintes. Retorna quantos foram enviados.
+    """
+    for index, row in enumerate(rows):
+        try:
+            error = _send(chatwoot_api, row)
+        except Exception as e:
+            logger.error(f"Erro inesperado ao espelhar o registro {row.pk} no Chatwoot: {e}", exc_info=True)
+            error = str(e) or type(e).__name__
+        if error is None:
+            ChatwootOutbox.objects.filter(pk=row.pk).delete()
+            continue
+        _failed(row, error)
+        ChatwootOutbox.objects.filter(pk__in=[r.pk for r in rows[index + 1:]]).update(
+            status=ChatwootOutbox.STATUS_PENDING, locked_at=None
+        )
+        return index
+    return len(rows)
+
+
+def _relay_in_thread(chatwoot_api, rows):
+    try:
+        return relay_conversation(chatwoot_api, rows)
+    finally:
+        # Cada thread do pool tem sua própria conexão com o banco.
+        connection.close()
+
+
+def relay_once(limit=None):
+    """
+    Reserva e envia um lote; conversas diferentes vão em paralelo (CHATWOOT_OUTBOX_CONCURRENCY).
+    Retorna (enviados, registros reservados).
+    """
+    batches = claim_batch(limit)
+    if not batches:
+        return 0, 0
+    chatwoot_api = ChatwootAPI()
+    claimed = sum(len(rows) for rows in batches.values())
+    concurrency = min(settings.CHATWOOT_OUTBOX_CONCURRENCY, len(batches))
+    if concurrency <= 1:
+        return sum(relay_conversation(chatwoot_api, rows) for rows in batches.values()), claimed
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='outbox') as executor:
+        sent = sum(executor.map(lambda rows: _relay_in_thread(chatwoot_api, rows), batches.values()))
+    return sent, claimed
+
+
+def requeue_stale(timeout=None):
+    """
+    Devolve para a fila registros presos em 'sending' (ex: o relay morreu no meio do lote).
+    """
+    timeout = settings.JOB_LOCK_TIMEOUT if timeout is None else timeout
+    limit = timezone.now() - timedelta(seconds=timeout)
+    count = ChatwootOutbox.objects.filter(status=ChatwootOutbox.STATUS_SENDING, locked_at__lt=limit).update(
+        status=ChatwootOutbox.STATUS_PENDING, locked_at=None
+    )
+    if count:
+        logger.warning(f"{count} espelhamento(s) preso(s) devolvido(s) para o outbox.")
+    return count
+
+
+def run_relay(stopping, poll_interval=None):
+    """
+    Laço do relay (thread do `run_worker` ou `manage.py relay_chatwoot_outbox`): envia lotes
+    enquanto houver registros e espera 'poll_interval' segundos quando o outbox está vazio.
+    """
+    poll_interval = settings.CHATWOOT_OUTBOX_POLL_INTERVAL if poll_interval is None else poll_interval
+    last_requeue = 0
+    try:
+        while not stopping.is_set():
+            close_old_connections()
+            if time.monotonic() - last_requeue >= settings.JOB_LOCK_TIMEOUT / 2:
+                requeue_stale()
+                last_requeue = time.monotonic()
+            try:
+                _, claimed = relay_once()
+            except Exception as e:
+                logger.error(f"Erro no relay do outbox do Chatwoot: {e}", exc_info=True)
+                claimed = 0
+            if not claimed:
+                stopping.wait(poll_interval)
+    finally:
+        connection.close()
+
+
+def stats():
+    """
+    Registros por status e a idade (segundos) do pendente mais antigo: o atraso do espelhamento.
+    """
+    depth = {status: 0 for status, _ in ChatwootOutbox.STATUS_CHOICES}
+    for row in ChatwootOutbox.objects.values('status').annotate(total=Count('id')).order_by():
+        depth[row['status']] = row['total']
+    oldest = ChatwootOutbox.objects.filter(status=ChatwootOutbox.STATUS_PENDING).aggregate(
+        oldest=Min('created_at')
+    )['oldest']
+    depth['oldest_pending_age'] = max((timezone.now() - oldest).total_seconds(), 0) if oldest else 0
+    return depth
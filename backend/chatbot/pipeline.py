@@ -0,0 +1,516 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from telegram_bridge.streaming import adeliver_streaming_reply, deliver_streaming_reply
+
+from . import conversations, faq, identity, jobs, metrics, outbox, response_cache, summarizer, services as chatbot_services
+from .outbound import PRIORITY_LOW
+from .chatwoot_services import ChatwootAPI
+from .context import build_context
+from .models import Conversation, Message
+from .ordering import aconversation_lock, conversation_lock, ordering_key
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyError(Exception):
+    """
+    Falha depois que a mensagem do usuário foi gravada (ao agendar, gerar ou entregar a resposta).
+    Quem recebeu o webhook não deve liberar a reserva do delivery id (idempotency): a reentrega
+    gravaria a mensagem, e o seu registro no outbox, de novo.
+    """
+
+
+def parse_telegram_update(payload):
+    """
+    Extrai (chat_id, texto, nome do usuário) de uma atualização do Telegram.
+    Retorna None se a atualização não contém uma mensagem de texto.
+    """
+    message_data = payload.get('message')
+    if not message_data:
+        return None
+
+    chat_id = message_data.get('chat', {}).get('id')
+    text = message_data.get('text')
+    user_name = message_data.get('from', {}).get('first_name', 'Usuário do Telegram')
+    if not chat_id or not text:
+        return None
+    return str(chat_id), text, user_name
+
+
+def parse_twilio_message(data):
+    """
+    Extrai (source_id, texto, nome do usuário) dos campos enviados pelo webhook do Twilio.
+    Retorna None se 'From' ou 'Body' estiverem ausentes.
+    """
+    source_id = data.get('From')  # Ex: 'whatsapp:+5511999998888'
+    text = data.get('Body')
+    user_name = data.get('ProfileName', 'Usuário do WhatsApp')
+    if not source_id or not text:
+        return None
+    return source_id, text, user_name
+
+
+def process_telegram_update(payload):
+    """
+    Processa uma atualização do Telegram (chamado pela view ou pelo worker).
+    """
+    parsed = parse_telegram_update(payload)
+    if not parsed:
+        logger.info("Atualização do Telegram ignorada: sem chat_id ou texto.")
+        return 'ok_no_chat_id_or_text'
+    chat_id, text, user_name = parsed
+    return handle_incoming_message('telegram', settings.TELEGRAM_INBOX_ID, chat_id, user_name, text)
+
+
+def process_twilio_message(data):
+    """
+    Processa uma mensagem recebida do Twilio (chamado pela view ou pelo worker).
+    """
+    parsed = parse_twilio_message(data)
+    if not parsed:
+        logger.info("Mensagem do Twilio ignorada: 'From' ou 'Body' ausentes.")
+        return 'ok_no_source_id_or_text'
+    source_id, text, user_name = parsed
+    return handle_incoming_message('twilio_whatsapp', settings.TWILIO_INBOX_ID, source_id, user_name, text)
+
+
+async def aprocess_telegram_update(payload):
+    """
+    Versão assíncrona de process_telegram_update (chamada pela view assíncrona).
+    """
+    parsed = parse_telegram_update(payload)
+    if not parsed:
+        logger.info("Atualização do Telegram ignorada: sem chat_id ou texto.")
+        return 'ok_no_chat_id_or_text'
+    chat_id, text, user_name = parsed
+    return await ahandle_incoming_message('telegram', settings.TELEGRAM_INBOX_ID, chat_id, user_name, text)
+
+
+async def aprocess_twilio_message(data):
+    """
+    Versão assíncrona de process_twilio_message (chamada pela view assíncrona).
+    """
+    parsed = parse_twilio_message(data)
+    if not parsed:
+        logger.info("Mensagem do Twilio ignorada: 'From' ou 'Body' ausentes.")
+        return 'ok_no_source_id_or_text'
+    source_id, text, user_name = parsed
+    return await ahandle_incoming_message('twilio_whatsapp', settings.TWILIO_INBOX_ID, source_id, user_name, text)
+
+
+def handle_incoming_message(channel, inbox_id, source_id, user_name, text):
+    """
+    Fluxo completo de uma mensagem recebida: espelha no Chatwoot, registra no banco,
+    gera a resposta da IA, envia ao canal e espelha a resposta no Chatwoot.
+
+    Com AI_COALESCE_WINDOW_MS e WEBHOOK_ASYNC_MODE, a resposta é agendada no worker para o fim da
+    janela e só é gerada se nenhuma mensagem mais nova do usuário chegou nesse meio tempo: mensagens
+    em rajada ("oi" / "tudo bem?" / "quero marcar consulta") viram um único turno, respondido pela
+    última delas. Sem a fila, a janela é ignorada: esperá-la seguraria o worker web a cada mensagem.
+    """
+    status = 'error'
+    try:
+        with metrics.stage(channel, 'turn'):
+            status = _handle_incoming_message(channel, inbox_id, source_id, user_name, text)
+        return status
+    finally:
+        metrics.TURNS.inc(channel=channel, status=status)
+
+
+def _handle_incoming_message(channel, inbox_id, source_id, user_name, text):
+    logger.info(f"Mensagem recebida de {source_id} via {channel}: '{text}'")
+
+    # --- Integração com Chatwoot ---
+    chatwoot_api = ChatwootAPI()
+    conversation_id = None
+    if not inbox_id:
+        logger.error(f"Inbox do Chatwoot não configurado para o canal {channel}.")
+        # Continua sem a integração para não parar o bot
+    elif not settings.CHATWOOT_OUTBOX_ENABLED:
+        if settings.CHATWOOT_CONCURRENT_BOOKKEEPING:
+            # Roda numa thread, em paralelo com a geração da resposta; o resultado (Future)
+            # só é esperado antes de espelhar a resposta do bot.
+            conversation_id = _bookkeeping_executor().submit(
+                _in_thread, chatwoot_bookkeeping, chatwoot_api, channel, inbox_id, user_name, source_id, text
+            )
+        else:
+            conversation_id = chatwoot_bookkeeping(chatwoot_api, channel, inbox_id, user_name, source_id, text)
+
+    try:
+        # --- Lógica do Bot ---
+        # (com o outbox, o espelhamento no Chatwoot é gravado aqui, junto com a mensagem)
+        message = save_message(channel, source_id, 'user', text, inbox_id, user_name)
+        try:
+            window = settings.AI_COALESCE_WINDOW_MS / 1000
+            if window and settings.WEBHOOK_ASYNC_MODE:
+                # No worker, não segura uma thread esperando: agenda a resposta para o fim da janela.
+                # Chave própria para as respostas: não segura a gravação das próximas mensagens.
+                jobs.enqueue('respond_to_message', {
+                    'channel': channel, 'source_id': source_id,
+                    'message_id': message.id, 'chatwoot_conversation_id': _joined(conversation_id),
+                }, delay=window, ordering_key=ordering_key(channel, source_id, lane='reply'))
+                return 'ok_scheduled'
+
+            return respond_to_message(channel, source_id, message.id, conversation_id, chatwoot_api)
+        except Exception as e:
+            raise ReplyError(str(e)) from e
+    finally:
+        # Mesmo quando a resposta foi descartada, o espelhamento desta mensagem termina antes
+        # da próxima da conversa (e o Chatwoot recebe as mensagens em ordem).
+        _joined(conversation_id)
+
+
+def chatwoot_bookkeeping(chatwoot_api, channel, inbox_id, user_name, source_id, text):
+    """
+    Garante que o contato e a conversa existam no Chatwoot (sem chamadas à API se já conhecidos)
+    e registra nela a mensagem do usuário. Retorna o ID da conversa, ou None se falhou.
+    """
+    try:
+        with metrics.stage(channel, 'chatwoot_bookkeeping'):
+            conversation_id = identity.resolve_conversation(chatwoot_api, channel, inbox_id, user_name, source_id)
+            if conversation_id:
+                mirror_to_chatwoot(chatwoot_api, conversation_id, text, 'incoming')
+        return conversation_id
+    except Exception as e:
+        # O Chatwoot não pode derrubar a resposta ao usuário.
+        logger.error(f"Erro ao registrar a mensagem de {channel}:{source_id} no Chatwoot: {e}", exc_info=True)
+        return None
+
+
+async def achatwoot_bookkeeping(chatwoot_api, channel, inbox_id, user_name, source_id, text):
+    """
+    Versão assíncrona de chatwoot_bookkeeping.
+    """
+    try:
+        with metrics.stage(channel, 'chatwoot_bookkeeping'):
+            conversation_id = await identity.aresolve_conversation(chatwoot_api, channel, inbox_id, user_name, source_id)
+            if conversation_id:
+                await amirror_to_chatwoot(chatwoot_api, conversation_id, text, 'incoming')
+        return conversation_id
+    except Exception as e:
+        logger.error(f"Erro ao registrar a mensagem de {channel}:{source_id} no Chatwoot: {e}", exc_info=True)
+        return None
+
+
+def respond_to_message(channel, source_id, message_id, chatwoot_conversation_id=None, chatwoot_api=None):
+    """
+    Gera e entrega a resposta ao turno que termina na mensagem 'message_id' do usuário.
+    Desiste (status 'ok_superseded') se uma mensagem mais nova do usuário chegou antes da
+    geração começar ou antes da resposta ser entregue: quem responde é o handler da mais nova,
+    com todas as mensagens no contexto.
+
+    Roda sob o lock da conversa: duas mensagens da mesma conversa processadas ao mesmo tempo
+    são respondidas uma depois da outra, e a segunda já vê a resposta da primeira no histórico.
+
+    'chatwoot_conversation_id' pode ser o Future do espelhamento em paralelo
+    (CHATWOOT_CONCURRENT_BOOKKEEPING); ele só é esperado antes de espelhar a resposta.
+    """
+    with conversation_lock(ordering_key(channel, source_id)):
+        return _respond_to_message(channel, source_id, message_id, chatwoot_conversation_id, chatwoot_api)
+
+
+def _respond_to_message(channel, source_id, message_id, chatwoot_conversation_id, chatwoot_api):
+    if is_superseded(channel, source_id, message_id):
+        logger.info(f"Resposta a {channel}:{source_id} deixada para a mensagem mais nova do usuário.")
+        return 'ok_superseded'
+    if conversations.is_human_handled(channel, source_id):
+        logger.info(f"Conversa {channel}:{source_id} com atendente humano; o bot não responde.")
+        return 'ok_human_handling'
+
+    with metrics.stage(channel, 'context'):
+        context = build_context(channel, source_id, settings.AI_MEDICAL_PROMPT)
+    with metrics.stage(channel, 'generate'):
+        bot_response_text, delivered = generate_reply(channel, source_id, settings.AI_MEDICAL_PROMPT, context)
+
+    if not bot_response_text or not bot_response_text.strip():
+        logger.warning("A resposta da IA está vazia. Nenhuma mensagem será enviada.")
+        return 'ok_empty_ai_response'
+
+    # Chegou mensagem nova durante a geração: descarta esta resposta (se ainda não foi entregue).
+    if not delivered and is_superseded(channel, source_id, message_id):
+        logger.info(f"Resposta a {channel}:{source_id} descartada: chegou uma mensagem mais nova durante a geração.")
+        return 'ok_superseded'
+
+    save_message(channel, source_id, 'bot', bot_response_text, outbox.inbox_for(channel))
+    if not delivered:
+        with metrics.stage(channel, 'send'):
+            chatbot_services.send_message_to_channel(
+                channel=channel, conversation_id=source_id, text=bot_response_text
+            )
+
+    # --- Registrar resposta do bot no Chatwoot ---
+    with metrics.stage(channel, 'chatwoot_reply'):
+        chatwoot_conversation_id = _joined(chatwoot_conversation_id)
+        if chatwoot_conversation_id:
+            mirror_to_chatwoot(chatwoot_api or ChatwootAPI(), chatwoot_conversation_id, bot_response_text, 'outgoing')
+
+    # --- Compactação do histórico antigo (feita em segundo plano pelo worker) ---
+    summarizer.maybe_schedule_summary(channel, source_id, context.summary)
+
+    return 'ok'
+
+
+def process_scheduled_response(payload):
+    """
+    Tarefa do worker agendada por handle_incoming_message para o fim da janela de AI_COALESCE_WINDOW_MS.
+    """
+    return respond_to_message(
+        payload['channel'], payload['source_id'], payload['message_id'], payload.get('chatwoot_conversation_id')
+    )
+
+
+def is_superseded(channel, conversation_id, message_id):
+    """
+    Indica se o usuário mandou outra mensagem depois de 'message_id' (pelo agregado da conversa).
+    """
+    return Conversation.objects.filter(
+        channel=channel, conversation_id=conversation_id, last_user_message_id__gt=message_id
+    ).exists()
+
+
+async def ahandle_incoming_message(channel, inbox_id, source_id, user_name, text):
+    """
+    Versão assíncrona de handle_incoming_message. As chamadas ao Chatwoot, ao OpenRouter e ao
+    Telegram não bloqueiam o event loop; as etapas que só consultam o banco (contexto, cache,
+    FAQ, resumo) rodam a versão síncrona numa thread.
+    """
+    status = 'error'
+    try:
+        with metrics.stage(channel, 'turn'):
+            status = await _ahandle_incoming_message(channel, inbox_id, source_id, user_name, text)
+        return status
+    finally:
+        metrics.TURNS.inc(channel=channel, status=status)
+
+
+async def _ahandle_incoming_message(channel, inbox_id, source_id, user_name, text):
+    logger.info(f"Mensagem recebida de {source_id} via {channel}: '{text}'")
+
+    chatwoot_api = ChatwootAPI()
+    conversation_id = None
+    if not inbox_id:
+        logger.error(f"Inbox do Chatwoot não configurado para o canal {channel}.")
+    elif not settings.CHATWOOT_OUTBOX_ENABLED:
+        bookkeeping = achatwoot_bookkeeping(chatwoot_api, channel, inbox_id, user_name, source_id, text)
+        if settings.CHATWOOT_CONCURRENT_BOOKKEEPING:
+            conversation_id = asyncio.create_task(bookkeeping)
+        else:
+            conversation_id = await bookkeeping
+
+    try:
+        message = await sync_to_async(save_message)(channel, source_id, 'user', text, inbox_id, user_name)
+        try:
+            window = settings.AI_COALESCE_WINDOW_MS / 1000
+            if window and settings.WEBHOOK_ASYNC_MODE:
+                await sync_to_async(jobs.enqueue)('respond_to_message', {
+                    'channel': channel, 'source_id': source_id,
+                    'message_id': message.id, 'chatwoot_conversation_id': await _ajoined(conversation_id),
+                }, delay=window, ordering_key=ordering_key(channel, source_id, lane='reply'))
+                return 'ok_scheduled'
+
+            return await arespond_to_message(channel, source_id, message.id, conversation_id, chatwoot_api)
+        except Exception as e:
+            raise ReplyError(str(e)) from e
+    finally:
+        await _ajoined(conversation_id)
+
+
+async def _ajoined(conversation_id):
+    """
+    Versão assíncrona de _joined (o espelhamento em paralelo é uma task).
+    """
+    if isinstance(conversation_id, asyncio.Task):
+        return await conversation_id
+    return conversation_id
+
+
+async def arespond_to_message(channel, source_id, message_id, chatwoot_conversation_id=None, chatwoot_api=None):
+    """
+    Versão assíncrona de respond_to_message.
+    """
+    async with aconversation_lock(ordering_key(channel, source_id)):
+        return await _arespond_to_message(channel, source_id, message_id, chatwoot_conversation_id, chatwoot_api)
+
+
+async def _arespond_to_message(channel, source_id, message_id, chatwoot_conversation_id, chatwoot_api):
+    if await ais_superseded(channel, source_id, message_id):
+        logger.info(f"Resposta a {channel}:{source_id} deixada para a mensagem mais nova do usuário.")
+        return 'ok_superseded'
+    if await conversations.ais_human_handled(channel, source_id):
+        logger.info(f"Conversa {channel}:{source_id} com atendente humano; o bot não responde.")
+        return 'ok_human_handling'
+
+    with metrics.stage(channel, 'context'):
+        context = await sync_to_async(build_context)(channel, source_id, settings.AI_MEDICAL_PROMPT)
+    with metrics.stage(channel, 'generate'):
+        bot_response_text, delivered = await agenerate_reply(channel, source_id, settings.AI_MEDICAL_PROMPT, context)
+
+    if not bot_response_text or not bot_response_text.strip():
+        logger.warning("A resposta da IA está vazia. Nenhuma mensagem será enviada.")
+        return 'ok_empty_ai_response'
+
+    if not delivered and await ais_superseded(channel, source_id, message_id):
+        logger.info(f"Resposta a {channel}:{source_id} descartada: chegou uma mensagem mais nova durante a geração.")
+        return 'ok_superseded'
+
+    await sync_to_async(save_message)(channel, source_id, 'bot', bot_response_text, outbox.inbox_for(channel))
+    if not delivered:
+        with metrics.stage(channel, 'send'):
+            await chatbot_services.asend_message_to_channel(
+                channel=channel, conversation_id=source_id, text=bot_response_text
+            )
+
+    with metrics.stage(channel, 'chatwoot_reply'):
+        chatwoot_conversation_id = await _ajoined(chatwoot_conversation_id)
+        if chatwoot_conversation_id:
+            await amirror_to_chatwoot(
+                chatwoot_api or ChatwootAPI(), chatwoot_conversation_id, bot_response_text, 'outgoing'
+            )
+
+    await sync_to_async(summarizer.maybe_schedule_summary)(channel, source_id, context.summary)
+
+    return 'ok'
+
+
+async def ais_superseded(channel, conversation_id, message_id):
+    return await Conversation.objects.filter(
+        channel=channel, conversation_id=conversation_id, last_user_message_id__gt=message_id
+    ).aexists()
+
+
+def generate_reply(channel, source_id, base_prompt, context):
+    """
+    Obtém a resposta do bot: do cache de respostas ou do FAQ, se possível, ou da IA.
+    No Telegram com streaming ativo a resposta da IA já é entregue ao usuário aqui; as do cache e
+    do FAQ, que já estão prontas, seguem pelo envio normal (uma mensagem, sem edições).
+    Retorna (texto, já_entregue).
+    """
+    cached = response_cache.lookup(base_prompt, context.messages)
+    if cached is not None:
+        logger.info(f"Resposta do cache para {channel}:{source_id}.")
+        return cached, False
+
+    faq_answer = faq.match(context.messages)
+    if faq_answer is not None:
+        return faq_answer, False
+
+    streamed = channel == 'telegram' and settings.AI_STREAMING_ENABLED
+    if streamed:
+        # A resposta é entregue ao usuário enquanto é gerada; aqui só recebemos o texto final.
+        stream = chatbot_services.stream_ai_response(context.messages, context.system_prompt)
+        text = deliver_streaming_reply(source_id, stream)
+        ok = stream.ok
+    else:
+        text, ok = chatbot_services.generate_ai_response(context.messages, context.system_prompt)
+
+    if ok:
+        response_cache.store(base_prompt, context.messages, text, context.summary)
+    return text, streamed
+
+
+async def agenerate_reply(channel, source_id, base_prompt, context):
+    """
+    Versão assíncrona de generate_reply.
+    """
+    cached = await sync_to_async(response_cache.lookup)(base_prompt, context.messages)
+    if cached is not None:
+        logger.info(f"Resposta do cache para {channel}:{source_id}.")
+        return cached, False
+
+    faq_answer = await sync_to_async(faq.match)(context.messages)
+    if faq_answer is not None:
+        return faq_answer, False
+
+    streamed = channel == 'telegram' and settings.AI_STREAMING_ENABLED
+    if streamed:
+        stream = chatbot_services.stream_ai_response(context.messages, context.system_prompt)
+        text = await adeliver_streaming_reply(source_id, stream)
+        ok = stream.ok
+    else:
+        text, ok = await chatbot_services.agenerate_ai_response(context.messages, context.system_prompt)
+
+    if ok:
+        await sync_to_async(response_cache.store)(base_prompt, context.messages, text, context.summary)
+    return text, streamed
+
+
+def save_message(channel, source_id, sender, text, inbox_id=None, user_name=''):
+    """
+    Grava a mensagem no histórico e, na mesma transação, atualiza o agregado da conversa (sinal
+    post_save) e, com CHATWOOT_OUTBOX_ENABLED (e o inbox do canal configurado), grava o registro
+    que o relay (chatbot/outbox.py) usa para espelhá-la no Chatwoot.
+    """
+    with metrics.stage(channel, 'save'), transaction.atomic():
+        message = Message.objects.create(conversation_id=source_id, channel=channel, sender=sender, text=text)
+        if settings.CHATWOOT_OUTBOX_ENABLED and inbox_id:
+            outbox.record(channel, inbox_id, source_id, user_name, text, 'incoming' if sender == 'user' else 'outgoing')
+        return message
+
+
+def mirror_to_chatwoot(chatwoot_api, conversation_id, text, message_type):
+    """
+    Registra a mensagem na conversa do Chatwoot. Se a chamada falhar (ex: a conversa
+    foi apagada), remove a conversa do mapa de identidades para que seja buscada de novo.
+    O espelhamento não é visto pelo usuário, então cede a vez a outros envios ao Chatwoot.
+    """
+    if chatwoot_api.create_message(conversation_id, text, message_type=message_type, priority=PRIORITY_LOW) is None:
+        identity.invalidate_conversation(conversation_id)
+
+
+async def amirror_to_chatwoot(chatwoot_api, conversation_id, text, message_type):
+    """
+    Versão assíncrona de mirror_to_chatwoot.
+    """
+    if await chatwoot_api.acreate_message(
+        conversation_id, text, message_type=message_type, priority=PRIORITY_LOW
+    ) is None:
+        await sync_to_async(identity.invalidate_conversation)(conversation_id)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _bookkeeping_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.CHATWOOT_BOOKKEEPING_THREADS, thread_name_prefix='chatwoot'
+                )
+    return _executor
+
+
+def _in_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # A thread do pool abre a própria conexão com o banco (mapa de identidades).
+        connection.close()
+
+
+def _joined(conversation_id):
+    """
+    ID da conversa no Chatwoot, esperando o espelhamento em paralelo terminar, se for o caso.
+    """
+    if isinstance(conversation_id, Future):
+        return conversation_id.result()
+    return conversation_id
+
+
+def _reset_executor_in_child():
+    # As threads do pool não existem no processo filho.
+    global _executor
+    _executor = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_executor_in_child)
@@ -0,0 +1,291 @@
+"""
+Retentativas, circuit breaker e modelos de reserva para as chamadas ao OpenRouter.
+
+Cada modelo da lista (OPENROUTER_MODEL seguido de OPENROUTER_FALLBACK_MODELS) tem o seu
+circuit breaker. Erros transitórios (429, 5xx, timeout, falha de conexão) são repetidos com
+backoff exponencial com jitter; esgotadas as tentativas, ou se o erro não for transitório,
+passa-se ao próximo modelo. Um modelo com AI_BREAKER_FAILURE_THRESHOLD falhas transitórias
+seguidas fica fora por AI_BREAKER_RESET_TIMEOUT segundos: com o OpenRouter fora do ar, as
+chamadas falham na hora em vez de prender os workers esperando o timeout.
+
+O laço de tentativas fica com quem faz a chamada (síncrona, assíncrona ou via SDK da OpenAI):
+
+    plan = RetryPlan()
+    while (attempt := plan.next_attempt()) is not None:
+        try:
+            time.sleep(attempt.delay)
+            ...chamada com attempt.model...
+            plan.failed(attempt, erro, retryable) / plan.succeeded(attempt)
+        finally:
+            plan.release(attempt)  # cancelamento, fila cheia ou erro inesperado: sem resultado
+
+Toda tentativa termina em succeeded, failed ou release: a tentativa que fez o teste do estado
+meio-aberto precisa devolvê-lo, senão o modelo fica fora até o processo reiniciar.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Status HTTP que indicam problema passageiro do provedor.
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Quantas latências recentes entram no cálculo do p95 por modelo.
+LATENCY_SAMPLES = 1000
+
+
+class CircuitBreaker:
+    """
+    Fechado: as chamadas passam. Aberto (após 'threshold' falhas seguidas): recusa tudo por
+    'reset_timeout' segundos. Depois disso fica meio-aberto e deixa passar uma única chamada
+    de teste; se ela der certo o circuito fecha, se falhar volta a abrir.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Retorna False se a chamada deve ser recusada; senão o estado em que ela passou
+        (HALF_OPEN para a chamada de teste, que precisa terminar em record_* ou release).
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == CLOSED:
+                return CLOSED
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return HALF_OPEN
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Circuit breaker aberto após {self.failures} falha(s) seguida(s).")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def release(self):
+        """
+        Devolve a vaga de teste do estado meio-aberto sem registrar resultado (ex: erro que
+        não diz nada sobre a saúde do provedor, como um 400).
+        """
+        with self._lock:
+            self.probing = False
+
+
+class _ModelStats:
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+
+_breakers = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def breaker_for(model):
+    with _lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(
+                settings.AI_BREAKER_FAILURE_THRESHOLD, settings.AI_BREAKER_RESET_TIMEOUT
+            )
+        return _breakers[model]
+
+
+def _model_stats(model):
+    with _lock:
+        return _stats.setdefault(model, _ModelStats())
+
+
+def model_chain():
+    """
+    Modelos a tentar, em ordem: o principal (OPENROUTER_MODEL) e os de reserva.
+    """
+    chain = [settings.OPENROUTER_MODEL]
+    for model in settings.OPENROUTER_FALLBACK_MODELS:
+        if model not in chain:
+            chain.append(model)
+    return chain
+
+
+def backoff_delay(retry):
+    """
+    Espera antes da retentativa número 'retry' (1, 2, ...): "full jitter", um valor aleatório
+    entre 0 e base * 2^(retry-1), limitado a AI_RETRY_MAX_DELAY. O jitter evita que os
+    workers repitam todos ao mesmo tempo e derrubem o provedor de novo.
+    """
+    ceiling = min(settings.AI_RETRY_MAX_DELAY, settings.AI_RETRY_BASE_DELAY * 2 ** (retry - 1))
+    return random.uniform(0, ceiling)
+
+
+class Attempt:
+    def __init__(self, model, delay, probe=False):
+        self.model = model
+        self.delay = delay
+        # Se é a chamada de teste do circuit breaker meio-aberto.
+        self.probe = probe
+        self.resolved = False
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+
+class RetryPlan:
+    """
+    Decide a próxima tentativa (modelo e espera) a partir do resultado das anteriores.
+    'last_error' guarda a descrição da última falha, para a mensagem de erro final.
+    """
+    def __init__(self, models=None):
+        self.models = list(models or model_chain())
+        self.index = 0
+        self.tries = 0          # Tentativas feitas no modelo atual
+        self.retry_after = None
+        self.last_error = None
+
+    def next_attempt(self):
+        while self.index < len(self.models):
+            model = self.models[self.index]
+            if self.tries >= settings.AI_RETRY_ATTEMPTS:
+                self._next_model()
+                continue
+            allowed = breaker_for(model).allow()
+            if not allowed:
+                if self.last_error is None:
+                    self.last_error = f"Circuit breaker aberto para {model}."
+                logger.info(f"Modelo {model} com circuit breaker aberto; pulando.")
+                self._next_model()
+                continue
+            delay = 0.0
+            if self.tries:
+                delay = backoff_delay(self.tries)
+                if self.retry_after is not None:
+                    delay = min(max(delay, self.retry_after), settings.AI_RETRY_MAX_DELAY)
+            self.tries += 1
+            return Attempt(model, delay, probe=allowed == HALF_OPEN)
+        return None
+
+    def _next_model(self):
+        self.index += 1
+        self.tries = 0
+        self.retry_after = None
+
+    def succeeded(self, attempt):
+        attempt.resolved = True
+        breaker_for(attempt.model).record_success()
+        stats = _model_stats(attempt.model)
+        with _lock:
+            stats.successes += 1
+            if attempt.started_at is not None:
+                stats.latencies.append(time.monotonic() - attempt.started_at)
+
+    def failed(self, attempt, error, retryable, retry_after=None):
+        """
+        Registra a falha. Só falhas transitórias contam para o circuit breaker e são repetidas
+        no mesmo modelo; as demais (ex: 400, 404 de modelo inexistente) passam direto ao próximo.
+        """
+        attempt.resolved = True
+        self.last_error = error
+        stats = _model_stats(attempt.model)
+        with _lock:
+            stats.failures += 1
+        breaker = breaker_for(attempt.model)
+        if retryable:
+            breaker.record_failure()
+            self.retry_after = retry_after
+            logger.warning(f"Falha transitória no modelo {attempt.model} (tentativa {self.tries}): {error}")
+        else:
+            if attempt.probe:
+                breaker.release()
+            logger.warning(f"Falha no modelo {attempt.model}: {error}")
+            self._next_model()
+
+    def release(self, attempt):
+        """
+        Encerra uma tentativa que terminou sem resultado (cancelada, recusada pelo limite de
+        gerações simultâneas ou interrompida por um erro inesperado). Se ela era a chamada de
+        teste do circuit breaker, devolve a vaga, para que a próxima chamada teste o modelo.
+        """
+        if attempt.resolved:
+            return
+        attempt.resolved = True
+        if attempt.probe:
+            breaker_for(attempt.model).release()
+
+
+def retry_after_seconds(headers):
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def stats():
+    """
+    Estado do circuit breaker e, por modelo: sucessos, falhas e latência (média e p95) das
+    últimas LATENCY_SAMPLES chamadas bem-sucedidas, em segundos.
+    """
+    with _lock:
+        result = {}
+        for model in set(_breakers) | set(_stats):
+            breaker = _breakers.get(model)
+            data = _stats.get(model) or _ModelStats()
+            latencies = sorted(data.latencies)
+            result[model] = {
+                'breaker': breaker.state if breaker else CLOSED,
+                'successes': data.successes,
+                'failures': data.failures,
+                'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+                'latency_p95': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] if latencies else 0.0,
+            }
+        return result
+
+
+def latency_percentile(model, percentile):
+    """
+    Latência (segundos) no percentil pedido das chamadas recentes bem-sucedidas do modelo,
+    e quantas amostras entraram na conta.
+    """
+    with _lock:
+        data = _stats.get(model)
+        latencies = sorted(data.latencies) if data else []
+    if not latencies:
+        return None, 0
+    return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)], len(latencies)
+
+
+def reset():
+    """
+    Fecha todos os circuit breakers e zera as métricas (usado nos testes).
+    """
+    with _lock:
+        _breakers.clear()
+        _stats.clear()
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from .lru import LRUCache
+from .models import CachedResponse
+
+logger = logging.getLogger(__name__)
+
+_memory = LRUCache(settings.AI_CACHE_MEMORY_SIZE, ttl=settings.AI_CACHE_TTL)
+_counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'skipped': 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def normalize(text):
+    """
+    Normaliza a pergunta para que variações triviais caiam na mesma chave:
+    minúsculas, sem acentos, sem pontuação e com espaços colapsados.
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def prompt_version(system_prompt):
+    return hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+
+
+def is_cacheable(messages):
+    """
+    Decide se o turno pode usar o cache. Ficam de fora turnos que dependem da conversa:
+    a última mensagem não é do usuário, é longa, casa com AI_CACHE_EXCLUDE_PATTERN,
+    ou responde a uma pergunta feita pelo bot (ex: "Qual o seu nome?" -> "Maria").
+    """
+    if not messages or messages[-1].sender != 'user':
+        return False
+    text = messages[-1].text or ''
+    if not text.strip() or len(text) > settings.AI_CACHE_MAX_CHARS:
+        return False
+    if settings.AI_CACHE_EXCLUDE_PATTERN and re.search(settings.AI_CACHE_EXCLUDE_PATTERN, text):
+        return False
+    previous = messages[-2] if len(messages) > 1 else None
+    if previous is not None and previous.sender == 'bot' and previous.text.rstrip().endswith('?'):
+        return False
+    return True
+
+
+def is_standalone(messages, summary=None):
+    """
+    Indica se a resposta gerada para o turno depende só do que entra na chave: sem resumo da
+    conversa e sem mensagens anteriores além das AI_CACHE_CONTEXT_TURNS incluídas na chave.
+    Respostas geradas com o histórico podem citar dados do paciente (nome, exames) e não
+    podem ser servidas a outra conversa.
+    """
+    if summary is not None and summary.summary:
+        return False
+    return len(messages) - 1 <= settings.AI_CACHE_CONTEXT_TURNS
+
+
+def cache_key(system_prompt, messages):
+    """
+    Chave = versão do prompt + pergunta normalizada (+ hash das AI_CACHE_CONTEXT_TURNS mensagens anteriores).
+    """
+    parts = [prompt_version(system_prompt), normalize(messages[-1].text)]
+    turns = settings.AI_CACHE_CONTEXT_TURNS
+    if turns:
+        parts.extend(f"{m.sender}:{normalize(m.text)}" for m in messages[-turns - 1:-1])
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def lookup(system_prompt, messages):
+    """
+    Procura uma resposta pronta para o último turno. Retorna o texto ou None.
+    'system_prompt' deve ser o prompt base (sem o resumo da conversa).
+    """
+    if not settings.AI_CACHE_ENABLED:
+        return None
+    if not is_cacheable(messages):
+        _count('skipped')
+        return None
+
+    key = cache_key(system_prompt, messages)
+    response = _memory.get(key)
+    if response is not None:
+        _count('memory_hits')
+        return response
+
+    entry = CachedResponse.objects.filter(key=key, expires_at__gt=timezone.now()).only('response').first()
+    if entry is None:
+        _count('misses')
+        return None
+
+    CachedResponse.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    _memory.set(key, entry.response)
+    _count('db_hits')
+    logger.info("Resposta encontrada no cache compartilhado.")
+    return entry.response
+
+
+def store(system_prompt, messages, response, summary=None):
+    """
+    Guarda a resposta gerada para o último turno nas duas camadas do cache, se ela foi gerada
+    só a partir do que entra na chave (is_standalone). 'summary' é o resumo usado no contexto.
+    """
+    if not settings.AI_CACHE_ENABLED or not response or not is_cacheable(messages):
+        return
+    if not is_standalone(messages, summary):
+        _count('skipped')
+        return
+
+    key = cache_key(system_prompt, messages)
+    now = timezone.now()
+    defaults = {
+        'prompt_version': prompt_version(system_prompt),
+        'question': normalize(messages[-1].text),
+        'response': response,
+        'last_used_at': now,
+        'expires_at': now + timedelta(seconds=settings.AI_CACHE_TTL),
+    }
+    try:
+        CachedResponse.objects.update_or_create(key=key, defaults=defaults)
+    except IntegrityError:
+        # Outro worker gravou a mesma chave ao mesmo tempo; a resposta dele serve.
+        pass
+    _memory.set(key, response)
+    _count('stores')
+
+
+def prune():
+    """
+    Remove entradas expiradas e, acima de AI_CACHE_DB_MAX_ENTRIES, as menos usadas recentemente.
+    """
+    deleted, _ = CachedResponse.objects.filter(expires_at__lte=timezone.now()).delete()
+    excess = CachedResponse.objects.count() - settings.AI_CACHE_DB_MAX_ENTRIES
+    if excess > 0:
+        oldest = CachedResponse.objects.order_by('last_used_at').values_list('pk', flat=True)[:excess]
+        deleted += CachedResponse.objects.filter(pk__in=list(oldest)).delete()[0]
+    return deleted
+
+
+def clear():
+    _memory.clear()
+    with _counters_lock:
+        for name in _counters:
+            _counters[name] = 0
+
+
+def stats():
+    """
+    Contadores de acertos/erros deste processo e a taxa de acerto.
+    """
+    with _counters_lock:
+        data = dict(_counters)
+    lookups = data['memory_hits'] + data['db_hits'] + data['misses']
+    data['hit_rate'] = (data['memory_hits'] + data['db_hits']) / lookups if lookups else 0.0
+    data['memory_size'] = len(_memory)
+    return data
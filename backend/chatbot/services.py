@@ -1,69 +1,155 @@
-import os
 import logging
-import requests
-import json
+
+from django.conf import settings
+from telegram_bridge.services import asend_telegram_message, send_telegram_message
+from twilio_bridge.services import asend_twilio_whatsapp_message, send_twilio_whatsapp_message
+
+from . import hedging
+from .gateway import AIServiceError, arequest_completion, astream_completion, request_completion, stream_completion
 
 logger = logging.getLogger(__name__)
 
+
+def build_chat_messages(history, system_prompt):
+    """
+    Converte o histórico (objetos com 'sender' e 'text') para o formato de chat da API.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    for msg in history:
+        # Garante que sender seja string
+        sender_role = "assistant" if str(msg.sender) == 'bot' else "user"
+        content = str(msg.text) if msg.text else ""
+        if content:
+            messages.append({"role": sender_role, "content": content})
+    return messages
+
+
+def generate_ai_response(history, system_prompt):
+    """
+    Como get_ai_response, mas retorna (texto, ok): 'ok' é False quando o texto é
+    a mensagem amigável de erro e não uma resposta de verdade (ex: não deve ir para cache).
+    """
+    try:
+        messages = build_chat_messages(history, system_prompt)
+        if settings.AI_HEDGING_ENABLED:
+            return ''.join(hedging.hedged(lambda models: [request_completion(messages, models=models)], messages)), True
+        return request_completion(messages), True
+    except AIServiceError as e:
+        logger.error(str(e))
+        return e.user_message, False
+    except Exception as e:
+        logger.error(f"Erro Crítico no requests: {e}", exc_info=True)
+        return "Erro técnico interno ao processar sua mensagem.", False
+
+
+async def agenerate_ai_response(history, system_prompt):
+    """
+    Versão assíncrona de generate_ai_response.
+    """
+    try:
+        messages = build_chat_messages(history, system_prompt)
+        if settings.AI_HEDGING_ENABLED:
+            chunks = hedging.ahedged(lambda models: hedging.single(arequest_completion(messages, models=models)), messages)
+            return ''.join([chunk async for chunk in chunks]), True
+        return await arequest_completion(messages), True
+    except AIServiceError as e:
+        logger.error(str(e))
+        return e.user_message, False
+    except Exception as e:
+        logger.error(f"Erro Crítico no httpx: {e}", exc_info=True)
+        return "Erro técnico interno ao processar sua mensagem.", False
+
+
 def get_ai_response(history, system_prompt):
     """
     Consome a API do OpenRouter via requests puro para evitar erros de tipagem.
+    Nunca levanta exceção: em caso de falha devolve uma mensagem amigável.
     """
-    try:
-        api_key = os.environ.get('OPENROUTER_API_KEY')
-        # URL fixa do OpenRouter para Chat Completions
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        model = os.environ.get('OPENROUTER_MODEL', 'deepseek/deepseek-chat')
-
-        if not api_key:
-            logger.error("API Key do OpenRouter não configurada.")
-            return "Erro de configuração: Chave da API ausente."
-
-        # Monta as mensagens
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        for msg in history:
-            # Garante que sender seja string
-            sender_role = "assistant" if str(msg.sender) == 'bot' else "user"
-            content = str(msg.text) if msg.text else ""
-            if content:
-                messages.append({"role": sender_role, "content": content})
-
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "http://localhost:8000", # Necessário para OpenRouter
-        }
-
-        payload = {
-            "model": model,
-            "messages": messages,
-            "temperature": 0.7
-        }
-
-        logger.info(f"Enviando request RAW para OpenRouter...")
-        
-        # Chamada direta
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        
-        if response.status_code != 200:
-            logger.error(f"Erro na API da IA: {response.status_code} - {response.text}")
-            return "Desculpe, meu cérebro está temporariamente fora do ar."
-
-        response_json = response.json()
-        
-        # Extração manual e segura do JSON
-        if 'choices' in response_json and len(response_json['choices']) > 0:
-            return response_json['choices'][0]['message']['content']
+    return generate_ai_response(history, system_prompt)[0]
+
+
+class AIResponseStream:
+    """
+    Iterável com os pedaços de uma resposta em streaming (retornado por stream_ai_response).
+    Nunca levanta exceção: se nada foi gerado, produz a mensagem amigável de erro; se o stream
+    cair no meio, encerra com o texto parcial. Depois de consumido, 'ok' indica se a geração
+    terminou normalmente. Com 'async for' usa o cliente HTTP assíncrono.
+    """
+    def __init__(self, history, system_prompt):
+        self.history = history
+        self.system_prompt = system_prompt
+        self.ok = False
+
+    def __iter__(self):
+        produced = False
+        messages = build_chat_messages(self.history, self.system_prompt)
+        if settings.AI_HEDGING_ENABLED:
+            chunks = hedging.hedged(lambda models: stream_completion(messages, models=models), messages)
         else:
-            logger.error(f"Formato inesperado do OpenRouter: {response_json}")
-            return "Recebi uma resposta vazia da IA."
+            chunks = stream_completion(messages)
+        try:
+            for content in chunks:
+                produced = True
+                yield content
+            self.ok = True
+        except AIServiceError as e:
+            logger.error(str(e))
+            if not produced:
+                yield e.user_message
+        except Exception as e:
+            logger.error(f"Erro Crítico no streaming: {e}", exc_info=True)
+            if not produced:
+                yield "Erro técnico interno ao processar sua mensagem."
+
+    async def __aiter__(self):
+        produced = False
+        messages = build_chat_messages(self.history, self.system_prompt)
+        if settings.AI_HEDGING_ENABLED:
+            chunks = hedging.ahedged(lambda models: astream_completion(messages, models=models), messages)
+        else:
+            chunks = astream_completion(messages)
+        try:
+            async for content in chunks:
+                produced = True
+                yield content
+            self.ok = True
+        except AIServiceError as e:
+            logger.error(str(e))
+            if not produced:
+                yield e.user_message
+        except Exception as e:
+            logger.error(f"Erro Crítico no streaming: {e}", exc_info=True)
+            if not produced:
+                yield "Erro técnico interno ao processar sua mensagem."
+
+
+def stream_ai_response(history, system_prompt):
+    """
+    Versão em streaming de get_ai_response.
+    """
+    return AIResponseStream(history, system_prompt)
 
-    except Exception as e:
-        logger.error(f"Erro Crítico no requests: {e}", exc_info=True)
-        return "Erro técnico interno ao processar sua mensagem."
 
-# Mantemos o envio para o Chatwoot aqui também, usando requests
 def send_message_to_channel(channel, conversation_id, text):
-    # (Seu código de envio para canais específicos, se houver)
-    pass
+    """
+    Entrega a resposta do bot ao usuário pelo canal de origem. Retorna o identificador da
+    mensagem enviada (message_id do Telegram, SID do Twilio) ou None se o envio falhou.
+    """
+    if channel == 'telegram':
+        return send_telegram_message(conversation_id, text)
+    if channel == 'twilio_whatsapp':
+        return send_twilio_whatsapp_message(conversation_id, text)
+    logger.error(f"Canal desconhecido para envio: {channel}")
+    return None
+
+
+async def asend_message_to_channel(channel, conversation_id, text):
+    """
+    Versão assíncrona de send_message_to_channel.
+    """
+    if channel == 'telegram':
+        return await asend_telegram_message(conversation_id, text)
+    if channel == 'twilio_whatsapp':
+        return await asend_twilio_whatsapp_message(conversation_id, text)
+    logger.error(f"Canal desconhecido para envio: {channel}")
+    return None
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import conversations, faq, history_cache, metrics
+from .models import FAQEntry, Message
+
+
+@receiver(post_save, sender=FAQEntry)
+@receiver(post_delete, sender=FAQEntry)
+def faq_entry_changed(sender, **kwargs):
+    # O índice do FAQ deste processo é atualizado (incrementalmente) na próxima busca.
+    faq.mark_dirty()
+
+
+@receiver(post_save, sender=Message)
+def message_created(sender, instance, created, **kwargs):
+    # Agregado da conversa (chatbot_conversation), na mesma transação da gravação da mensagem,
+    # e a entrada da conversa no cache do histórico deste processo.
+    if created:
+        conversations.record_message(instance)
+        if settings.HISTORY_CACHE_ENABLED:
+            history_cache.append(instance)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Mede as consultas de cada conexão aberta (chatbot_db_query_seconds), com METRICS_ENABLED.
+    if metrics.db_execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.db_execute_wrapper)
@@ -0,0 +1,256 @@
+"""
+Servidores HTTP locais que imitam as APIs externas, para testes e medições sem rede.
+Cada servidor roda numa thread própria; use como context manager:
+
+    with StubServer(OpenRouterStubHandler, reply="Olá!") as server:
+        settings.OPENROUTER_BASE_URL = server.url
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Cliente que desistiu da resposta (ex: pedido perdedor de um hedge) não é erro do stub.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubServer:
+    """
+    Sobe um ThreadingHTTPServer em 127.0.0.1 numa porta livre. As opções nomeadas
+    ficam em 'server.options' e podem ser lidas pelo handler.
+    """
+    def __init__(self, handler_class, **options):
+        self.handler_class = handler_class
+        self.options = options
+        self.httpd = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.httpd = _QuietHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.options = self.options
+        self.httpd.requests = []
+        self.httpd.deliveries = []
+        self.httpd.counter = itertools.count(1)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def requests(self):
+        """Corpos (JSON) das requisições recebidas, na ordem de chegada."""
+        return self.httpd.requests
+
+    @property
+    def deliveries(self):
+        """
+        (destinatário, time.monotonic()) de cada mensagem entregue ao usuário, nos stubs dos
+        canais: é o fim da medição de latência de ponta a ponta.
+        """
+        return self.httpd.deliveries
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def option(self, name, default=None):
+        return self.server.options.get(name, default)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        self.server.requests.append(data)
+        return data
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def deliver(self, recipient):
+        self.server.deliveries.append((str(recipient), time.monotonic()))
+
+    def next_id(self):
+        return next(self.server.counter)
+
+
+class OpenRouterStubHandler(StubHandler):
+    """
+    Imita POST /chat/completions do OpenRouter, com e sem streaming (SSE).
+    Opções: reply (texto da resposta), latency (segundos até o primeiro byte),
+    chunk_delay (segundos entre pedaços do stream), status (código HTTP),
+    model_status (dict modelo -> código HTTP, para simular a falha de um modelo só),
+    model_latency (dict modelo -> latência, para simular um modelo lento).
+    """
+    def do_POST(self):
+        payload = self.read_json()
+        time.sleep(self.option('model_latency', {}).get(payload.get('model'), self.option('latency', 0)))
+
+        status = self.option('model_status', {}).get(payload.get('model'), self.option('status', 200))
+        if status != 200:
+            self.send_json({'error': {'code': status, 'message': 'Erro simulado'}}, status=status)
+            return
+
+        reply = self.option('reply', 'Olá! Esta é uma resposta do servidor de testes.')
+        model = payload.get('model', 'stub/model')
+        if payload.get('stream'):
+            self.stream_reply(reply, model, (payload.get('stream_options') or {}).get('include_usage'))
+        else:
+            self.send_json({
+                'id': 'stub-completion',
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': {
+                    'prompt_tokens': sum(len(m.get('content', '')) // 4 + 1 for m in payload.get('messages', [])),
+                    'completion_tokens': len(reply) // 4 + 1,
+                },
+            })
+
+    def stream_reply(self, reply, model, include_usage=False):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        self.wfile.write(b': OPENROUTER PROCESSING\n\n')
+        words = reply.split(' ')
+        for i, word in enumerate(words):
+            content = word if i == len(words) - 1 else word + ' '
+            chunk = {'id': 'stub-completion', 'model': model, 'choices': [{'index': 0, 'delta': {'content': content}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.option('chunk_delay', 0))
+        if include_usage:
+            usage = {'prompt_tokens': 10, 'completion_tokens': len(reply) // 4 + 1}
+            self.wfile.write(f"data: {json.dumps({'id': 'stub-completion', 'choices': [], 'usage': usage})}\n\n".encode())
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+
+class TwilioStubHandler(StubHandler):
+    """
+    Imita POST /2010-04-01/Accounts/<sid>/Messages.json do Twilio (corpo em form data).
+    Opções: latency (segundos até a resposta), status (código HTTP).
+    """
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        self.server.requests.append(data)
+        time.sleep(self.option('latency', 0))
+
+        status = self.option('status', 201)
+        if status >= 400:
+            self.send_json({'code': 20000 + status, 'message': 'Erro simulado', 'status': status}, status=status)
+            return
+        self.deliver(data.get('To'))
+        self.send_json({
+            'sid': f"SM{uuid.uuid4().hex}",
+            'from': data.get('From'),
+            'to': data.get('To'),
+            'body': data.get('Body'),
+            'status': 'queued',
+        }, status=status)
+
+
+class TelegramStubHandler(StubHandler):
+    """
+    Imita sendMessage, editMessageText, getUpdates e deleteWebhook da Bot API do Telegram
+    (POST /bot<token>/<método>).
+    Opções: latency (segundos até a resposta); updates (lista de atualizações servidas pelo
+    getUpdates, que espera até o timeout pedido enquanto não houver nenhuma a partir do offset);
+    webhook (True: o getUpdates responde 409 até um deleteWebhook).
+    """
+    def do_POST(self):
+        payload = self.read_json()
+        time.sleep(self.option('latency', 0))
+        method = self.path.rsplit('/', 1)[-1]
+        if method == 'sendMessage':
+            self.deliver(payload.get('chat_id'))
+            self.send_json({'ok': True, 'result': {'message_id': self.next_id(), 'chat': {'id': payload.get('chat_id')}}})
+        elif method == 'editMessageText':
+            self.send_json({'ok': True, 'result': {'message_id': payload.get('message_id')}})
+        elif method == 'getUpdates':
+            self.get_updates(payload)
+        elif method == 'deleteWebhook':
+            self.server.options['webhook'] = False
+            self.send_json({'ok': True, 'result': True})
+        else:
+            self.send_json({'ok': False, 'error_code': 404, 'description': 'Not Found'}, status=404)
+
+    def get_updates(self, payload):
+        if self.option('webhook'):
+            self.send_json({'ok': False, 'error_code': 409, 'description': 'Conflict: webhook is active'}, status=409)
+            return
+        offset = payload.get('offset') or 0
+        deadline = time.monotonic() + (payload.get('timeout') or 0)
+        while True:
+            pending = [u for u in self.option('updates', []) if u['update_id'] >= offset]
+            if pending or time.monotonic() >= deadline:
+                break
+            time.sleep(0.01)
+        self.send_json({'ok': True, 'result': pending[:payload.get('limit') or 100]})
+
+
+class ChatwootStubHandler(StubHandler):
+    """
+    Imita as rotas da API do Chatwoot usadas pelo bot (/api/v1/accounts/<id>/...): busca e criação de
+    contato, conversas do contato, criação de conversa e de mensagem. Todo contato é novo e não tem
+    conversas. Mensagens 'outgoing' contam como entrega ao usuário da conversa.
+    Opções: latency (segundos até a resposta).
+    """
+    def do_GET(self):
+        time.sleep(self.option('latency', 0))
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/contacts/search') or path.endswith('/conversations'):
+            self.send_json({'payload': []})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        payload = self.read_json()
+        time.sleep(self.option('latency', 0))
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/contacts'):
+            self.send_json({'payload': {'id': self.next_id(), 'name': payload.get('name')}})
+        elif path.endswith('/conversations'):
+            self.send_json({'id': self.next_id(), 'inbox_id': payload.get('inbox_id'), 'status': 'open'})
+        elif path.endswith('/messages'):
+            if payload.get('message_type') == 'outgoing':
+                self.deliver(path.split('/conversations/', 1)[1].split('/', 1)[0])
+            self.send_json({'id': self.next_id(), 'content': payload.get('content')})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
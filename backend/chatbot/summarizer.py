@@ -0,0 +1,85 @@
+import logging
+
+from django.conf import settings
+
+from . import jobs
+from .models import Conversation, ConversationSummary, Job, Message
+from .gateway import PURPOSE_SUMMARY, request_completion
+
+logger = logging.getLogger(__name__)
+
+SPEAKERS = {'user': 'Usuário', 'bot': 'Assistente'}
+
+
+def maybe_schedule_summary(channel, conversation_id, summary=None):
+    """
+    Agenda a compactação da conversa quando o número de mensagens ainda não resumidas
+    passa de AI_SUMMARY_THRESHOLD. O trabalho em si é feito pelo worker (`run_worker`).
+    """
+    if not settings.AI_SUMMARY_ENABLED:
+        return False
+
+    # Contador do agregado da conversa, em vez de contar as mensagens a cada turno.
+    summarized = summary.summarized_count if summary else 0
+    total = Conversation.objects.filter(channel=channel, conversation_id=conversation_id).values_list(
+        'message_count', flat=True
+    ).first()
+    if total is None or total < summarized:
+        # Agregado ausente ou atrás do resumo (mensagens gravadas sem o sinal, antes do backfill).
+        total = Message.objects.filter(channel=channel, conversation_id=conversation_id).count()
+    pending = total - summarized
+    if pending <= settings.AI_SUMMARY_THRESHOLD:
+        return False
+
+    already_queued = Job.objects.filter(
+        kind='summarize_conversation', status__in=[Job.STATUS_PENDING, Job.STATUS_RUNNING],
+        payload__channel=channel, payload__conversation_id=conversation_id,
+    ).exists()
+    if not already_queued:
+        jobs.enqueue('summarize_conversation', {'channel': channel, 'conversation_id': conversation_id})
+    return True
+
+
+def summarize_conversation(payload):
+    """
+    Tarefa do worker: incorpora ao resumo as mensagens mais antigas ainda não resumidas,
+    mantendo as AI_SUMMARY_KEEP_RECENT mais recentes fora dele. Processa no máximo
+    AI_SUMMARY_BATCH_SIZE mensagens por vez e se reagenda se ainda houver mais.
+    """
+    channel, conversation_id = payload['channel'], payload['conversation_id']
+    summary, _ = ConversationSummary.objects.get_or_create(channel=channel, conversation_id=conversation_id)
+
+    unsummarized = Message.objects.filter(
+        channel=channel, conversation_id=conversation_id, id__gt=summary.summarized_until_id
+    ).order_by('id')
+    to_compact = unsummarized.count() - settings.AI_SUMMARY_KEEP_RECENT
+    if to_compact <= 0:
+        return
+
+    batch = list(unsummarized.values_list('id', 'sender', 'text')[:min(to_compact, settings.AI_SUMMARY_BATCH_SIZE)])
+    transcript = "\n".join(f"{SPEAKERS.get(sender, sender)}: {text}" for _, sender, text in batch)
+    messages = [
+        {"role": "system", "content": settings.AI_SUMMARY_PROMPT},
+        {"role": "user", "content": (
+            f"Resumo atual:\n{summary.summary or '(vazio)'}\n\n"
+            f"Novas mensagens para incorporar ao resumo:\n{transcript}"
+        )},
+    ]
+    # Em caso de erro a exceção sobe e o worker tenta de novo mais tarde.
+    new_summary = request_completion(messages, temperature=0.2, purpose=PURPOSE_SUMMARY).strip()
+
+    # Atualização otimista: se outro worker já avançou o resumo, descarta este resultado.
+    updated = ConversationSummary.objects.filter(
+        pk=summary.pk, summarized_until_id=summary.summarized_until_id
+    ).update(
+        summary=new_summary,
+        summarized_until_id=batch[-1][0],
+        summarized_count=summary.summarized_count + len(batch),
+    )
+    if not updated:
+        logger.warning(f"Resumo de {channel}:{conversation_id} alterado por outro worker; resultado descartado.")
+        return
+
+    logger.info(f"Resumo de {channel}:{conversation_id} atualizado com mais {len(batch)} mensagem(ns).")
+    if to_compact > len(batch):
+        jobs.enqueue('summarize_conversation', payload)
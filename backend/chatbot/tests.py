@@ -1,7 +1,25 @@
-from django.test import TestCase, override_settings
-from unittest.mock import patch, MagicMock
-from .services import get_ai_response
-from .models import Message
+import asyncio
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.apps import apps as django_apps
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from unittest.mock import AsyncMock, patch, MagicMock
+from . import conversations, db, faq, gateway, hedging, history_cache, http_client, idempotency, identity, jobs, metrics, outbound, outbox, pipeline, resilience, response_cache, summarizer
+from .chatwoot_services import ChatwootAPI
+from .context import Turn, build_context, estimate_tokens
+from .services import AIServiceError, generate_ai_response, get_ai_response, request_completion, stream_ai_response
+from .stub_servers import OpenRouterStubHandler, StubServer
+from .models import CachedResponse, ChatwootIdentity, ChatwootOutbox, Conversation, ConversationSummary, FAQEntry, Job, LLMRequestLog, Message, WebhookDelivery
+from .ordering import ordering_key, shard_partitions
 
 # Helper class to simulate the Message model without hitting the database
 class MockMessage:
@@ -9,25 +27,37 @@ class MockMessage:
         self.sender = sender
         self.text = text
 
-@override_settings(GEMINI_API_KEY="fake-gemini-key-for-testing")
-class GetAIResponseTests(TestCase):
 
-    @patch('chatbot.services.genai')
-    def test_get_ai_response_success(self, mock_genai):
-        """
-        Testa se get_ai_response chama a API do Gemini e retorna o texto com sucesso.
-        """
-        # 1. Arrange: Configura a cadeia de mocks para a API do Gemini
-        mock_response = MagicMock()
-        mock_response.text = 'Esta é uma resposta mockada do Gemini.'
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Servidor HTTP local mínimo com keep-alive, usado para testar o pool de conexões."""
+    protocol_version = 'HTTP/1.1'
 
-        mock_chat = MagicMock()
-        mock_chat.send_message.return_value = mock_response
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
 
-        mock_model = MagicMock()
-        mock_model.start_chat.return_value = mock_chat
+    def log_message(self, format, *args):
+        pass
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+class GetAIResponseTests(TestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
 
-        mock_genai.GenerativeModel.return_value = mock_model
+    @patch('chatbot.gateway.get_session')
+    def test_get_ai_response_success(self, mock_get_session):
+        """
+        Testa se get_ai_response chama a API do OpenRouter pela sessão compartilhada e retorna o texto.
+        """
+        # 1. Arrange: Configura a resposta mockada do OpenRouter
+        mock_response = MagicMock(status_code=200)
+        mock_response.json.return_value = {
+            'choices': [{'message': {'content': 'Esta é uma resposta mockada do OpenRouter.'}}]
+        }
+        mock_get_session.return_value.post.return_value = mock_response
 
         # Cria um histórico de conversa falso
         conversation_history = [
@@ -37,29 +67,1195 @@ class GetAIResponseTests(TestCase):
         ]
 
         # 2. Act: Executa a função que está sendo testada
-        response_text = get_ai_response(conversation_history)
+        response_text = get_ai_response(conversation_history, 'Prompt de sistema')
 
-        # 3. Assert: Verifica se o resultado é o esperado e se os mocks foram chamados
-        self.assertEqual(response_text, "Esta é uma resposta mockada do Gemini.")
-        mock_genai.configure.assert_called_once_with(api_key="fake-gemini-key-for-testing")
-        mock_genai.GenerativeModel.assert_called_once()
-        mock_model.start_chat.assert_called_once()
-        # Verifica se a última mensagem do usuário foi corretamente enviada
-        mock_chat.send_message.assert_called_once_with('Qual o endereço?')
+        # 3. Assert: Verifica se o resultado é o esperado e se o histórico foi enviado
+        self.assertEqual(response_text, "Esta é uma resposta mockada do OpenRouter.")
+        mock_get_session.return_value.post.assert_called_once()
+        payload = mock_get_session.return_value.post.call_args.kwargs['json']
+        self.assertEqual(payload['messages'], [
+            {'role': 'system', 'content': 'Prompt de sistema'},
+            {'role': 'user', 'content': 'Olá!'},
+            {'role': 'assistant', 'content': 'Olá! Como posso ajudar?'},
+            {'role': 'user', 'content': 'Qual o endereço?'},
+        ])
 
-    @patch('chatbot.services.genai.GenerativeModel')
-    def test_get_ai_response_api_error(self, mock_generative_model):
+    @override_settings(AI_RETRY_ATTEMPTS=3, AI_RETRY_BASE_DELAY=0, OPENROUTER_FALLBACK_MODELS=[])
+    @patch('chatbot.gateway.get_session')
+    def test_get_ai_response_api_error(self, mock_get_session):
         """
-        Testa o comportamento de get_ai_response quando a API do Gemini lança uma exceção.
+        Testa o comportamento de get_ai_response quando a API do OpenRouter responde com erro
+        (depois de esgotar as retentativas).
         """
-        # 1. Arrange: Configura o mock para levantar uma exceção
-        mock_generative_model.side_effect = Exception("Erro de conexão simulado com Gemini")
+        # 1. Arrange: Configura o mock para responder com erro 500
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=500, text='Erro simulado', headers={})
 
         conversation_history = [MockMessage(sender='user', text='Isso vai dar erro?')]
 
         # 2. Act: Executa a função
-        response_text = get_ai_response(conversation_history)
+        response_text = get_ai_response(conversation_history, 'Prompt de sistema')
 
         # 3. Assert: Verifica se a mensagem de erro amigável foi retornada
-        expected_error_message = "Desculpe, estou com problemas para me conectar com minha inteligência. Tente novamente mais tarde."
+        expected_error_message = "Desculpe, meu cérebro está temporariamente fora do ar."
         self.assertEqual(response_text, expected_error_message)
+        self.assertEqual(mock_get_session.return_value.post.call_count, 3)
+
+
+class HTTPClientTests(SimpleTestCase):
+
+    def setUp(self):
+        http_client.reset_session()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.reset_session()
+
+    def test_session_reuses_connections(self):
+        """
+        Testa se requisições sequenciais ao mesmo host reaproveitam a mesma conexão.
+        """
+        session = http_client.get_session()
+        for _ in range(3):
+            self.assertEqual(session.get(self.url).status_code, 200)
+
+        self.assertIs(http_client.get_session(), session)
+        stats = http_client.pool_stats()[f"http://127.0.0.1:{self.server.server_address[1]}"]
+        self.assertEqual(stats, {'connections': 1, 'requests': 3, 'reused': 2})
+
+
+class JobQueueTests(TestCase):
+
+    def test_claim_and_run_job_success(self):
+        """
+        Testa se uma tarefa reservada é executada pelo handler registrado e marcada como concluída.
+        """
+        job = jobs.enqueue('telegram_update', {'update_id': 1})
+
+        with patch('chatbot.pipeline.process_telegram_update') as mock_handler:
+            claimed = jobs.claim_jobs(10)
+            self.assertEqual([j.pk for j in claimed], [job.pk])
+            self.assertTrue(jobs.run_job(claimed[0]))
+
+        mock_handler.assert_called_once_with({'update_id': 1})
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(jobs.claim_jobs(10), [])
+
+    @override_settings(JOB_MAX_ATTEMPTS=2)
+    def test_failed_job_is_retried_then_marked_failed(self):
+        """
+        Testa se uma tarefa com erro volta para a fila com backoff e falha após o limite de tentativas.
+        """
+        job = jobs.enqueue('twilio_message', {'From': 'whatsapp:+5511999998888', 'Body': 'Oi'})
+
+        with patch('chatbot.pipeline.process_twilio_message', side_effect=Exception("Falha simulada")):
+            self.assertFalse(jobs.run_job(jobs.claim_jobs(1)[0]))
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.STATUS_PENDING)
+            self.assertGreater(job.available_at, timezone.now())
+
+            Job.objects.filter(pk=job.pk).update(available_at=timezone.now())
+            self.assertFalse(jobs.run_job(jobs.claim_jobs(1)[0]))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertEqual(job.last_error, "Falha simulada")
+
+    def test_queue_depth(self):
+        """
+        Testa a contagem de tarefas por status.
+        """
+        jobs.enqueue('telegram_update', {})
+        jobs.enqueue('telegram_update', {}, delay=60)
+        depth = jobs.queue_depth()
+        self.assertEqual(depth['pending'], 2)
+        self.assertEqual(depth['running'], 0)
+
+    @patch('chatbot.pipeline.process_telegram_update')
+    def test_same_conversation_runs_one_at_a_time_in_order(self, mock_process):
+        """
+        Testa se a segunda mensagem de uma conversa só é reservada depois que a primeira termina,
+        enquanto outras conversas seguem em paralelo.
+        """
+        first = jobs.enqueue('telegram_update', {'n': 1}, ordering_key=ordering_key('telegram', 1))
+        second = jobs.enqueue('telegram_update', {'n': 2}, ordering_key=ordering_key('telegram', 1))
+        other = jobs.enqueue('telegram_update', {'n': 3}, ordering_key=ordering_key('telegram', 2))
+
+        claimed = jobs.claim_jobs(10)
+        self.assertEqual([job.pk for job in claimed], [first.pk, other.pk])
+        self.assertEqual(jobs.claim_jobs(10), [])
+
+        jobs.run_job(claimed[0])
+        self.assertEqual([job.pk for job in jobs.claim_jobs(10)], [second.pk])
+
+    def test_shards_split_conversations(self):
+        keys = [ordering_key('telegram', i) for i in range(20)]
+        for key in keys:
+            jobs.enqueue('telegram_update', {}, ordering_key=key)
+
+        shard_0 = {job.ordering_key for job in jobs.claim_jobs(20, shard_partitions('0/2'))}
+        shard_1 = {job.ordering_key for job in jobs.claim_jobs(20, shard_partitions('1/2'))}
+        self.assertFalse(shard_0 & shard_1)
+        self.assertEqual(shard_0 | shard_1, set(keys))
+        self.assertTrue(shard_0 and shard_1)
+
+    def test_reply_lane_stays_on_the_conversation_shard(self):
+        for i in range(20):
+            message = jobs.enqueue('telegram_update', {}, ordering_key=ordering_key('telegram', i))
+            reply = jobs.enqueue('respond_to_message', {}, ordering_key=ordering_key('telegram', i, lane='reply'))
+            self.assertEqual(reply.partition, message.partition)
+            self.assertNotEqual(reply.ordering_key, message.ordering_key)
+
+
+class IdentityMapTests(TestCase):
+
+    def setUp(self):
+        identity._cache.clear()
+        self.api = MagicMock()
+        self.api.get_or_create_contact.return_value = {'id': 10}
+        self.api.find_or_create_conversation.return_value = {'id': 99}
+
+    def resolve(self):
+        return identity.resolve_conversation(self.api, 'telegram', '3', 'Maria', '123456')
+
+    def test_known_user_makes_no_api_calls(self):
+        """
+        Testa se, depois da primeira resolução, o contato e a conversa vêm do cache/banco sem chamar a API.
+        """
+        self.assertEqual(self.resolve(), 99)
+        self.assertEqual(self.api.get_or_create_contact.call_count, 1)
+
+        self.assertEqual(self.resolve(), 99)
+        identity._cache.clear()
+        self.assertEqual(self.resolve(), 99)
+
+        self.assertEqual(self.api.get_or_create_contact.call_count, 1)
+        self.assertEqual(self.api.find_or_create_conversation.call_count, 1)
+
+    def test_resolved_conversation_is_invalidated(self):
+        """
+        Testa se, após a conversa ser resolvida, a próxima mensagem busca uma nova conversa
+        reaproveitando o contato já conhecido.
+        """
+        self.resolve()
+        identity.invalidate_conversation(99)
+        self.api.find_or_create_conversation.return_value = {'id': 100}
+
+        self.assertEqual(self.resolve(), 100)
+        self.assertEqual(self.api.get_or_create_contact.call_count, 1)
+        self.api.find_or_create_conversation.assert_called_with({'id': 10}, '3', '123456')
+        self.assertEqual(ChatwootIdentity.objects.get().conversation_id, 100)
+
+    @override_settings(CHATWOOT_API_URL='http://chatwoot.local/api/v1/accounts/1', CHATWOOT_ACCESS_TOKEN='token')
+    def test_find_conversation_matches_inbox_id_from_settings(self):
+        """
+        Testa se o inbox_id vindo das configurações (string) casa com o inteiro devolvido pela API.
+        """
+        api = ChatwootAPI()
+        conversations = {'payload': [{'id': 7, 'inbox_id': 3, 'status': 'open'}]}
+        with patch.object(api, '_request', return_value=conversations) as mock_request:
+            self.assertEqual(api.find_or_create_conversation({'id': 10}, '3', '123456'), conversations['payload'][0])
+        mock_request.assert_called_once_with('GET', 'contacts/10/conversations')
+
+    async def test_async_resolution_uses_the_async_api(self):
+        """
+        Na view assíncrona, as chamadas ao Chatwoot não rodam numa thread (segurando a conexão com o banco).
+        """
+        self.api.aget_or_create_contact = AsyncMock(return_value={'id': 10})
+        self.api.afind_or_create_conversation = AsyncMock(return_value={'id': 99})
+
+        self.assertEqual(await identity.aresolve_conversation(self.api, 'telegram', '3', 'Maria', '123456'), 99)
+
+        self.api.get_or_create_contact.assert_not_called()
+        self.api.afind_or_create_conversation.assert_awaited_once_with({'id': 10}, '3', '123456')
+        self.assertEqual((await ChatwootIdentity.objects.aget()).conversation_id, 99)
+
+
+class ContextBuilderTests(TestCase):
+
+    def setUp(self):
+        for i in range(30):
+            Message.objects.create(
+                channel='twilio_whatsapp', conversation_id='whatsapp:+5511999998888',
+                sender='user' if i % 2 == 0 else 'bot', text=f"mensagem {i:02d} " + 'x' * 28,
+            )
+
+    @override_settings(AI_CONTEXT_PAGE_SIZE=5)
+    def test_selects_most_recent_turns_within_budget(self):
+        """
+        Testa se apenas as mensagens mais recentes que cabem no orçamento são buscadas e enviadas.
+        """
+        # Cada mensagem tem 40 caracteres: 11 tokens estimados + 4 de overhead.
+        # 1 consulta para o resumo da conversa + 2 páginas de histórico.
+        with self.assertNumQueries(3):
+            context = build_context('twilio_whatsapp', 'whatsapp:+5511999998888', budget=100)
+
+        self.assertEqual(len(context.messages), 6)
+        self.assertTrue(context.messages[0].text.startswith('mensagem 24'))
+        self.assertTrue(context.messages[-1].text.startswith('mensagem 29'))
+        self.assertEqual(context.tokens, 4 + 6 * 15)
+
+    def test_latest_message_is_always_included(self):
+        context = build_context('twilio_whatsapp', 'whatsapp:+5511999998888', system_prompt='p' * 400, budget=50)
+
+        self.assertEqual(len(context.messages), 1)
+        self.assertTrue(context.messages[0].text.startswith('mensagem 29'))
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(''), 0)
+        self.assertEqual(estimate_tokens('a' * 400), 101)
+
+
+@override_settings(HISTORY_CACHE_ENABLED=True, HISTORY_CACHE_MAX_MESSAGES=10)
+class HistoryCacheTests(TestCase):
+
+    def setUp(self):
+        history_cache.clear()
+        for i in range(6):
+            self.create(f"mensagem {i:02d}")
+
+    def create(self, text, sender='user'):
+        return Message.objects.create(channel='telegram', conversation_id='123456', sender=sender, text=text)
+
+    def test_next_turn_skips_history_query(self):
+        # Resumo + versão da conversa + histórico.
+        with self.assertNumQueries(3):
+            build_context('telegram', '123456')
+        self.create('resposta do bot', sender='bot')
+
+        # A resposta foi acrescentada à entrada: só resumo + versão.
+        with self.assertNumQueries(2):
+            context = build_context('telegram', '123456')
+
+        self.assertEqual([turn.text for turn in context.messages[-2:]], ['mensagem 05', 'resposta do bot'])
+        stats = history_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['appends']), (1, 1, 1))
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_message_written_elsewhere_is_refetched(self):
+        build_context('telegram', '123456')
+        # Gravada por outro processo: o cache deste não vê a mensagem, mas o agregado avança.
+        with patch('chatbot.signals.history_cache.append'):
+            self.create('mensagem de outro worker')
+
+        context = build_context('telegram', '123456')
+
+        self.assertEqual(context.messages[-1].text, 'mensagem de outro worker')
+        self.assertEqual(history_cache.stats()['stale'], 1)
+
+    def test_partial_entry_continues_from_the_database(self):
+        for i in range(6, 15):
+            self.create(f"mensagem {i:02d}")
+
+        for _ in range(2):
+            context = build_context('telegram', '123456')
+            self.assertEqual([turn.text for turn in context.messages], [f"mensagem {i:02d}" for i in range(15)])
+
+    def test_evicts_least_recently_used_by_memory(self):
+        cache = history_cache.HistoryCache(max_bytes=1000, max_messages=10)
+        message = (1, 'user', 'x' * 200)
+        cache.store('a', (1, 1), 0, [message], True)
+        cache.store('b', (1, 1), 0, [message], True)
+        cache.lookup('a', (1, 1), 0)
+        cache.store('c', (1, 1), 0, [message], True)
+
+        self.assertIsNone(cache.lookup('b', (1, 1), 0))
+        self.assertIsNotNone(cache.lookup('a', (1, 1), 0))
+        self.assertLessEqual(cache.size, 1000)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+@override_settings(AI_SUMMARY_ENABLED=True, AI_SUMMARY_THRESHOLD=20, AI_SUMMARY_KEEP_RECENT=5, AI_SUMMARY_BATCH_SIZE=10)
+class SummarizerTests(TestCase):
+
+    def setUp(self):
+        self.messages = [
+            Message.objects.create(
+                channel='telegram', conversation_id='123456',
+                sender='user' if i % 2 == 0 else 'bot', text=f"mensagem {i:02d}",
+            )
+            for i in range(30)
+        ]
+
+    def test_schedules_summary_above_threshold(self):
+        self.assertTrue(summarizer.maybe_schedule_summary('telegram', '123456'))
+        self.assertTrue(summarizer.maybe_schedule_summary('telegram', '123456'))
+        # Não duplica a tarefa enquanto a anterior estiver pendente.
+        self.assertEqual(Job.objects.filter(kind='summarize_conversation').count(), 1)
+
+    def test_missing_aggregate_falls_back_to_counting_messages(self):
+        """
+        Conversa anterior ao agregado, sem backfill: a primeira mensagem nova cria a linha com
+        message_count=1, abaixo do que já foi resumido.
+        """
+        Conversation.objects.all().delete()
+        summary = ConversationSummary.objects.create(channel='telegram', conversation_id='123456', summarized_count=5)
+        Message.objects.create(channel='telegram', conversation_id='123456', sender='user', text='mensagem nova')
+
+        self.assertTrue(summarizer.maybe_schedule_summary('telegram', '123456', summary))
+
+    def test_migration_backfills_existing_conversations(self):
+        Conversation.objects.all().delete()
+        migration = importlib.import_module('chatbot.migrations.0018_backfill_conversations')
+
+        migration.backfill_conversations(django_apps, None)
+
+        self.assertEqual(conversations.get('telegram', '123456').message_count, 30)
+
+    @patch('chatbot.summarizer.request_completion', return_value='O usuário se chama Maria.')
+    def test_summarize_compacts_oldest_messages_in_batches(self, mock_completion):
+        """
+        Testa se as mensagens antigas são incorporadas ao resumo em lotes e se o contexto
+        passa a ser prompt + resumo + mensagens recentes.
+        """
+        summarizer.summarize_conversation({'channel': 'telegram', 'conversation_id': '123456'})
+
+        summary = ConversationSummary.objects.get()
+        self.assertEqual(summary.summarized_until_id, self.messages[9].id)
+        self.assertEqual(summary.summarized_count, 10)
+        self.assertIn('mensagem 09', mock_completion.call_args.args[0][1]['content'])
+        self.assertNotIn('mensagem 10', mock_completion.call_args.args[0][1]['content'])
+        # Ainda restam mensagens antigas: a tarefa se reagenda.
+        self.assertEqual(Job.objects.filter(kind='summarize_conversation').count(), 1)
+
+        context = build_context('telegram', '123456', 'Prompt de sistema')
+        self.assertTrue(context.system_prompt.startswith('Prompt de sistema'))
+        self.assertIn('O usuário se chama Maria.', context.system_prompt)
+        self.assertEqual(context.messages[0].text, 'mensagem 10')
+
+    @patch('chatbot.summarizer.request_completion', side_effect=AIServiceError('Erro 500', 'Desculpe'))
+    def test_failed_summary_keeps_previous_state(self, mock_completion):
+        with self.assertRaises(AIServiceError):
+            summarizer.summarize_conversation({'channel': 'telegram', 'conversation_id': '123456'})
+        self.assertEqual(ConversationSummary.objects.get().summarized_until_id, 0)
+
+
+@override_settings(AI_CACHE_ENABLED=True)
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        response_cache.clear()
+
+    def test_normalized_question_hits_cache(self):
+        """
+        Testa se a mesma pergunta, com variações de acento e pontuação, é respondida pelo cache.
+        """
+        response_cache.store('Prompt', [Turn('user', 'Qual o endereço?')], 'Rua Fictícia, 123.')
+
+        self.assertEqual(response_cache.lookup('Prompt', [Turn('user', 'qual o endereco')]), 'Rua Fictícia, 123.')
+        # Mudou o prompt de sistema: outra versão, outra chave.
+        self.assertIsNone(response_cache.lookup('Prompt novo', [Turn('user', 'Qual o endereço?')]))
+        self.assertEqual(response_cache.stats()['memory_hits'], 1)
+
+    def test_shared_tier_is_used_after_memory_eviction(self):
+        response_cache.store('Prompt', [Turn('user', 'Horário de funcionamento?')], 'Das 08:00 às 18:00.')
+        response_cache._memory.clear()
+
+        self.assertEqual(
+            response_cache.lookup('Prompt', [Turn('user', 'horario de funcionamento')]), 'Das 08:00 às 18:00.'
+        )
+        self.assertEqual(CachedResponse.objects.get().hits, 1)
+        self.assertEqual(response_cache.stats()['db_hits'], 1)
+
+    def test_conversation_dependent_turns_are_skipped(self):
+        answering_bot = [Turn('bot', 'Qual o seu nome completo?'), Turn('user', 'Maria Silva')]
+        with_date = [Turn('user', 'Quero remarcar para 12/05')]
+
+        for messages in (answering_bot, with_date):
+            response_cache.store('Prompt', messages, 'Resposta')
+            self.assertIsNone(response_cache.lookup('Prompt', messages))
+        self.assertFalse(CachedResponse.objects.exists())
+        self.assertEqual(response_cache.stats()['skipped'], 2)
+
+    @patch('chatbot.pipeline.chatbot_services.send_message_to_channel')
+    @patch('chatbot.pipeline.chatbot_services.generate_ai_response')
+    def test_reply_generated_with_history_is_not_shared(self, mock_generate, mock_send):
+        """
+        Duas conversas com históricos diferentes mandam a mesma mensagem: a resposta personalizada
+        da primeira não é servida à segunda.
+        """
+        mock_generate.side_effect = [('Sim, Maria! Seu hemograma está pronto.', True), ('Qual o seu nome?', True)]
+        Message.objects.create(channel='telegram', conversation_id='111', sender='user', text='Sou a Maria')
+        Message.objects.create(channel='telegram', conversation_id='111', sender='bot', text='Olá, Maria.')
+
+        for chat_id in (111, 222):
+            pipeline.process_telegram_update({
+                'update_id': chat_id,
+                'message': {'chat': {'id': chat_id}, 'text': 'Meu exame está pronto', 'from': {'first_name': 'X'}},
+            })
+
+        self.assertEqual(mock_generate.call_count, 2)
+        self.assertEqual(mock_send.call_args.kwargs['text'], 'Qual o seu nome?')
+        # Sem histórico, a resposta da segunda conversa pode ser guardada.
+        self.assertEqual(CachedResponse.objects.get().response, 'Qual o seu nome?')
+
+    def test_reply_with_conversation_summary_is_not_stored(self):
+        summary = ConversationSummary(channel='telegram', conversation_id='111', summary='O paciente se chama João.')
+        response_cache.store('Prompt', [Turn('user', 'Meu exame está pronto')], 'Sim, João.', summary)
+
+        self.assertFalse(CachedResponse.objects.exists())
+
+    @override_settings(AI_CACHE_DB_MAX_ENTRIES=1)
+    def test_prune_evicts_least_recently_used(self):
+        response_cache.store('Prompt', [Turn('user', 'Endereço?')], 'Rua Fictícia, 123.')
+        response_cache.store('Prompt', [Turn('user', 'Especialidades?')], 'Clínica Geral.')
+        CachedResponse.objects.filter(question='endereco').update(last_used_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(response_cache.prune(), 1)
+        self.assertEqual(CachedResponse.objects.get().question, 'especialidades')
+
+
+@override_settings(FAQ_MATCHER_ENABLED=True, FAQ_SIMILARITY_THRESHOLD=0.6)
+class FAQMatcherTests(TestCase):
+
+    def setUp(self):
+        faq.reset()
+        FAQEntry.objects.create(question='Qual o horário de funcionamento da clínica?', answer='Das 08:00 às 18:00.')
+        FAQEntry.objects.create(question='Quais convênios vocês aceitam?', answer='Unimed e Bradesco Saúde.')
+        FAQEntry.objects.create(question='Onde fica o estacionamento?', answer='No subsolo do prédio.')
+
+    def test_paraphrase_matches(self):
+        """
+        Testa se uma paráfrase da pergunta (sem acento, palavras a mais) é respondida pelo FAQ.
+        """
+        self.assertEqual(faq.match([Turn('user', 'qual horario de funcionamento?')]), 'Das 08:00 às 18:00.')
+        self.assertEqual(faq.match([Turn('user', 'vcs aceitam quais convenios')]), 'Unimed e Bradesco Saúde.')
+
+    def test_unrelated_question_misses(self):
+        self.assertIsNone(faq.match([Turn('user', 'Estou com dor de cabeça há três dias')]))
+        # Resposta a uma pergunta do bot depende da conversa: nunca vai para o FAQ.
+        self.assertIsNone(faq.match([Turn('bot', 'Qual convênio?'), Turn('user', 'Quais convênios vocês aceitam?')]))
+
+    def test_index_follows_saves_and_deactivations(self):
+        self.assertIsNone(faq.match([Turn('user', 'Vocês fazem exame de sangue?')]))
+
+        entry = FAQEntry.objects.create(question='Vocês fazem exame de sangue?', answer='Sim, com agendamento.')
+        self.assertEqual(faq.match([Turn('user', 'voces fazem exame de sangue')]), 'Sim, com agendamento.')
+
+        entry.active = False
+        entry.save()
+        self.assertIsNone(faq.match([Turn('user', 'voces fazem exame de sangue')]))
+
+    @override_settings(FAQ_MATCHER_ENABLED=False)
+    def test_disabled(self):
+        self.assertIsNone(faq.match([Turn('user', 'Qual o horário de funcionamento da clínica?')]))
+
+
+@override_settings(AI_COALESCE_WINDOW_MS=1500, WEBHOOK_ASYNC_MODE=True, TWILIO_INBOX_ID=None)
+class BurstCoalescingTests(TestCase):
+
+    def receive(self, text):
+        return pipeline.process_twilio_message({'From': 'whatsapp:+5511999998888', 'Body': text})
+
+    def run_scheduled(self):
+        return [
+            pipeline.process_scheduled_response(job.payload)
+            for job in Job.objects.filter(kind='respond_to_message').order_by('id')
+        ]
+
+    @patch('chatbot.pipeline.chatbot_services.generate_ai_response', return_value=('Claro! Qual o seu nome?', True))
+    def test_burst_becomes_a_single_turn(self, mock_generate):
+        """
+        Três mensagens em rajada geram uma única chamada à IA, com as três no contexto.
+        """
+        for text in ('Oi', 'tudo bem?', 'quero marcar consulta'):
+            self.assertEqual(self.receive(text), 'ok_scheduled')
+
+        self.assertEqual(self.run_scheduled(), ['ok_superseded', 'ok_superseded', 'ok'])
+        mock_generate.assert_called_once()
+        history = mock_generate.call_args.args[0]
+        self.assertEqual([t.text for t in history], ['Oi', 'tudo bem?', 'quero marcar consulta'])
+        self.assertEqual(Message.objects.filter(sender='bot').count(), 1)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=False)
+    @patch('chatbot.pipeline.chatbot_services.generate_ai_response', return_value=('Olá!', True))
+    def test_inline_mode_does_not_wait_for_the_window(self, mock_generate):
+        start = time.monotonic()
+
+        self.assertEqual(self.receive('Oi'), 'ok')
+
+        self.assertLess(time.monotonic() - start, 1.0)
+        mock_generate.assert_called_once()
+        self.assertFalse(Job.objects.exists())
+
+    def test_reply_is_discarded_when_a_newer_message_arrives_during_generation(self):
+        self.receive('Quero remarcar')
+
+        def generate(history, system_prompt):
+            # O usuário manda outra mensagem enquanto a IA ainda está gerando.
+            Message.objects.create(channel='twilio_whatsapp', conversation_id='whatsapp:+5511999998888',
+                                   sender='user', text='para sexta')
+            return 'Para qual data?', True
+
+        with patch('chatbot.pipeline.chatbot_services.generate_ai_response', side_effect=generate):
+            self.assertEqual(self.run_scheduled(), ['ok_superseded'])
+        self.assertFalse(Message.objects.filter(sender='bot').exists())
+
+
+class ConversationAggregateTests(TestCase):
+
+    def create(self, sender, conversation_id='123456'):
+        return Message.objects.create(channel='telegram', conversation_id=conversation_id, sender=sender, text='oi')
+
+    def test_counters_follow_each_message(self):
+        first = self.create('user')
+        last_user = self.create('user')
+        last = self.create('bot')
+        self.create('user', conversation_id='999')
+
+        conversation = conversations.get('telegram', '123456')
+        self.assertEqual(
+            (conversation.message_count, conversation.user_message_count, conversation.bot_message_count), (3, 2, 1)
+        )
+        self.assertEqual(conversation.first_message_at, first.created_at)
+        self.assertEqual((conversation.last_message_id, conversation.last_user_message_id), (last.id, last_user.id))
+        self.assertTrue(pipeline.is_superseded('telegram', '123456', first.id))
+        self.assertFalse(pipeline.is_superseded('telegram', '123456', last_user.id))
+
+    def test_backfill_rebuilds_counts_and_keeps_status(self):
+        for sender in ('user', 'bot', 'user'):
+            self.create(sender)
+        Conversation.objects.filter(conversation_id='123456').update(status=Conversation.STATUS_HUMAN, message_count=0)
+        # bulk_create não dispara o sinal: só o backfill enxerga essas mensagens.
+        Message.objects.bulk_create([Message(channel='telegram', conversation_id='777', sender='user', text='oi')])
+
+        self.assertEqual(conversations.backfill(batch_size=1), 2)
+
+        conversation = conversations.get('telegram', '123456')
+        self.assertEqual((conversation.message_count, conversation.status), (3, Conversation.STATUS_HUMAN))
+        self.assertEqual(conversations.get('telegram', '777').user_message_count, 1)
+
+        # Depois do backfill, as novas mensagens continuam somando a partir do recálculo.
+        self.create('bot', conversation_id='777')
+        self.assertEqual(conversations.get('telegram', '777').message_count, 2)
+
+    def test_chatwoot_conversation_set_before_the_first_message_is_kept(self):
+        """
+        Com CHATWOOT_CONCURRENT_BOOKKEEPING, a conversa no Chatwoot pode ser aberta antes de a primeira
+        mensagem criar a linha do agregado.
+        """
+        conversations.set_chatwoot_conversation('telegram', '123456', 42)
+        message = self.create('user')
+
+        conversation = conversations.get('telegram', '123456')
+        self.assertEqual(conversation.chatwoot_conversation_id, 42)
+        self.assertEqual((conversation.message_count, conversation.user_message_count), (1, 1))
+        self.assertEqual((conversation.first_message_at, conversation.last_message_at), (message.created_at,) * 2)
+
+    def test_message_and_counters_are_saved_together(self):
+        """
+        O backfill trava a linha da conversa e conta as mensagens confirmadas: a mensagem e o seu
+        incremento precisam ser confirmados juntos, senão ela seria contada duas vezes.
+        """
+        with patch('chatbot.conversations.record_message', side_effect=RuntimeError('falhou')):
+            with self.assertRaises(RuntimeError):
+                self.create('user')
+        self.assertFalse(Message.objects.exists())
+
+    @patch('chatbot.pipeline.chatbot_services.generate_ai_response')
+    def test_human_handled_conversation_gets_no_reply(self, mock_generate):
+        self.create('user')
+        Conversation.objects.update(status=Conversation.STATUS_HUMAN)
+
+        status = pipeline.process_telegram_update(
+            {'update_id': 1, 'message': {'chat': {'id': 123456}, 'text': 'Alguém aí?', 'from': {'first_name': 'Ana'}}}
+        )
+
+        self.assertEqual(status, 'ok_human_handling')
+        mock_generate.assert_not_called()
+        self.assertEqual(conversations.get('telegram', '123456').user_message_count, 2)
+
+
+@override_settings(
+    OUTBOUND_RATE_LIMITS={'telegram': 30}, OUTBOUND_RECIPIENT_RATE_LIMITS={'telegram': 10}, OUTBOUND_MAX_RETRIES=3
+)
+class OutboundDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        outbound.reset()
+        self.addCleanup(outbound.reset)
+
+    def test_recipient_limit_does_not_hold_other_chats(self):
+        """
+        O segundo envio ao mesmo chat espera a ficha do chat; o envio a outro chat passa na hora.
+        """
+        dispatcher = outbound.get_dispatcher()
+        dispatcher.acquire('telegram', 'chat-a')
+
+        start = time.monotonic()
+        dispatcher.acquire('telegram', 'chat-b')
+        self.assertLess(time.monotonic() - start, 0.05)
+
+        dispatcher.acquire('telegram', 'chat-a')
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+        self.assertEqual(outbound.stats()['telegram']['sent'], 3)
+
+    def test_higher_priority_is_released_first(self):
+        dispatcher = outbound.OutboundDispatcher({'telegram': 30}, {})
+        dispatcher.throttled('telegram', retry_after=0.1)
+        order = []
+
+        async def send(name, priority):
+            await dispatcher.aacquire('telegram', priority=priority)
+            order.append(name)
+
+        async def scenario():
+            low = asyncio.create_task(send('low', outbound.PRIORITY_LOW))
+            await asyncio.sleep(0.01)
+            await asyncio.gather(low, send('high', outbound.PRIORITY_HIGH))
+
+        asyncio.run(scenario())
+
+        self.assertEqual(order, ['high', 'low'])
+        stats = dispatcher.stats()['telegram']
+        self.assertEqual((stats['sent'], stats['queued'], stats['throttled']), (2, 0, 1))
+        self.assertGreater(stats['wait_max'], 0.05)
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        dispatcher = outbound.OutboundDispatcher({'telegram': 1}, {})
+        dispatcher.acquire('telegram')
+
+        async def scenario():
+            waiting = asyncio.create_task(dispatcher.aacquire('telegram'))
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        asyncio.run(scenario())
+
+        stats = dispatcher.stats()['telegram']
+        self.assertEqual((stats['sent'], stats['queued']), (1, 0))
+
+    def test_429_from_unconfigured_provider_keeps_it_unthrottled(self):
+        dispatcher = outbound.OutboundDispatcher({}, {})
+
+        self.assertEqual(dispatcher.throttled('chatwoot', retry_after=0.2), 0.2)
+
+        self.assertEqual(dispatcher.provider_rates, {})
+        start = time.monotonic()
+        dispatcher.acquire('chatwoot')
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    @override_settings(OUTBOUND_RATE_LIMITS={'chatwoot': 5})
+    @patch('chatbot.views.get_session')
+    def test_chatwoot_webhook_reply_goes_through_the_limiter(self, mock_get_session):
+        from .views import enviar_para_chatwoot
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=200)
+
+        enviar_para_chatwoot(42, 'Olá!')
+
+        mock_get_session.return_value.post.assert_called_once()
+        self.assertEqual(outbound.stats()['chatwoot']['sent'], 1)
+
+    @patch('chatbot.views.get_async_client')
+    async def test_async_chatwoot_reply_failure_is_logged(self, mock_get_client):
+        from .views import aenviar_para_chatwoot
+        mock_get_client.return_value.post = AsyncMock(return_value=MagicMock(status_code=404, text='{"error": "x"}'))
+
+        with self.assertLogs('chatbot.views', level='ERROR') as logs:
+            await aenviar_para_chatwoot(42, 'Olá!')
+
+        self.assertEqual(logs.output, [
+            "ERROR:chatbot.views:Erro ao enviar a resposta para a conversa 42 do Chatwoot: HTTP 404"
+        ])
+
+    def test_429_waits_retry_after_and_resends(self):
+        throttled = MagicMock(status_code=429)
+        throttled.json.return_value = {'ok': False, 'parameters': {'retry_after': 0.1}}
+        call = MagicMock(side_effect=[throttled, MagicMock(status_code=200)])
+
+        start = time.monotonic()
+        response = outbound.send('telegram', 'chat-a', call)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(call.call_count, 2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(outbound.stats()['telegram']['throttled'], 1)
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(
+    OPENROUTER_MODEL='primary/model', OPENROUTER_FALLBACK_MODELS=['backup/model'],
+    AI_RETRY_ATTEMPTS=2, AI_RETRY_BASE_DELAY=0,
+    AI_BREAKER_FAILURE_THRESHOLD=2, AI_BREAKER_RESET_TIMEOUT=60, AI_REQUEST_LOG_ENABLED=False,
+)
+class ResilienceTests(SimpleTestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        self.stub = StubServer(OpenRouterStubHandler, reply='Resposta').start()
+        self.addCleanup(self.stub.stop)
+        self.settings_override = override_settings(OPENROUTER_BASE_URL=self.stub.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def models_requested(self):
+        return [request['model'] for request in self.stub.requests]
+
+    def test_transient_errors_are_retried_then_fall_back(self):
+        self.stub.httpd.options['model_status'] = {'primary/model': 503}
+
+        self.assertEqual(request_completion([{'role': 'user', 'content': 'Oi'}]), 'Resposta')
+
+        self.assertEqual(self.models_requested(), ['primary/model', 'primary/model', 'backup/model'])
+        stats = resilience.stats()
+        self.assertEqual((stats['primary/model']['failures'], stats['backup/model']['successes']), (2, 1))
+
+    def test_open_breaker_fails_fast(self):
+        """
+        Com o provedor fora do ar, depois de abrir o circuito as chamadas falham sem ir à rede.
+        """
+        self.stub.httpd.options['status'] = 503
+
+        for _ in range(2):
+            with self.assertRaises(AIServiceError):
+                request_completion([{'role': 'user', 'content': 'Oi'}])
+
+        self.assertEqual(len(self.stub.requests), 4)
+        self.assertEqual({s['breaker'] for s in resilience.stats().values()}, {resilience.OPEN})
+
+    def test_client_error_is_not_retried(self):
+        self.stub.httpd.options['model_status'] = {'primary/model': 400}
+
+        self.assertEqual(request_completion([{'role': 'user', 'content': 'Oi'}]), 'Resposta')
+
+        self.assertEqual(self.models_requested(), ['primary/model', 'backup/model'])
+        self.assertEqual(resilience.stats()['primary/model']['breaker'], resilience.CLOSED)
+
+    def half_open(self, model):
+        breaker = resilience.breaker_for(model)
+        breaker.state, breaker.opened_at = resilience.OPEN, time.monotonic() - 120
+        return breaker
+
+    def test_cancelled_probe_is_released(self):
+        """
+        A chamada de teste do circuito meio-aberto é cancelada no meio: a vaga de teste volta
+        e a próxima chamada testa (e fecha) o circuito.
+        """
+        self.stub.httpd.options['model_latency'] = {'primary/model': 1}
+        breaker = self.half_open('primary/model')
+
+        async def cancel_in_flight():
+            task = asyncio.create_task(gateway.arequest_completion([{'role': 'user', 'content': 'Oi'}]))
+            while not self.stub.requests:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_in_flight())
+
+        self.assertEqual((breaker.state, breaker.probing), (resilience.HALF_OPEN, False))
+        self.stub.httpd.options['model_latency'] = {}
+        self.assertEqual(request_completion([{'role': 'user', 'content': 'Oi'}]), 'Resposta')
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    @override_settings(AI_MAX_CONCURRENCY=1, AI_QUEUE_MAX_WAITING=0)
+    def test_probe_rejected_by_concurrency_limit_is_released(self):
+        gateway.reset()
+        self.addCleanup(gateway.reset)
+        breaker = self.half_open('primary/model')
+        busy = gateway._limiters_for('primary/model')[0]
+        busy.acquire()
+
+        with self.assertRaises(AIServiceError):
+            request_completion([{'role': 'user', 'content': 'Oi'}])
+
+        self.assertEqual((breaker.state, breaker.probing), (resilience.HALF_OPEN, False))
+        busy.release()
+        self.assertEqual(request_completion([{'role': 'user', 'content': 'Oi'}]), 'Resposta')
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(
+    OPENROUTER_MODEL='slow/model', AI_HEDGING_ENABLED=True, AI_HEDGE_MODEL='fast/model', AI_HEDGE_DELAY=0.2,
+    AI_HEDGE_MIN_SAMPLES=1000,
+    OPENROUTER_FALLBACK_MODELS=[], AI_REQUEST_LOG_ENABLED=False,
+)
+class HedgingTests(SimpleTestCase):
+    def setUp(self):
+        resilience.reset()
+        hedging.reset()
+        self.addCleanup(resilience.reset)
+        self.addCleanup(hedging.reset)
+        self.stub = StubServer(OpenRouterStubHandler, reply='Olá Maria', model_latency={'slow/model': 1.5}).start()
+        self.addCleanup(self.stub.stop)
+        self.settings_override = override_settings(OPENROUTER_BASE_URL=self.stub.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_slow_primary_is_hedged(self):
+        start = time.monotonic()
+        text, ok = generate_ai_response([MockMessage('user', 'Oi')], 'Prompt')
+
+        self.assertEqual((text, ok), ('Olá Maria', True))
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual([r['model'] for r in self.stub.requests], ['slow/model', 'fast/model'])
+        stats = hedging.stats()
+        self.assertEqual((stats['requests'], stats['hedged'], stats['hedge_wins']), (1, 1, 1))
+        self.assertGreater(stats['extra_prompt_tokens'], 0)
+
+    def test_fast_primary_is_not_hedged(self):
+        self.stub.httpd.options['model_latency'] = {}
+
+        text, ok = generate_ai_response([MockMessage('user', 'Oi')], 'Prompt')
+
+        self.assertEqual((text, ok), ('Olá Maria', True))
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(hedging.stats()['hedged'], 0)
+
+    def test_async_stream_is_hedged_on_first_token(self):
+        async def consume():
+            return ''.join([chunk async for chunk in stream_ai_response([MockMessage('user', 'Oi')], 'Prompt')])
+
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(consume()), 'Olá Maria')
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(hedging.stats()['hedge_wins'], 1)
+
+    def test_cancelled_leg_releases_half_open_probe(self):
+        """
+        O pedido principal é a chamada de teste do circuito meio-aberto e perde para o hedge:
+        ao cancelá-lo, a vaga de teste volta antes de a chamada terminar.
+        """
+        breaker = resilience.breaker_for('slow/model')
+        breaker.state, breaker.opened_at = resilience.OPEN, time.monotonic() - 3600
+
+        async def consume():
+            text = ''.join([chunk async for chunk in stream_ai_response([MockMessage('user', 'Oi')], 'Prompt')])
+            return text, breaker.state, breaker.probing
+
+        self.assertEqual(asyncio.run(consume()), ('Olá Maria', resilience.HALF_OPEN, False))
+        self.assertEqual(hedging.stats()['hedge_wins'], 1)
+        self.assertTrue(breaker.allow())
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(OPENROUTER_MODEL='stub/model', OPENROUTER_FALLBACK_MODELS=[], AI_REQUEST_LOG_ENABLED=True)
+class GatewayTests(TestCase):
+    def setUp(self):
+        resilience.reset()
+        gateway.reset()
+        self.addCleanup(resilience.reset)
+        self.addCleanup(gateway.reset)
+        self.stub = StubServer(OpenRouterStubHandler, reply='Olá Maria, tudo bem?').start()
+        self.addCleanup(self.stub.stop)
+        self.settings_override = override_settings(OPENROUTER_BASE_URL=self.stub.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_calls_are_recorded_with_tokens_and_purpose(self):
+        gateway.request_completion([{'role': 'user', 'content': 'Oi'}], purpose=gateway.PURPOSE_SUMMARY)
+        self.assertEqual(''.join(gateway.stream_completion([{'role': 'user', 'content': 'Oi'}])), 'Olá Maria, tudo bem?')
+
+        summary, reply = LLMRequestLog.objects.order_by('id')
+        self.assertEqual((summary.model, summary.purpose, summary.status, summary.streamed), ('stub/model', 'summary', 'ok', False))
+        self.assertEqual((summary.prompt_tokens, summary.completion_tokens), (1, 6))
+        self.assertEqual((reply.purpose, reply.streamed, reply.prompt_tokens), ('reply', True, 10))
+        self.assertIsNotNone(reply.first_token_ms)
+
+    @override_settings(AI_MAX_CONCURRENCY=1, AI_QUEUE_MAX_WAITING=0, AI_REQUEST_LOG_ENABLED=False)
+    def test_full_queue_rejects_immediately(self):
+        """
+        Com a única vaga ocupada e sem fila de espera, o segundo pedido é recusado na hora.
+        """
+        self.stub.httpd.options['latency'] = 0.3
+        busy = threading.Thread(target=gateway.request_completion, args=([{'role': 'user', 'content': 'Oi'}],))
+        busy.start()
+        time.sleep(0.1)
+
+        start = time.monotonic()
+        with self.assertRaises(AIServiceError) as raised:
+            gateway.request_completion([{'role': 'user', 'content': 'Oi'}])
+        self.assertLess(time.monotonic() - start, 0.1)
+        busy.join()
+
+        self.assertIn('muitas conversas', raised.exception.user_message)
+        self.assertEqual(gateway.concurrency_stats()['global']['rejected'], 1)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    @override_settings(AI_MAX_CONCURRENCY=1, AI_QUEUE_MAX_WAITING=10, AI_REQUEST_LOG_ENABLED=False)
+    def test_waiters_get_the_slot_in_turn(self):
+        self.stub.httpd.options['latency'] = 0.1
+        threads = [
+            threading.Thread(target=gateway.request_completion, args=([{'role': 'user', 'content': 'Oi'}],))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = gateway.concurrency_stats()['global']
+        self.assertEqual((stats['peak'], stats['in_use'], stats['rejected']), (1, 0, 0))
+        self.assertEqual(len(self.stub.requests), 3)
+
+
+class IdempotencyTests(TestCase):
+
+    def setUp(self):
+        idempotency.reset()
+        self.addCleanup(idempotency.reset)
+
+    def test_claim_once_per_delivery_id(self):
+        self.assertTrue(idempotency.claim('twilio', 'SM1'))
+        self.assertFalse(idempotency.claim('twilio', 'SM1'))
+        # O mesmo ID de outro provedor e entregas sem ID não são duplicatas.
+        self.assertTrue(idempotency.claim('telegram', 'SM1'))
+        self.assertTrue(idempotency.claim('twilio', None))
+        self.assertTrue(idempotency.claim('twilio', None))
+
+    def test_prune_forgets_expired_deliveries(self):
+        idempotency.claim('telegram', 1)
+        idempotency.claim('telegram', 2)
+        WebhookDelivery.objects.filter(delivery_id='1').update(received_at=timezone.now() - timedelta(days=2))
+
+        self.assertEqual(idempotency.prune(), 1)
+        self.assertEqual(list(WebhookDelivery.objects.values_list('delivery_id', flat=True)), ['2'])
+
+
+@override_settings(
+    CHATWOOT_OUTBOX_ENABLED=True, CHATWOOT_OUTBOX_CONCURRENCY=1, TWILIO_INBOX_ID='7',
+    WEBHOOK_ASYNC_MODE=False, AI_COALESCE_WINDOW_MS=0,
+)
+class ChatwootOutboxTests(TestCase):
+
+    @patch('chatbot.pipeline.chatbot_services.send_message_to_channel')
+    @patch('chatbot.pipeline.chatbot_services.generate_ai_response', return_value=('Atendemos das 8h às 18h.', True))
+    @patch.object(ChatwootAPI, '_request')
+    def test_pipeline_records_mirrors_without_calling_chatwoot(self, mock_request, mock_generate, mock_send):
+        """
+        Com o outbox, a resposta ao usuário não faz nenhuma chamada ao Chatwoot: as duas mensagens
+        do turno ficam gravadas para o relay, na ordem.
+        """
+        status = pipeline.process_twilio_message({'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'})
+
+        self.assertEqual(status, 'ok')
+        mock_request.assert_not_called()
+        mock_send.assert_called_once()
+        rows = list(ChatwootOutbox.objects.order_by('id').values_list('message_type', 'text', 'inbox_id'))
+        self.assertEqual(rows, [('incoming', 'Horário?', '7'), ('outgoing', 'Atendemos das 8h às 18h.', '7')])
+
+    @patch('chatbot.outbox.identity.resolve_conversation', return_value=99)
+    def test_relay_keeps_order_per_conversation_and_retries(self, mock_resolve):
+        for source_id, text in [('A', 'a1'), ('B', 'b1'), ('A', 'a2'), ('B', 'b2')]:
+            outbox.record('twilio_whatsapp', '7', source_id, 'Maria', text, 'incoming')
+        sent = []
+
+        def create_message(conversation_id, text, message_type, priority):
+            if text == 'a1' and not sent.count('a1-failed'):
+                sent.append('a1-failed')
+                return None
+            sent.append(text)
+            return {'id': len(sent)}
+
+        with patch.object(ChatwootAPI, 'create_message', side_effect=create_message):
+            self.assertEqual(outbox.relay_once(), (2, 4))
+            # 'a1' falhou e está em backoff: 'a2' não pode passar na frente.
+            self.assertEqual(outbox.relay_once(), (0, 0))
+            self.assertEqual(ChatwootOutbox.objects.get(text='a1').attempts, 1)
+
+            ChatwootOutbox.objects.update(available_at=timezone.now())
+            self.assertEqual(outbox.relay_once(), (2, 2))
+
+        self.assertEqual(sent, ['a1-failed', 'b1', 'b2', 'a1', 'a2'])
+        self.assertFalse(ChatwootOutbox.objects.exists())
+
+
+@override_settings(CHATWOOT_CONCURRENT_BOOKKEEPING=True, TWILIO_INBOX_ID='7', WEBHOOK_ASYNC_MODE=False, AI_COALESCE_WINDOW_MS=0)
+@patch('chatbot.pipeline.chatbot_services.send_message_to_channel')
+class ConcurrentBookkeepingTests(TestCase):
+    """
+    Chatwoot com 0,3s por chamada (resolução + registro da mensagem do usuário) e IA com 0,3s:
+    em paralelo, o turno leva ~0,6s (os 0,3s da IA ficam escondidos) em vez de ~0,9s.
+    """
+
+    def setUp(self):
+        self.calls = []
+
+    def resolve(self, *args):
+        time.sleep(0.3)
+        self.calls.append('resolve')
+        return 99
+
+    def create_message(self, conversation_id, text, message_type, priority):
+        time.sleep(0.3 if message_type == 'incoming' else 0)
+        self.calls.append(message_type)
+        return {'id': 1}
+
+    def generate(self, history, system_prompt):
+        time.sleep(0.3)
+        self.calls.append('generate')
+        return 'Atendemos das 8h às 18h.', True
+
+    def test_chatwoot_runs_alongside_generation(self, mock_send):
+        with patch('chatbot.pipeline.identity.resolve_conversation', side_effect=self.resolve), \
+                patch.object(ChatwootAPI, 'create_message', side_effect=self.create_message), \
+                patch('chatbot.pipeline.chatbot_services.generate_ai_response', side_effect=self.generate):
+            started = time.monotonic()
+            status = pipeline.process_twilio_message({'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'})
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(status, 'ok')
+        self.assertLess(elapsed, 0.8)
+        # A resposta do bot só é espelhada depois da mensagem do usuário.
+        self.assertEqual(self.calls[-1], 'outgoing')
+        self.assertLess(self.calls.index('incoming'), self.calls.index('outgoing'))
+        self.assertLess(self.calls.index('generate'), self.calls.index('incoming'))
+
+    async def test_async_pipeline_runs_bookkeeping_as_task(self, mock_send):
+        async def aresolve(*args):
+            await asyncio.sleep(0.3)
+            self.calls.append('resolve')
+            return 99
+
+        async def acreate_message(conversation_id, text, message_type, priority):
+            await asyncio.sleep(0.3 if message_type == 'incoming' else 0)
+            self.calls.append(message_type)
+            return {'id': 1}
+
+        async def agenerate(history, system_prompt):
+            await asyncio.sleep(0.3)
+            self.calls.append('generate')
+            return 'Atendemos das 8h às 18h.', True
+
+        with patch('chatbot.pipeline.identity.aresolve_conversation', side_effect=aresolve), \
+                patch.object(ChatwootAPI, 'acreate_message', side_effect=acreate_message), \
+                patch('chatbot.pipeline.chatbot_services.agenerate_ai_response', side_effect=agenerate), \
+                patch('chatbot.pipeline.chatbot_services.asend_message_to_channel'):
+            started = time.monotonic()
+            status = await pipeline.aprocess_twilio_message({'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'})
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(status, 'ok')
+        self.assertLess(elapsed, 0.8)
+        self.assertEqual(self.calls[-2:], ['incoming', 'outgoing'])
+        self.assertIn('generate', self.calls[:2])
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='', TWILIO_INBOX_ID=None, AI_COALESCE_WINDOW_MS=0)
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    @patch('chatbot.pipeline.chatbot_services.send_message_to_channel')
+    def test_turn_is_measured_by_stage_upstream_and_model(self, mock_send):
+        with StubServer(OpenRouterStubHandler, reply='Atendemos das 8h às 18h.') as stub, \
+                override_settings(OPENROUTER_BASE_URL=stub.url):
+            status = pipeline.process_twilio_message({'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'})
+            host = stub.url.split('//')[1]
+        self.assertEqual(status, 'ok')
+
+        text = self.client.get('/metrics').content.decode()
+        for line in (
+            'chatbot_turns_total{channel="twilio_whatsapp",status="ok"} 1',
+            'chatbot_stage_seconds_count{channel="twilio_whatsapp",stage="generate"} 1',
+            'chatbot_stage_seconds_count{channel="twilio_whatsapp",stage="save"} 2',
+            'chatbot_stage_seconds_count{channel="twilio_whatsapp",stage="send"} 1',
+            f'chatbot_upstream_request_seconds_count{{host="{host}",endpoint="/chat/completions",method="POST",status="200"}} 1',
+            'chatbot_llm_request_seconds_count{model="deepseek/deepseek-chat",purpose="reply",status="ok"} 1',
+            'chatbot_llm_tokens_per_second_count{model="deepseek/deepseek-chat"} 1',
+        ):
+            self.assertIn(line, text)
+        self.assertIn('chatbot_db_query_seconds_count{operation="insert"}', text)
+
+    def test_endpoint_label_hides_ids_and_tokens(self):
+        self.assertEqual(
+            metrics.endpoint_label('https://chat.example.com/api/v1/accounts/1/conversations/42/messages'),
+            ('chat.example.com', '/api/v1/accounts/:id/conversations/:id/messages'),
+        )
+        self.assertEqual(
+            metrics.endpoint_label('https://api.telegram.org/bot123456:ABC-def/sendMessage'),
+            ('api.telegram.org', '/:id/sendMessage'),
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Teste.', ['stage'], buckets=(0.1, 1))
+        self.addCleanup(metrics._registry.remove, histogram)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, stage='a')
+
+        lines = list(histogram.lines(('a',), histogram.snapshot()[('a',)]))
+        self.assertEqual(lines, [
+            'test_seconds_bucket{stage="a",le="0.1"} 1',
+            'test_seconds_bucket{stage="a",le="1"} 2',
+            'test_seconds_bucket{stage="a",le="+Inf"} 3',
+            'test_seconds_sum{stage="a"} 5.55',
+            'test_seconds_count{stage="a"} 3',
+        ])
+
+    def test_processes_are_summed_from_multiproc_dir(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_MULTIPROC_DIR=directory):
+            metrics.TURNS.inc(channel='telegram', status='ok')
+            metrics.flush()
+            # Outro processo (outro pid) com um turno gravado.
+            os.rename(os.path.join(directory, f"{os.getpid()}.json"), os.path.join(directory, f"{os.getppid()}.json"))
+            metrics.reset()
+            metrics.TURNS.inc(channel='telegram', status='ok')
+
+            self.assertIn('chatbot_turns_total{channel="telegram",status="ok"} 2', metrics.render())
+
+    def test_gauges_are_per_process_and_dead_processes_are_dropped(self):
+        # Um processo que já terminou (worker reiniciado) deixou seu retrato no diretório.
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_MULTIPROC_DIR=directory):
+            metrics.TURNS.inc(channel='telegram', status='ok')
+            metrics.HISTORY_CACHE_BYTES.set(100)
+            metrics.flush()
+            own = os.path.join(directory, f"{os.getpid()}.json")
+            shutil.copy(own, os.path.join(directory, f"{os.getppid()}.json"))
+            os.rename(own, os.path.join(directory, f"{dead.pid}.json"))
+            metrics.reset()
+            metrics.HISTORY_CACHE_BYTES.set(40)
+
+            text = metrics.render()
+
+            self.assertIn('chatbot_turns_total{channel="telegram",status="ok"} 1', text)
+            self.assertIn(f'chatbot_history_cache_bytes{{pid="{os.getpid()}"}} 40', text)
+            self.assertIn(f'chatbot_history_cache_bytes{{pid="{os.getppid()}"}} 100', text)
+            self.assertNotIn(f'pid="{dead.pid}"', text)
+            self.assertEqual(os.listdir(directory), [f"{os.getppid()}.json"])
+
+    @override_settings(METRICS_TOKEN='segredo')
+    def test_token_is_required_when_configured(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer segredo')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled_route_does_not_exist(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class ConnectionReleaseTests(TestCase):
+
+    async def test_outbound_send_releases_the_connection_before_waiting(self):
+        """
+        Sob ASGI, a requisição não segura a conexão com o banco enquanto espera um envio.
+        """
+        events = []
+
+        async def call():
+            events.append('call')
+            return MagicMock(status_code=200)
+
+        with patch.object(db, 'release_connections', side_effect=lambda: events.append('release')):
+            await outbound.asend('telegram', None, call)
+
+        self.assertEqual(events, ['release', 'call'])
+
+    @override_settings(AI_REQUEST_LOG_ENABLED=False)
+    async def test_llm_call_releases_the_connection_before_waiting(self):
+        with patch.object(db, 'release_connections') as release:
+            async with gateway._aslot('modelo/a', gateway.PURPOSE_REPLY, 10):
+                self.assertEqual(release.call_count, 1)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
@@ -5,5 +6,9 @@ app_name = 'chatbot'
 
 urlpatterns = [
     # This is the endpoint that the Chatwoot Agent Bot will call.
-    path('webhook/chatwoot/', views.chatwoot_webhook, name='chatwoot_webhook'),
+    path(
+        'webhook/chatwoot/',
+        views.async_chatwoot_webhook if settings.ASYNC_WEBHOOKS else views.chatwoot_webhook,
+        name='chatwoot_webhook',
+    ),
 ]
@@ -1,11 +1,21 @@
+import hmac
 import json
-import requests
+import logging
 import os
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
-from .ai_service import gerar_resposta_ia
+from .ai_service import agerar_resposta_ia, gerar_resposta_ia
+from .async_http import get_async_client
+from .http_client import get_session
+from .identity import invalidate_conversation
+from . import metrics, outbound
+
+logger = logging.getLogger(__name__)
+
 
 @csrf_exempt
 @api_view(['POST'])
@@ -16,6 +26,13 @@ def chatwoot_webhook(request):
         
         # 1. SEGURANÇA BÁSICA: Validar se é uma mensagem criada
         event_type = data.get('event')
+
+        # Conversa resolvida no Chatwoot: a próxima mensagem do usuário deve abrir uma nova.
+        if event_type == 'conversation_status_changed' and data.get('status') == 'resolved':
+            if data.get('id'):
+                invalidate_conversation(data['id'])
+            return JsonResponse({'status': 'success', 'reason': 'conversation_resolved'})
+
         if event_type != 'message_created':
             return JsonResponse({'status': 'ignored', 'reason': 'not_message_created'})
 
@@ -70,6 +87,96 @@ def enviar_para_chatwoot(conversation_id, text):
         "private": False 
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    response = outbound.send(
+        'chatwoot', None, lambda: get_session().post(url, json=payload, headers=headers), outbound.PRIORITY_HIGH
+    )
     if response.status_code != 200:
         print(f"Erro ao enviar para Chatwoot: {response.text}")
+
+
+@csrf_exempt
+async def async_chatwoot_webhook(request):
+    """
+    Versão assíncrona de chatwoot_webhook (rota usada com ASYNC_WEBHOOKS). Não passa pelo
+    Django REST Framework, que não suporta views assíncronas.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method Not Allowed'}, status=405)
+
+    try:
+        data = json.loads(request.body)
+        event_type = data.get('event')
+
+        if event_type == 'conversation_status_changed' and data.get('status') == 'resolved':
+            if data.get('id'):
+                await sync_to_async(invalidate_conversation)(data['id'])
+            return JsonResponse({'status': 'success', 'reason': 'conversation_resolved'})
+
+        if event_type != 'message_created':
+            return JsonResponse({'status': 'ignored', 'reason': 'not_message_created'})
+
+        if data.get('message_type') != 'incoming':
+            return JsonResponse({'status': 'ignored', 'reason': 'not_incoming_message'})
+
+        conversation_id = data.get('conversation', {}).get('id')
+        user_message = data.get('content')
+
+        if not user_message or not conversation_id:
+            return JsonResponse({'status': 'error', 'reason': 'missing_data'})
+
+        logger.info(f"Mensagem recebida do Chatwoot na conversa {conversation_id}: '{user_message}'")
+
+        historico = [{"role": "user", "content": user_message}]
+        resposta_ia = await agerar_resposta_ia(historico)
+
+        logger.info(f"Resposta da IA para a conversa {conversation_id} do Chatwoot: '{resposta_ia}'")
+
+        await aenviar_para_chatwoot(conversation_id, resposta_ia)
+
+        return JsonResponse({'status': 'success'})
+
+    except Exception as e:
+        logger.error(f"Erro inesperado no webhook do Chatwoot: {e}", exc_info=True)
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+async def aenviar_para_chatwoot(conversation_id, text):
+    """
+    Versão assíncrona de enviar_para_chatwoot.
+    """
+    base_url = os.environ.get("CHATWOOT_BASE_URL")
+    account_id = os.environ.get("CHATWOOT_ACCOUNT_ID")
+    token = os.environ.get("CHATWOOT_API_TOKEN")
+
+    url = f"{base_url}/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
+    headers = {
+        "api_access_token": token,
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "content": text,
+        "message_type": "outgoing",
+        "private": False
+    }
+
+    response = await outbound.asend(
+        'chatwoot', None, lambda: get_async_client().post(url, json=payload, headers=headers), outbound.PRIORITY_HIGH
+    )
+    if response.status_code != 200:
+        logger.error(
+            f"Erro ao enviar a resposta para a conversa {conversation_id} do Chatwoot: HTTP {response.status_code}"
+        )
+
+
+def metrics_view(request):
+    """
+    Métricas no formato de exposição do Prometheus (chatbot/metrics.py). Só existe com
+    METRICS_ENABLED; com METRICS_TOKEN, exige 'Authorization: Bearer <token>'.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse('Não autorizado.', status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -163,6 +163,10 @@ TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
 TWILIO_WHATSAPP_NUMBER = os.environ.get('TWILIO_WHATSAPP_NUMBER') # Ex: 'whatsapp:+14155238886'
 TWILIO_INBOX_ID = os.environ.get('TWILIO_INBOX_ID')
+# Endereço da API REST (twilio_bridge/services.py); troque para medir com um stub.
+TWILIO_API_BASE_URL = os.environ.get('TWILIO_API_BASE_URL', 'https://api.twilio.com').rstrip('/')
+# Envios simultâneos em `manage.py send_whatsapp_bulk` (a vazão continua limitada por OUTBOUND_RATE_LIMITS).
+TWILIO_BULK_CONCURRENCY = int(os.environ.get('TWILIO_BULK_CONCURRENCY', '20'))
 
 # --- Configuração do Chatwoot ---
 # É recomendado usar variáveis de ambiente para dados sensíveis.
@@ -216,3 +220,213 @@ Seja sempre cordial, profissional e eficiente. Não forneça diagnósticos ou co
 # --- Configuração do Telegram ---
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 TELEGRAM_INBOX_ID = os.environ.get('TELEGRAM_INBOX_ID')
+# Endereço da Bot API; troque para medir com um stub (`manage.py loadtest`).
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL', 'https://api.telegram.org').rstrip('/')
+
+# --- Recebimento do Telegram por long polling (`manage.py poll_telegram`) ---
+# Alternativa ao webhook (e ao túnel até ele): o comando busca as atualizações com getUpdates.
+# Cada lote (até TELEGRAM_POLL_LIMIT atualizações) é processado com TELEGRAM_POLL_CONCURRENCY
+# conversas em paralelo, em ordem dentro de cada conversa.
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get('TELEGRAM_POLL_TIMEOUT', '25'))  # Segundos que o getUpdates espera por novidades
+TELEGRAM_POLL_LIMIT = int(os.environ.get('TELEGRAM_POLL_LIMIT', '100'))
+TELEGRAM_POLL_CONCURRENCY = int(os.environ.get('TELEGRAM_POLL_CONCURRENCY', '8'))
+# Tentativas de uma atualização que falha antes de ir para TelegramDeadLetter (o offset passa por ela).
+TELEGRAM_POLL_MAX_ATTEMPTS = int(os.environ.get('TELEGRAM_POLL_MAX_ATTEMPTS', '5'))
+
+# --- Fila de processamento assíncrono dos webhooks ---
+# Com WEBHOOK_ASYNC_MODE ativo, os webhooks apenas validam e gravam a atualização na fila
+# (tabela chatbot_job) e respondem na hora; o comando `manage.py run_worker` processa as tarefas.
+WEBHOOK_ASYNC_MODE = os.environ.get('WEBHOOK_ASYNC_MODE', 'False').lower() in ('true', '1', 't')
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '4'))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', '1'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', '300'))  # Segundos até uma tarefa 'running' ser considerada presa
+# Partições fixas das conversas; `run_worker --shard i/N` atende só as partições p com p % N == i.
+JOB_PARTITIONS = int(os.environ.get('JOB_PARTITIONS', '64'))
+
+# Janela (em ms) para juntar mensagens em rajada: a resposta só é gerada quando o usuário fica esse
+# tempo sem mandar outra mensagem, e cobre todas elas num único turno. 0 desativa. Só vale com
+# WEBHOOK_ASYNC_MODE (a resposta é agendada no worker); no modo síncrono a janela é ignorada.
+AI_COALESCE_WINDOW_MS = int(os.environ.get('AI_COALESCE_WINDOW_MS', '0'))
+
+# --- Deduplicação das reentregas de webhook (chatbot/idempotency.py) ---
+# Atualizações do Telegram (update_id) e mensagens do Twilio (MessageSid) já recebidas são
+# respondidas na hora, sem reprocessar. Os IDs ficam em memória (LRU) e na tabela chatbot_webhookdelivery.
+WEBHOOK_DEDUP_ENABLED = os.environ.get('WEBHOOK_DEDUP_ENABLED', 'True').lower() in ('true', '1', 't')
+WEBHOOK_DEDUP_TTL = int(os.environ.get('WEBHOOK_DEDUP_TTL', '86400'))  # Segundos
+WEBHOOK_DEDUP_MEMORY_SIZE = int(os.environ.get('WEBHOOK_DEDUP_MEMORY_SIZE', '10000'))
+
+# --- Conexões HTTP com as APIs externas ---
+# Sessão compartilhada por processo (chatbot/http_client.py) com pool de conexões keep-alive.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+# Tamanho do pool por host, no formato 'host=tamanho,host=tamanho'.
+HTTP_POOL_SIZES = {
+    host.strip(): int(size)
+    for host, _, size in (
+        item.partition('=') for item in os.environ.get(
+            'HTTP_POOL_SIZES', 'openrouter.ai=20,api.telegram.org=20,api.twilio.com=20'
+        ).split(',') if '=' in item
+    )
+}
+
+# Limite de conexões simultâneas do cliente HTTP assíncrono (chatbot/async_http.py), somando todos os hosts.
+HTTP_ASYNC_MAX_CONNECTIONS = int(os.environ.get('HTTP_ASYNC_MAX_CONNECTIONS', '200'))
+
+# --- Webhooks assíncronos (ASGI) ---
+# Com ASYNC_WEBHOOKS ativo, as rotas dos webhooks usam as views assíncronas: as chamadas às APIs
+# externas não bloqueiam uma thread, e um único processo uvicorn (core.asgi) atende centenas de
+# conversas ao mesmo tempo; a conexão com o banco é devolvida durante as esperas de rede (chatbot/db.py).
+# Sob WSGI (gunicorn core.wsgi) mantenha desativado.
+ASYNC_WEBHOOKS = os.environ.get('ASYNC_WEBHOOKS', 'False').lower() in ('true', '1', 't')
+
+# --- Controle de vazão dos envios (chatbot/outbound.py) ---
+# Mensagens por segundo aceitas por provedor e por destinatário, no formato 'provedor=taxa,...'
+# (provedores: telegram, twilio, chatwoot). Provedor fora da lista não tem limite. Um 429 do
+# provedor pausa os envios pelo retry_after pedido e a mensagem é reenviada até OUTBOUND_MAX_RETRIES vezes.
+def _rates(name, default):
+    return {
+        provider.strip(): float(rate)
+        for provider, _, rate in (
+            item.partition('=') for item in os.environ.get(name, default).split(',') if '=' in item
+        )
+    }
+
+
+OUTBOUND_RATE_LIMITS = _rates('OUTBOUND_RATE_LIMITS', 'telegram=30,twilio=10,chatwoot=20')
+OUTBOUND_RECIPIENT_RATE_LIMITS = _rates('OUTBOUND_RECIPIENT_RATE_LIMITS', 'telegram=1')
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '3'))
+
+# --- Métricas (chatbot/metrics.py) ---
+# Com METRICS_ENABLED, cada etapa do pipeline, as chamadas HTTP às APIs externas (por endpoint), as consultas
+# ao banco, as gerações da IA (por modelo, com tokens/s) e os envios aos canais são medidos em histogramas e
+# contadores em memória, expostos em /metrics no formato do Prometheus. Com METRICS_TOKEN, a rota exige
+# 'Authorization: Bearer <token>'. Sob gunicorn (vários processos), aponte METRICS_MULTIPROC_DIR para um
+# diretório gravável e limpo a cada deploy: cada processo grava ali suas métricas a cada
+# METRICS_FLUSH_INTERVAL segundos e /metrics soma os contadores dos processos vivos (gauges saem por 'pid').
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False').lower() in ('true', '1', 't')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+# --- Espelhamento no Chatwoot em paralelo com a resposta ---
+# Com CHATWOOT_CONCURRENT_BOOKKEEPING (e sem o outbox), a resolução do contato/conversa e o registro da
+# mensagem do usuário no Chatwoot rodam em paralelo com o histórico e a geração da resposta (numa thread
+# de um pool de CHATWOOT_BOOKKEEPING_THREADS, ou numa task nas views assíncronas); a resposta do bot só é
+# espelhada depois que eles terminam. A latência do turno passa a ser ~max(Chatwoot, IA) em vez da soma.
+CHATWOOT_CONCURRENT_BOOKKEEPING = os.environ.get('CHATWOOT_CONCURRENT_BOOKKEEPING', 'False').lower() in ('true', '1', 't')
+CHATWOOT_BOOKKEEPING_THREADS = int(os.environ.get('CHATWOOT_BOOKKEEPING_THREADS', '16'))
+
+# --- Outbox do Chatwoot (chatbot/outbox.py) ---
+# Com CHATWOOT_OUTBOX_ENABLED, o espelhamento das mensagens no Chatwoot sai do caminho da resposta:
+# cada mensagem a espelhar é gravada na tabela chatbot_chatwootoutbox junto com a Message, e o relay
+# do `run_worker` (ou `manage.py relay_chatwoot_outbox`) envia em lotes, em ordem dentro de cada conversa.
+CHATWOOT_OUTBOX_ENABLED = os.environ.get('CHATWOOT_OUTBOX_ENABLED', 'False').lower() in ('true', '1', 't')
+CHATWOOT_OUTBOX_BATCH_SIZE = int(os.environ.get('CHATWOOT_OUTBOX_BATCH_SIZE', '50'))  # Conversas por lote
+CHATWOOT_OUTBOX_CONCURRENCY = int(os.environ.get('CHATWOOT_OUTBOX_CONCURRENCY', '4'))  # Conversas enviadas em paralelo
+CHATWOOT_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('CHATWOOT_OUTBOX_MAX_ATTEMPTS', '8'))
+CHATWOOT_OUTBOX_POLL_INTERVAL = float(os.environ.get('CHATWOOT_OUTBOX_POLL_INTERVAL', '1'))
+
+# --- Mapa de identidades do Chatwoot ---
+# Cache em memória de (canal, source_id) -> contato/conversa, na frente da tabela chatbot_chatwootidentity.
+CHATWOOT_IDENTITY_CACHE_SIZE = int(os.environ.get('CHATWOOT_IDENTITY_CACHE_SIZE', '10000'))
+CHATWOOT_IDENTITY_CACHE_TTL = int(os.environ.get('CHATWOOT_IDENTITY_CACHE_TTL', '300'))  # Segundos
+
+# --- Contexto enviado à IA ---
+# Orçamento de tokens (estimados localmente) para prompt de sistema + histórico recente da conversa.
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '3000'))
+AI_CONTEXT_PAGE_SIZE = int(os.environ.get('AI_CONTEXT_PAGE_SIZE', '20'))  # Mensagens buscadas por consulta
+
+# --- Cache do histórico recente (chatbot/history_cache.py) ---
+# Mantém em memória, por processo, as últimas mensagens de cada conversa, acrescidas a cada gravação;
+# o contexto só consulta o histórico no banco quando a versão do agregado Conversation não bate.
+HISTORY_CACHE_ENABLED = os.environ.get('HISTORY_CACHE_ENABLED', 'False').lower() in ('true', '1', 't')
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))  # Memória total estimada
+HISTORY_CACHE_MAX_MESSAGES = int(os.environ.get('HISTORY_CACHE_MAX_MESSAGES', '60'))  # Mensagens guardadas por conversa
+
+# --- Resumo contínuo de conversas longas ---
+# Quando ativo, o worker (`run_worker`) compacta as mensagens antigas num resumo guardado em
+# chatbot_conversationsummary, e o prompt passa a ser prompt de sistema + resumo + mensagens recentes.
+AI_SUMMARY_ENABLED = os.environ.get('AI_SUMMARY_ENABLED', 'False').lower() in ('true', '1', 't')
+AI_SUMMARY_THRESHOLD = int(os.environ.get('AI_SUMMARY_THRESHOLD', '40'))  # Mensagens não resumidas que disparam a compactação
+AI_SUMMARY_KEEP_RECENT = int(os.environ.get('AI_SUMMARY_KEEP_RECENT', '20'))  # Mensagens recentes mantidas fora do resumo
+AI_SUMMARY_BATCH_SIZE = int(os.environ.get('AI_SUMMARY_BATCH_SIZE', '50'))  # Máximo de mensagens resumidas por chamada à IA
+AI_SUMMARY_PROMPT = os.environ.get(
+    'AI_SUMMARY_PROMPT',
+    """
+Você mantém o resumo de uma conversa entre um usuário e o assistente virtual de um consultório médico.
+Atualize o resumo atual incorporando as novas mensagens. Preserve todos os dados informados pelo usuário
+(nome completo, data de nascimento, telefone), consultas agendadas, remarcadas ou canceladas com datas e
+horários, e pedidos ainda pendentes. Descarte cumprimentos e repetições.
+Responda apenas com o novo resumo, em português, em no máximo 15 linhas.
+"""
+)
+
+# --- Configuração do OpenRouter ---
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1').rstrip('/')
+OPENROUTER_MODEL = os.environ.get('OPENROUTER_MODEL', 'deepseek/deepseek-chat')  # Modelo principal
+# Modelos de reserva, em ordem, tentados quando OPENROUTER_MODEL falha (separados por vírgula).
+OPENROUTER_FALLBACK_MODELS = [m.strip() for m in os.environ.get('OPENROUTER_FALLBACK_MODELS', '').split(',') if m.strip()]
+# Retentativas por modelo em erros transitórios (429, 5xx, timeout), com backoff exponencial com jitter.
+AI_RETRY_ATTEMPTS = int(os.environ.get('AI_RETRY_ATTEMPTS', '3'))  # Tentativas por modelo, contando a primeira
+AI_RETRY_BASE_DELAY = float(os.environ.get('AI_RETRY_BASE_DELAY', '0.5'))  # Segundos
+AI_RETRY_MAX_DELAY = float(os.environ.get('AI_RETRY_MAX_DELAY', '8'))  # Segundos
+# Circuit breaker por modelo: após N falhas transitórias seguidas, o modelo é pulado por RESET_TIMEOUT segundos.
+AI_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('AI_BREAKER_FAILURE_THRESHOLD', '5'))
+AI_BREAKER_RESET_TIMEOUT = float(os.environ.get('AI_BREAKER_RESET_TIMEOUT', '30'))
+# Hedging (chatbot/hedging.py): se a resposta (ou o primeiro pedaço, em streaming) não chegar dentro do
+# percentil AI_HEDGE_PERCENTILE das latências recentes, um segundo pedido vai para AI_HEDGE_MODEL (vazio = o
+# primeiro modelo de reserva, ou o mesmo modelo) e vale o que responder primeiro. Custa tokens extras.
+AI_HEDGING_ENABLED = os.environ.get('AI_HEDGING_ENABLED', 'False').lower() in ('true', '1', 't')
+AI_HEDGE_MODEL = os.environ.get('AI_HEDGE_MODEL', '')
+AI_HEDGE_PERCENTILE = float(os.environ.get('AI_HEDGE_PERCENTILE', '95'))
+AI_HEDGE_MIN_SAMPLES = int(os.environ.get('AI_HEDGE_MIN_SAMPLES', '20'))  # Latências necessárias para usar o percentil
+AI_HEDGE_DELAY = float(os.environ.get('AI_HEDGE_DELAY', '3'))  # Segundos, enquanto não há amostras suficientes
+
+# --- Gateway da IA (chatbot/gateway.py) ---
+# Gerações simultâneas por processo, no total (0 = sem limite) e por modelo ('modelo=n,modelo=n').
+# Quem passa do limite espera numa fila de até AI_QUEUE_MAX_WAITING pedidos, por no máximo
+# AI_QUEUE_TIMEOUT segundos; depois disso o pedido é recusado com uma mensagem amigável.
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', '32'))
+AI_MODEL_CONCURRENCY = {
+    model.strip(): int(limit)
+    for model, _, limit in (
+        item.partition('=') for item in os.environ.get('AI_MODEL_CONCURRENCY', '').split(',') if '=' in item
+    )
+}
+AI_QUEUE_MAX_WAITING = int(os.environ.get('AI_QUEUE_MAX_WAITING', '100'))
+AI_QUEUE_TIMEOUT = float(os.environ.get('AI_QUEUE_TIMEOUT', '30'))
+# Registro de cada chamada (modelo, tokens, fila e latência) em chatbot_llmrequestlog; veja `manage.py llm_report`.
+AI_REQUEST_LOG_ENABLED = os.environ.get('AI_REQUEST_LOG_ENABLED', 'True').lower() in ('true', '1', 't')
+# Prompt de sistema do webhook do Chatwoot (chatbot/views.py).
+AI_CHATWOOT_PROMPT = os.environ.get(
+    'AI_CHATWOOT_PROMPT', "Você é um assistente útil e direto de uma organização social. Responda com clareza."
+)
+# Streaming: a resposta aparece no Telegram a partir do primeiro pedaço gerado e é atualizada
+# com editMessageText no máximo a cada TELEGRAM_STREAM_EDIT_INTERVAL segundos.
+AI_STREAMING_ENABLED = os.environ.get('AI_STREAMING_ENABLED', 'False').lower() in ('true', '1', 't')
+TELEGRAM_STREAM_EDIT_INTERVAL = float(os.environ.get('TELEGRAM_STREAM_EDIT_INTERVAL', '1.0'))
+
+# --- Cache de respostas da IA ---
+# Perguntas repetidas (ex: "endereço?") são respondidas sem chamar a IA. Há uma camada em memória
+# (LRU por processo) e uma no banco (chatbot_cachedresponse), compartilhada entre os workers.
+AI_CACHE_ENABLED = os.environ.get('AI_CACHE_ENABLED', 'False').lower() in ('true', '1', 't')
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', '86400'))  # Segundos
+AI_CACHE_MEMORY_SIZE = int(os.environ.get('AI_CACHE_MEMORY_SIZE', '1000'))
+AI_CACHE_DB_MAX_ENTRIES = int(os.environ.get('AI_CACHE_DB_MAX_ENTRIES', '10000'))
+# Quantas mensagens anteriores entram na chave (0 = só a pergunta). Só são guardadas respostas geradas
+# sem resumo da conversa e sem histórico além dessas mensagens (a resposta não pode citar outro paciente).
+AI_CACHE_CONTEXT_TURNS = int(os.environ.get('AI_CACHE_CONTEXT_TURNS', '0'))
+# Turnos que dependem da conversa não usam o cache: mensagens longas, respostas a uma pergunta
+# do bot e mensagens que casam com o padrão abaixo (por padrão, qualquer dígito: datas, telefones...).
+AI_CACHE_MAX_CHARS = int(os.environ.get('AI_CACHE_MAX_CHARS', '120'))
+AI_CACHE_EXCLUDE_PATTERN = os.environ.get('AI_CACHE_EXCLUDE_PATTERN', r'\d')
+
+# --- Buscador semântico local de FAQ ---
+# Compara a mensagem com as perguntas de chatbot_faqentry (n-gramas com hashing + TF-IDF, em NumPy)
+# e responde sem chamar a IA quando a similaridade passa do limiar.
+FAQ_MATCHER_ENABLED = os.environ.get('FAQ_MATCHER_ENABLED', 'False').lower() in ('true', '1', 't')
+FAQ_SIMILARITY_THRESHOLD = float(os.environ.get('FAQ_SIMILARITY_THRESHOLD', '0.85'))
+FAQ_VECTOR_DIM = int(os.environ.get('FAQ_VECTOR_DIM', '1024'))
+FAQ_REFRESH_INTERVAL = float(os.environ.get('FAQ_REFRESH_INTERVAL', '30'))  # Segundos entre verificações de mudanças no banco
@@ -1,10 +1,15 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from chatbot.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
 
     path('api/v1/', include('chatbot.urls')),
     path('api/v1/telegram/', include('telegram_bridge.urls')),
     path('api/v1/twilio/', include('twilio_bridge.urls')),
+
+    # Métricas para o Prometheus (METRICS_ENABLED).
+    path('metrics', metrics_view, name='metrics'),
 ]
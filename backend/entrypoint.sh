@@ -21,6 +21,15 @@ echo "Banco de dados pronto!"
 echo "Aplicando migrações do banco de dados..."
 python manage.py migrate --noinput
 
+# Com ASYNC_WEBHOOKS ativo, os webhooks são views assíncronas: um processo uvicorn (ASGI)
+# atende centenas de conversas simultâneas sem prender uma thread por chamada à IA.
+case "${ASYNC_WEBHOOKS}" in
+  true|True|TRUE|1|t)
+    echo "Iniciando o servidor Uvicorn (ASGI) na porta 8000..."
+    exec uvicorn core.asgi:application --host 0.0.0.0 --port 8000 --workers ${UVICORN_WORKERS:-1}
+    ;;
+esac
+
 # Inicia o servidor Gunicorn
 # --workers: número de processos para lidar com as requisições.
 # --bind: especifica o endereço e a porta. 0.0.0.0 torna acessível de fora do contêiner.
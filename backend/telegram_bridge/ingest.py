@@ -0,0 +1,262 @@
+"""
+Entrada das atualizações do Telegram, pelo webhook ou por long polling.
+
+ingest_update() é o caminho de cada atualização (validação, deduplicação pelo update_id, fila
+ou pipeline) e é o mesmo para a view do webhook e para `manage.py poll_telegram`; a view
+assíncrona usa aingest_update(), com o pipeline assíncrono. O polling busca lotes com getUpdates
+e os processa com process_batch(): conversas diferentes em paralelo, as atualizações de uma mesma
+conversa em ordem. O offset só avança (e é gravado em TelegramPollOffset) depois que o lote foi
+processado, e só até a primeira atualização que falhou: ela volta no próximo getUpdates, até
+falhar TELEGRAM_POLL_MAX_ATTEMPTS vezes e ir para TelegramDeadLetter. Se o comando cair no meio
+de um lote, o lote inteiro volta; nos dois casos, as atualizações já processadas são barradas
+pela deduplicação.
+"""
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+from chatbot import idempotency, pipeline
+from chatbot.http_client import get_session
+from chatbot.models import TelegramDeadLetter, TelegramPollOffset
+from chatbot.ordering import ordering_key
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramAPIError(Exception):
+    """
+    Resposta de erro da Bot API (ex: 409 quando há um webhook configurado, 401 com token inválido).
+    """
+    def __init__(self, status, description):
+        super().__init__(f"{status}: {description}")
+        self.status = status
+        self.description = description
+
+
+def ingest_update(payload):
+    """
+    Processa uma atualização recebida e retorna o status (o mesmo que o webhook responde).
+    """
+    ignored, parsed = _validate(payload)
+    if ignored:
+        return ignored
+
+    # Reentrega de uma atualização já recebida: responde sem processar de novo.
+    # Modo assíncrono: apenas persiste a atualização (junto com a reserva) e responde imediatamente.
+    update_id = payload.get('update_id')
+    if settings.WEBHOOK_ASYNC_MODE:
+        queued = idempotency.claim_and_enqueue(
+            'telegram', update_id, 'telegram_update', payload, ordering_key('telegram', parsed[0])
+        )
+        return 'ok_queued' if queued else 'ok_duplicate'
+    if not idempotency.claim('telegram', update_id):
+        return 'ok_duplicate'
+
+    try:
+        return pipeline.process_telegram_update(payload)
+    except pipeline.ReplyError:
+        # A mensagem já foi gravada: a reserva fica, e a reentrega é barrada como duplicada.
+        raise
+    except Exception:
+        # A reentrega do Telegram (ou o mesmo lote do polling) deve ser processada de novo.
+        idempotency.release('telegram', update_id)
+        raise
+
+
+async def aingest_update(payload):
+    """
+    Versão assíncrona de ingest_update (view assíncrona do webhook): a atualização segue pelo
+    pipeline assíncrono, sem ocupar uma thread durante as chamadas à IA e às APIs.
+    """
+    ignored, parsed = _validate(payload)
+    if ignored:
+        return ignored
+
+    update_id = payload.get('update_id')
+    if settings.WEBHOOK_ASYNC_MODE:
+        queued = await idempotency.aclaim_and_enqueue(
+            'telegram', update_id, 'telegram_update', payload, ordering_key('telegram', parsed[0])
+        )
+        return 'ok_queued' if queued else 'ok_duplicate'
+    if not await idempotency.aclaim('telegram', update_id):
+        return 'ok_duplicate'
+
+    try:
+        return await pipeline.aprocess_telegram_update(payload)
+    except pipeline.ReplyError:
+        raise
+    except Exception:
+        await idempotency.arelease('telegram', update_id)
+        raise
+
+
+def _validate(payload):
+    """
+    Retorna (status, None) para uma atualização ignorada ou (None, (chat_id, texto, nome)).
+    """
+    if not payload.get('message'):
+        logger.warning("Atualização do Telegram ignorada: não contém a chave 'message'.")
+        return 'ok_no_message', None
+
+    parsed = pipeline.parse_telegram_update(payload)
+    if not parsed:
+        logger.info("Atualização do Telegram ignorada: sem chat_id ou texto.")
+        return 'ok_no_chat_id_or_text', None
+    return None, parsed
+
+
+# --- Long polling ---
+
+def bot_id():
+    """
+    Parte numérica do token do bot (o token inteiro não é gravado no banco).
+    """
+    return (settings.TELEGRAM_BOT_TOKEN or '').split(':', 1)[0]
+
+
+def _call(method, payload, read_timeout=None):
+    url = f"{settings.TELEGRAM_API_BASE_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/{method}"
+    timeout = (settings.HTTP_CONNECT_TIMEOUT, read_timeout or settings.HTTP_READ_TIMEOUT)
+    response = get_session().post(url, json=payload, timeout=timeout)
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if response.status_code != 200 or not data.get('ok'):
+        raise TelegramAPIError(response.status_code, data.get('description') or response.text[:200])
+    return data.get('result')
+
+
+def get_updates(offset, timeout=None, limit=None):
+    """
+    Busca as atualizações a partir de 'offset' (confirmando as anteriores), esperando até
+    'timeout' segundos (TELEGRAM_POLL_TIMEOUT) se não houver nenhuma.
+    """
+    timeout = settings.TELEGRAM_POLL_TIMEOUT if timeout is None else timeout
+    payload = {
+        'offset': offset, 'timeout': timeout, 'limit': limit or settings.TELEGRAM_POLL_LIMIT,
+        'allowed_updates': ['message'],
+    }
+    # O servidor segura a requisição por até 'timeout' segundos: o timeout de leitura precisa ser maior.
+    return _call('getUpdates', payload, read_timeout=timeout + 10)
+
+
+def delete_webhook():
+    """
+    Remove o webhook do bot (o getUpdates é recusado com 409 enquanto houver um). As atualizações
+    pendentes são mantidas e chegam pelo polling.
+    """
+    return _call('deleteWebhook', {'drop_pending_updates': False})
+
+
+def load_offset():
+    row = TelegramPollOffset.objects.filter(bot_id=bot_id()).first()
+    return row.offset if row else 0
+
+
+def save_offset(offset):
+    TelegramPollOffset.objects.update_or_create(bot_id=bot_id(), defaults={'offset': offset})
+
+
+def _conversation_of(update):
+    parsed = pipeline.parse_telegram_update(update)
+    # Atualizações sem conversa (ignoradas pelo ingest_update) não precisam de ordem.
+    return ordering_key('telegram', parsed[0]) if parsed else f"update:{update.get('update_id')}"
+
+
+def _ingest_in_order(updates):
+    """
+    Retorna (status de cada atualização, (atualização que falhou, erro) ou None). Depois de uma
+    falha, as atualizações seguintes da conversa ficam para o próximo lote ('deferred'), para não
+    passarem na frente da que falhou.
+    """
+    statuses = []
+    failure = None
+    try:
+        for update in updates:
+            try:
+                statuses.append(ingest_update(update))
+            except Exception as e:
+                logger.error(f"Erro ao processar a atualização {update.get('update_id')} do Telegram: {e}", exc_info=True)
+                statuses.append('error')
+                failure = (update, str(e))
+                break
+    finally:
+        # Cada thread do pool tem sua própria conexão com o banco.
+        connection.close()
+    statuses.extend(['deferred'] * (len(updates) - len(statuses)))
+    return statuses, failure
+
+
+def process_batch(updates, executor):
+    """
+    Processa um lote do getUpdates: uma tarefa do 'executor' por conversa, com as atualizações
+    da conversa em ordem. Retorna (contagem de status, [(atualização que falhou, erro), ...]).
+    """
+    by_conversation = {}
+    for update in sorted(updates, key=lambda u: u.get('update_id', 0)):
+        by_conversation.setdefault(_conversation_of(update), []).append(update)
+
+    statuses = Counter()
+    failures = []
+    for result, failure in executor.map(_ingest_in_order, by_conversation.values()):
+        statuses.update(result)
+        if failure is not None:
+            failures.append(failure)
+    return statuses, failures
+
+
+def dead_letter(update, error, attempts):
+    """
+    Desiste de uma atualização que falhou 'attempts' vezes: grava em TelegramDeadLetter e a marca
+    como recebida (idempotency), para que o próximo getUpdates a pule.
+    """
+    update_id = update['update_id']
+    logger.error(
+        f"Atualização {update_id} do Telegram descartada após {attempts} tentativa(s): {error}. Payload: {update}"
+    )
+    TelegramDeadLetter.objects.update_or_create(
+        bot_id=bot_id(), update_id=update_id, defaults={'payload': update, 'error': error, 'attempts': attempts},
+    )
+    idempotency.claim('telegram', update_id)
+
+
+def poll_once(offset, executor, timeout=None, attempts=None):
+    """
+    Um ciclo do polling: busca um lote, processa e grava o novo offset. Retorna (novo offset,
+    contagem de status do lote).
+
+    Uma atualização que falhou volta no próximo getUpdates (o offset para nela), até falhar
+    TELEGRAM_POLL_MAX_ATTEMPTS vezes: aí vai para dead_letter() e o offset passa por ela, para
+    que um erro determinístico não trave as atualizações de trás. 'attempts' (update_id ->
+    falhas) é mantido pelo chamador entre um ciclo e outro.
+    """
+    attempts = Counter() if attempts is None else attempts
+    updates = get_updates(offset, timeout)
+    if not updates:
+        return offset, Counter()
+    statuses, failures = process_batch(updates, executor)
+
+    # O offset para na primeira atualização que falhou, ou logo depois dela se foi descartada (as
+    # adiadas da mesma conversa voltam no próximo lote; a descartada é barrada pela deduplicação).
+    resume_at = []
+    for update, error in failures:
+        update_id = update['update_id']
+        attempts[update_id] += 1
+        if attempts[update_id] < settings.TELEGRAM_POLL_MAX_ATTEMPTS:
+            resume_at.append(update_id)
+            continue
+        dead_letter(update, error, attempts.pop(update_id))
+        statuses['error'] -= 1
+        statuses['dead_letter'] += 1
+        resume_at.append(update_id + 1)
+    if not statuses['error']:
+        del statuses['error']
+
+    next_offset = min(resume_at, default=max(update['update_id'] for update in updates) + 1)
+    for update_id in [update_id for update_id in attempts if update_id < next_offset]:
+        del attempts[update_id]
+    save_offset(next_offset)
+    return next_offset, statuses
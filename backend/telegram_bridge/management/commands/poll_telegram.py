@@ -0,0 +1,92 @@
+import signal
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from telegram_bridge import ingest
+
+# Espera máxima (segundos) entre tentativas quando a Bot API está fora do ar ou o lote falhou.
+MAX_BACKOFF = 30
+
+
+class Command(BaseCommand):
+    help = (
+        'Recebe as atualizações do Telegram por long polling (getUpdates), sem webhook nem túnel. '
+        'Cada lote é processado pelo mesmo caminho do webhook, com conversas diferentes em paralelo '
+        'e em ordem dentro de cada conversa; o offset fica gravado no banco (TelegramPollOffset).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.TELEGRAM_POLL_CONCURRENCY,
+                            help='Conversas de um lote processadas em paralelo.')
+        parser.add_argument('--timeout', type=int, default=settings.TELEGRAM_POLL_TIMEOUT,
+                            help='Segundos que cada getUpdates espera por novas atualizações.')
+        parser.add_argument('--delete-webhook', action='store_true',
+                            help='Remove o webhook do bot antes de começar (o getUpdates é recusado enquanto houver um).')
+        parser.add_argument('--once', action='store_true', help='Processa as atualizações pendentes e encerra.')
+
+    def handle(self, *args, **options):
+        if not settings.TELEGRAM_BOT_TOKEN:
+            raise CommandError("A variável de ambiente TELEGRAM_BOT_TOKEN não está configurada.")
+        if options['delete_webhook']:
+            ingest.delete_webhook()
+            self.stdout.write("Webhook do bot removido.")
+
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        offset = ingest.load_offset()
+        timeout = 0 if options['once'] else options['timeout']
+        concurrency = max(options['concurrency'], 1)
+        self.stdout.write(f"Polling do Telegram iniciado (offset {offset}, concorrência {concurrency}).")
+        failures = 0
+        attempts = Counter()  # Falhas de cada atualização, até TELEGRAM_POLL_MAX_ATTEMPTS.
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='telegram-poll') as executor:
+            while not self.stopping.is_set():
+                close_old_connections()
+                try:
+                    offset, statuses = ingest.poll_once(offset, executor, timeout, attempts)
+                except ingest.TelegramAPIError as e:
+                    if e.status == 409:
+                        raise CommandError(
+                            f"O bot tem um webhook configurado ({e.description}). Use --delete-webhook para trocar "
+                            "para o polling."
+                        )
+                    if e.status in (401, 404):
+                        raise CommandError(f"Token do Telegram recusado ({e.description}).")
+                    failures = self.backoff(failures, f"Falha no getUpdates ({e})")
+                    continue
+                except requests.exceptions.RequestException as e:
+                    failures = self.backoff(failures, f"Falha no getUpdates ({e})")
+                    continue
+
+                if statuses:
+                    summary = ', '.join(f"{count} {status}" for status, count in sorted(statuses.items()))
+                    self.stdout.write(f"Lote de {sum(statuses.values())} atualização(ões): {summary}. Offset {offset}.")
+                if statuses.get('error'):
+                    # O offset parou na atualização que falhou: ela volta no próximo getUpdates.
+                    if options['once']:
+                        break
+                    failures = self.backoff(failures, f"{statuses['error']} atualização(ões) com erro")
+                    continue
+                failures = 0
+                if not statuses and options['once']:
+                    break
+        self.stdout.write("Polling do Telegram encerrado.")
+
+    def backoff(self, failures, reason):
+        failures += 1
+        delay = min(2 ** failures, MAX_BACKOFF)
+        self.stderr.write(f"{reason}; nova tentativa em {delay}s.")
+        self.stopping.wait(delay)
+        return failures
+
+    def request_stop(self, signum, frame):
+        self.stdout.write("Sinal de parada recebido, terminando o lote em andamento...")
+        self.stopping.set()
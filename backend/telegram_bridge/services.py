@@ -1,34 +1,43 @@
 import logging
 
+import httpx
 import requests
 from django.conf import settings
 
+from chatbot import outbound
+from chatbot.async_http import get_async_client
+from chatbot.http_client import get_session
+
 logger = logging.getLogger(__name__)
 
 
-def send_telegram_message(chat_id, text):
+def send_telegram_message(chat_id, text, markdown=True, priority=outbound.PRIORITY_HIGH):
     """
     Envia uma mensagem para um chat específico no Telegram.
     Tenta primeiro com parse_mode='Markdown' e, se falhar com um Bad Request,
     tenta novamente sem formatação como fallback.
+    Com markdown=False envia direto como texto plano (ex: trechos parciais de uma resposta em streaming).
+    Retorna o message_id da mensagem enviada (ou None em caso de falha).
+    O envio passa pelo controle de vazão (chatbot/outbound.py) com a prioridade informada.
     """
     token = settings.TELEGRAM_BOT_TOKEN
     if not token:
         logger.error("A variável de ambiente TELEGRAM_BOT_TOKEN não está configurada.")
         return
 
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    url = f"{settings.TELEGRAM_API_BASE_URL}/bot{token}/sendMessage"
     
     # Payload 1: Tentar com Markdown, que é mais tolerante a erros que o MarkdownV2.
-    payload_markdown = {
-        "chat_id": chat_id, "text": text, "parse_mode": "Markdown"
-    }
+    payload_markdown = {"chat_id": chat_id, "text": text}
+    if markdown:
+        payload_markdown["parse_mode"] = "Markdown"
 
     try:
         # Tentativa 1: Enviar com Markdown
-        response = requests.post(url, json=payload_markdown)
+        response = outbound.send('telegram', chat_id, lambda: get_session().post(url, json=payload_markdown), priority)
         response.raise_for_status()
         logger.info(f"Mensagem enviada para o chat_id {chat_id} com sucesso (com Markdown).")
+        return _message_id(response)
 
     except requests.exceptions.HTTPError as e:
         # Se o erro for um 400 Bad Request, é provável que seja um problema de formatação.
@@ -40,9 +49,10 @@ def send_telegram_message(chat_id, text):
             logger.info(f"Tentando enviar payload de fallback (texto plano): {payload_plain}")
             try:
                 # Tentativa 2: Enviar como texto plano
-                response_plain = requests.post(url, json=payload_plain)
+                response_plain = outbound.send('telegram', chat_id, lambda: get_session().post(url, json=payload_plain), priority)
                 response_plain.raise_for_status()
                 logger.info(f"Mensagem enviada para o chat_id {chat_id} com sucesso (fallback texto plano).")
+                return _message_id(response_plain)
             except requests.exceptions.RequestException as e_plain:
                 error_details_plain = e_plain.response.json() if hasattr(e_plain, 'response') and e_plain.response.content else str(e_plain)
                 logger.error(f"Erro ao enviar mensagem para o Telegram na tentativa de fallback: {error_details_plain}")
@@ -51,4 +61,98 @@ def send_telegram_message(chat_id, text):
             logger.error(f"Erro HTTP inesperado ao enviar mensagem para o Telegram: {e}")
     except requests.exceptions.RequestException as e_conn:
         # Erro de conexão, timeout, etc.
-        logger.error(f"Erro de conexão ao enviar mensagem para o Telegram: {e_conn}")
\ No newline at end of file
+        logger.error(f"Erro de conexão ao enviar mensagem para o Telegram: {e_conn}")
+
+
+def edit_telegram_message(chat_id, message_id, text, parse_mode=None, priority=outbound.PRIORITY_NORMAL):
+    """
+    Substitui o texto de uma mensagem já enviada (editMessageText).
+    Usado para entregar respostas em streaming. Retorna True se a edição foi aceita.
+    """
+    token = settings.TELEGRAM_BOT_TOKEN
+    if not token:
+        logger.error("A variável de ambiente TELEGRAM_BOT_TOKEN não está configurada.")
+        return False
+
+    url = f"{settings.TELEGRAM_API_BASE_URL}/bot{token}/editMessageText"
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+
+    try:
+        response = outbound.send('telegram', chat_id, lambda: get_session().post(url, json=payload), priority)
+        response.raise_for_status()
+        return True
+    except requests.exceptions.HTTPError as e:
+        # O Telegram recusa edições que não mudam o texto; não é um erro de verdade.
+        if e.response.status_code == 400 and 'message is not modified' in e.response.text:
+            return True
+        logger.warning(f"Falha ao editar a mensagem {message_id} do chat_id {chat_id}: {e.response.text}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Erro de conexão ao editar mensagem no Telegram: {e}")
+    return False
+
+
+async def asend_telegram_message(chat_id, text, markdown=True, priority=outbound.PRIORITY_HIGH):
+    """
+    Versão assíncrona de send_telegram_message (mesmo fallback para texto plano).
+    """
+    token = settings.TELEGRAM_BOT_TOKEN
+    if not token:
+        logger.error("A variável de ambiente TELEGRAM_BOT_TOKEN não está configurada.")
+        return
+
+    url = f"{settings.TELEGRAM_API_BASE_URL}/bot{token}/sendMessage"
+    payload = {"chat_id": chat_id, "text": text}
+    if markdown:
+        payload["parse_mode"] = "Markdown"
+
+    client = get_async_client()
+    try:
+        response = await outbound.asend('telegram', chat_id, lambda: client.post(url, json=payload), priority)
+        if response.status_code == 400 and markdown:
+            logger.warning(f"Falha ao enviar com Markdown (Bad Request): {response.text}. Tentando sem formatação.")
+            response = await outbound.asend(
+                'telegram', chat_id, lambda: client.post(url, json={"chat_id": chat_id, "text": text}), priority
+            )
+        response.raise_for_status()
+        logger.info(f"Mensagem enviada para o chat_id {chat_id} com sucesso.")
+        return _message_id(response)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Erro HTTP ao enviar mensagem para o Telegram: {e.response.status_code} {e.response.text}")
+    except httpx.HTTPError as e:
+        logger.error(f"Erro de conexão ao enviar mensagem para o Telegram: {e}")
+
+
+async def aedit_telegram_message(chat_id, message_id, text, parse_mode=None, priority=outbound.PRIORITY_NORMAL):
+    """
+    Versão assíncrona de edit_telegram_message.
+    """
+    token = settings.TELEGRAM_BOT_TOKEN
+    if not token:
+        logger.error("A variável de ambiente TELEGRAM_BOT_TOKEN não está configurada.")
+        return False
+
+    url = f"{settings.TELEGRAM_API_BASE_URL}/bot{token}/editMessageText"
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+
+    try:
+        client = get_async_client()
+        response = await outbound.asend('telegram', chat_id, lambda: client.post(url, json=payload), priority)
+    except httpx.HTTPError as e:
+        logger.error(f"Erro de conexão ao editar mensagem no Telegram: {e}")
+        return False
+    # O Telegram recusa edições que não mudam o texto; não é um erro de verdade.
+    if response.status_code == 200 or (response.status_code == 400 and 'message is not modified' in response.text):
+        return True
+    logger.warning(f"Falha ao editar a mensagem {message_id} do chat_id {chat_id}: {response.text}")
+    return False
+
+
+def _message_id(response):
+    try:
+        return response.json().get('result', {}).get('message_id')
+    except ValueError:
+        return None
@@ -0,0 +1,140 @@
+import logging
+import time
+
+from django.conf import settings
+
+from chatbot.outbound import PRIORITY_HIGH, PRIORITY_LOW
+
+from .services import aedit_telegram_message, asend_telegram_message, edit_telegram_message, send_telegram_message
+
+logger = logging.getLogger(__name__)
+
+# Limite de caracteres de uma mensagem do Telegram.
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+class StreamingReply:
+    """
+    Estado de uma resposta entregue em streaming. Não faz chamadas ao Telegram: 'feed' e
+    'finish' são geradores que produzem as chamadas a fazer, ('send', texto, markdown) ou
+    ('edit', message_id, texto, parse_mode), e recebem de volta (via send()) o resultado de
+    cada uma. Assim a mesma lógica serve à entrega síncrona e à assíncrona.
+    As chamadas de 'feed' (texto parcial) têm prioridade baixa no controle de vazão; as de
+    'finish' (texto final), alta.
+    """
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.interval = settings.TELEGRAM_STREAM_EDIT_INTERVAL
+        self.text = ''
+        self.offset = 0          # Início do trecho exibido na mensagem atual
+        self.message_id = None
+        self.displayed = ''      # Texto que a mensagem atual está mostrando
+        self.last_update = 0.0
+        self.failed = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.failed:
+            return
+
+        # Trecho da mensagem atual passou do limite: fecha a mensagem e começa outra.
+        while len(self.text) - self.offset > TELEGRAM_MAX_MESSAGE_LENGTH:
+            full = self.text[self.offset:self.offset + TELEGRAM_MAX_MESSAGE_LENGTH]
+            if self.message_id is None:
+                yield 'send', full, False
+            elif self.displayed != full:
+                yield 'edit', self.message_id, full, None
+            self.offset += TELEGRAM_MAX_MESSAGE_LENGTH
+            self.message_id, self.displayed = None, ''
+
+        current = self.text[self.offset:]
+        if not current.strip():
+            return
+
+        now = time.monotonic()
+        if self.message_id is None:
+            self.message_id = yield 'send', current, False
+            self.displayed, self.last_update = current, now
+            if self.message_id is None:
+                logger.error(f"Não foi possível iniciar a resposta em streaming para o chat_id {self.chat_id}.")
+                self.failed = True
+        elif current != self.displayed and now - self.last_update >= self.interval:
+            yield 'edit', self.message_id, current, None
+            self.displayed, self.last_update = current, now
+
+    def finish(self):
+        current = self.text[self.offset:]
+        if not current.strip():
+            return
+
+        if self.failed:
+            # Última tentativa: entrega o restante da resposta de uma vez só.
+            yield 'send', current, True
+            return
+
+        # Versão final com Markdown (o texto parcial podia ter formatação incompleta);
+        # se o Telegram recusar a formatação, fica o texto plano.
+        accepted = yield 'edit', self.message_id, current, 'Markdown'
+        if not accepted and current != self.displayed:
+            yield 'edit', self.message_id, current, None
+
+
+def deliver_streaming_reply(chat_id, chunks):
+    """
+    Entrega uma resposta gerada em streaming: envia o primeiro pedaço com sendMessage e
+    vai atualizando a mesma mensagem com editMessageText, no máximo a cada
+    TELEGRAM_STREAM_EDIT_INTERVAL segundos. Respostas maiores que o limite do Telegram
+    continuam em novas mensagens. Retorna o texto completo gerado.
+    """
+    reply = StreamingReply(chat_id)
+
+    def run(steps, priority):
+        result = None
+        try:
+            while True:
+                step = steps.send(result)
+                if step[0] == 'send':
+                    result = send_telegram_message(chat_id, step[1], markdown=step[2], priority=priority)
+                else:
+                    result = edit_telegram_message(chat_id, step[1], step[2], parse_mode=step[3], priority=priority)
+        except StopIteration:
+            pass
+
+    for chunk in chunks:
+        run(reply.feed(chunk), PRIORITY_LOW)
+    run(reply.finish(), PRIORITY_HIGH)
+    return reply.text
+
+
+async def adeliver_streaming_reply(chat_id, chunks):
+    """
+    Versão assíncrona de deliver_streaming_reply: 'chunks' pode ser um iterável assíncrono
+    (ex: AIResponseStream com 'async for') ou comum (ex: [resposta_do_cache]).
+    """
+    reply = StreamingReply(chat_id)
+
+    async def run(steps, priority):
+        result = None
+        try:
+            while True:
+                step = steps.send(result)
+                if step[0] == 'send':
+                    result = await asend_telegram_message(chat_id, step[1], markdown=step[2], priority=priority)
+                else:
+                    result = await aedit_telegram_message(
+                        chat_id, step[1], step[2], parse_mode=step[3], priority=priority
+                    )
+        except StopIteration:
+            pass
+
+    if not hasattr(chunks, '__aiter__'):
+        chunks = _aiter(chunks)
+    async for chunk in chunks:
+        await run(reply.feed(chunk), PRIORITY_LOW)
+    await run(reply.finish(), PRIORITY_HIGH)
+    return reply.text
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
@@ -1,3 +1,350 @@
-from django.test import TestCase
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+
+from chatbot import idempotency
+from chatbot.models import Job, Message, TelegramDeadLetter, TelegramPollOffset, WebhookDelivery
+from chatbot.outbound import PRIORITY_HIGH, PRIORITY_LOW
+from chatbot.pipeline import aprocess_telegram_update, process_telegram_update
+from chatbot.gateway import stream_completion
+from chatbot.stub_servers import OpenRouterStubHandler, StubServer, TelegramStubHandler
+
+from . import ingest
+from .streaming import deliver_streaming_reply
+from .views import async_telegram_webhook_handler
+
+TELEGRAM_UPDATE = {
+    'update_id': 1000,
+    'message': {
+        'chat': {'id': 123456},
+        'from': {'first_name': 'Maria'},
+        'text': 'Qual o endereço?',
+    },
+}
+
+
+class TelegramWebhookTests(TestCase):
+
+    def setUp(self):
+        idempotency.reset()
+        self.addCleanup(idempotency.reset)
+
+    def post_update(self, payload):
+        return self.client.post('/api/v1/telegram/webhook/', data=json.dumps(payload), content_type='application/json')
+
+    @override_settings(WEBHOOK_ASYNC_MODE=True)
+    @patch('chatbot.pipeline.process_telegram_update')
+    def test_async_mode_only_enqueues(self, mock_process):
+        """
+        No modo assíncrono o webhook apenas grava a atualização na fila e responde.
+        """
+        response = self.post_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'ok_queued'})
+        mock_process.assert_not_called()
+        job = Job.objects.get()
+        self.assertEqual(job.kind, 'telegram_update')
+        self.assertEqual(job.payload, TELEGRAM_UPDATE)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=False)
+    @patch('chatbot.pipeline.process_telegram_update', return_value='ok')
+    def test_sync_mode_processes_inline(self, mock_process):
+        response = self.post_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(response.json(), {'status': 'ok'})
+        mock_process.assert_called_once_with(TELEGRAM_UPDATE)
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(WEBHOOK_ASYNC_MODE=True)
+    def test_redelivered_update_is_acknowledged_without_processing(self):
+        """
+        O Telegram reenvia a mesma atualização (mesmo update_id): só a primeira entra na fila.
+        """
+        self.post_update(TELEGRAM_UPDATE)
+        response = self.post_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(response.json(), {'status': 'ok_duplicate'})
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(idempotency.stats()['memory_duplicates'], 1)
+
+        # Outro processo (sem o ID na memória) também reconhece a reentrega, pela tabela.
+        idempotency.reset()
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).json(), {'status': 'ok_duplicate'})
+        self.assertEqual(idempotency.stats()['db_duplicates'], 1)
+        self.assertEqual(WebhookDelivery.objects.count(), 1)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=False)
+    @patch('chatbot.pipeline.process_telegram_update', side_effect=[RuntimeError('falhou'), 'ok'])
+    def test_failed_update_is_processed_again_on_redelivery(self, mock_process):
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).status_code, 500)
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).json(), {'status': 'ok'})
+        self.assertEqual(mock_process.call_count, 2)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=False, TELEGRAM_INBOX_ID=None)
+    @patch('chatbot.pipeline.generate_reply', side_effect=RuntimeError('IA fora do ar'))
+    def test_redelivery_after_the_message_was_saved_is_a_duplicate(self, mock_reply):
+        """
+        Se a falha veio depois de gravar a mensagem do usuário, a reserva fica: a reentrega não a duplica.
+        """
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).status_code, 500)
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).json(), {'status': 'ok_duplicate'})
+        mock_reply.assert_called_once()
+        self.assertEqual(Message.objects.filter(sender='user').count(), 1)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=True)
+    def test_update_is_queued_on_redelivery_when_enqueue_failed(self):
+        """
+        Se a gravação da tarefa falha, a reserva do update_id é desfeita junto e a reentrega entra na fila.
+        """
+        with patch('chatbot.jobs.enqueue', side_effect=RuntimeError('banco indisponível')):
+            self.assertEqual(self.post_update(TELEGRAM_UPDATE).status_code, 500)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+        self.assertEqual(self.post_update(TELEGRAM_UPDATE).json(), {'status': 'ok_queued'})
+        self.assertEqual(Job.objects.filter(kind='telegram_update').count(), 1)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=True)
+    def test_update_without_text_is_not_enqueued(self):
+        response = self.post_update({'update_id': 1001, 'message': {'chat': {'id': 123456}}})
+
+        self.assertEqual(response.json(), {'status': 'ok_no_chat_id_or_text'})
+        self.assertFalse(Job.objects.exists())
+
+
+    @override_settings(WEBHOOK_ASYNC_MODE=True)
+    async def test_async_view_enqueues(self):
+        request = AsyncRequestFactory().post(
+            '/api/v1/telegram/webhook/', data=TELEGRAM_UPDATE, content_type='application/json'
+        )
+        response = await async_telegram_webhook_handler(request)
+
+        self.assertEqual(json.loads(response.content), {'status': 'ok_queued'})
+        self.assertEqual(await Job.objects.filter(kind='telegram_update').acount(), 1)
+
+    @override_settings(WEBHOOK_ASYNC_MODE=False)
+    @patch('chatbot.pipeline.process_telegram_update')
+    @patch('chatbot.pipeline.aprocess_telegram_update', return_value='ok')
+    async def test_async_view_uses_the_async_pipeline(self, mock_aprocess, mock_process):
+        request = AsyncRequestFactory().post(
+            '/api/v1/telegram/webhook/', data=TELEGRAM_UPDATE, content_type='application/json'
+        )
+        response = await async_telegram_webhook_handler(request)
+
+        self.assertEqual(json.loads(response.content), {'status': 'ok'})
+        mock_aprocess.assert_awaited_once_with(TELEGRAM_UPDATE)
+        mock_process.assert_not_called()
+        self.assertTrue(await WebhookDelivery.objects.filter(provider='telegram', delivery_id='1000').aexists())
+
+
+def telegram_update(update_id, chat_id, text='Oi'):
+    return {'update_id': update_id, 'message': {'chat': {'id': chat_id}, 'from': {'first_name': 'Maria'}, 'text': text}}
+
+
+@override_settings(TELEGRAM_BOT_TOKEN='123:stub-token', WEBHOOK_ASYNC_MODE=False)
+class TelegramPollingTests(TransactionTestCase):
+    # O lote é processado em threads, com conexões próprias (fora da transação de um TestCase).
+    def setUp(self):
+        idempotency.reset()
+        self.addCleanup(idempotency.reset)
+
+    def poll(self, stub, *args):
+        # Uma conversa por vez: o SQLite em memória dos testes recusa gravações simultâneas de
+        # threads diferentes ('database table is locked'), o que faria atualizações falharem ao acaso.
+        with override_settings(TELEGRAM_API_BASE_URL=stub.url):
+            call_command('poll_telegram', '--once', '--concurrency', '1', *args, stdout=open('/dev/null', 'w'))
+
+    @patch('chatbot.pipeline.process_telegram_update', return_value='ok')
+    def test_batch_keeps_order_per_chat_and_saves_offset(self, mock_process):
+        updates = [telegram_update(10, 111, 'a1'), telegram_update(11, 222, 'b1'), telegram_update(12, 111, 'a2')]
+        with StubServer(TelegramStubHandler, updates=updates) as stub:
+            self.poll(stub)
+            # O offset gravado confirma o lote: uma nova execução não processa nada de novo.
+            self.poll(stub)
+
+        texts = [c.args[0]['message']['text'] for c in mock_process.call_args_list]
+        self.assertEqual(sorted(texts), ['a1', 'a2', 'b1'])
+        self.assertLess(texts.index('a1'), texts.index('a2'))
+        self.assertEqual(TelegramPollOffset.objects.get(bot_id='123').offset, 13)
+
+    def test_offset_stops_at_the_failed_update(self):
+        """
+        Uma atualização que falha (e as seguintes da mesma conversa) volta no próximo getUpdates.
+        """
+        texts = []
+
+        def process(update):
+            text = update['message']['text']
+            texts.append(text)
+            if text == 'b1' and texts.count('b1') == 1:
+                raise RuntimeError('falhou')
+            return 'ok'
+
+        updates = [telegram_update(10, 111, 'a1'), telegram_update(11, 222, 'b1'),
+                   telegram_update(12, 111, 'a2'), telegram_update(13, 222, 'b2')]
+        with patch('chatbot.pipeline.process_telegram_update', side_effect=process), \
+                StubServer(TelegramStubHandler, updates=updates) as stub:
+            self.poll(stub)
+            self.assertEqual(TelegramPollOffset.objects.get(bot_id='123').offset, 11)
+            self.assertNotIn('b2', texts)
+
+            self.poll(stub)
+
+        # a2 (já processada antes do erro) não é repetida; b1 e b2 saem em ordem.
+        self.assertEqual(sorted(texts), ['a1', 'a2', 'b1', 'b1', 'b2'])
+        self.assertEqual([text for text in texts if text.startswith('b')], ['b1', 'b1', 'b2'])
+        self.assertEqual(TelegramPollOffset.objects.get(bot_id='123').offset, 14)
+
+    @override_settings(TELEGRAM_POLL_MAX_ATTEMPTS=2, TELEGRAM_POLL_LIMIT=2)
+    def test_update_that_keeps_failing_goes_to_dead_letter(self):
+        """
+        Um erro determinístico não trava o polling: depois de TELEGRAM_POLL_MAX_ATTEMPTS falhas a
+        atualização vai para TelegramDeadLetter e o offset passa por ela, alcançando as de trás do lote.
+        """
+        def process(update):
+            if update['message']['text'] == 'ruim':
+                raise ValueError('payload inesperado')
+            return 'ok'
+
+        updates = [telegram_update(10, 111, 'ruim'), telegram_update(11, 111, 'a2'), telegram_update(12, 222, 'b1')]
+        attempts = Counter()
+        with patch('chatbot.pipeline.process_telegram_update', side_effect=process) as mock_process, \
+                StubServer(TelegramStubHandler, updates=updates) as stub, \
+                override_settings(TELEGRAM_API_BASE_URL=stub.url), ThreadPoolExecutor(max_workers=1) as executor:
+            offset, statuses = ingest.poll_once(0, executor, 0, attempts)
+            self.assertEqual((offset, statuses), (10, Counter(error=1, deferred=1)))
+
+            offset, statuses = ingest.poll_once(offset, executor, 0, attempts)
+            self.assertEqual((offset, statuses), (11, Counter(dead_letter=1, deferred=1)))
+
+            offset, statuses = ingest.poll_once(offset, executor, 0, attempts)
+            self.assertEqual((offset, statuses), (13, Counter(ok=2)))
+
+        dead = TelegramDeadLetter.objects.get()
+        self.assertEqual((dead.update_id, dead.attempts, dead.error), (10, 2, 'payload inesperado'))
+        self.assertEqual(dead.payload, updates[0])
+        texts = [c.args[0]['message']['text'] for c in mock_process.call_args_list]
+        self.assertEqual(texts, ['ruim', 'ruim', 'a2', 'b1'])
+        self.assertEqual(attempts, Counter())
+
+    @patch('chatbot.pipeline.process_telegram_update', return_value='ok')
+    def test_update_received_by_webhook_is_not_processed_again(self, mock_process):
+        self.client.post('/api/v1/telegram/webhook/', data=json.dumps(TELEGRAM_UPDATE), content_type='application/json')
+        with StubServer(TelegramStubHandler, updates=[TELEGRAM_UPDATE]) as stub:
+            self.poll(stub)
+
+        mock_process.assert_called_once()
+
+    def test_active_webhook_requires_delete_webhook(self):
+        with StubServer(TelegramStubHandler, updates=[], webhook=True) as stub:
+            with self.assertRaises(CommandError):
+                self.poll(stub)
+            self.poll(stub, '--delete-webhook')
+            self.assertFalse(stub.httpd.options['webhook'])
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(TELEGRAM_STREAM_EDIT_INTERVAL=0, TELEGRAM_INBOX_ID=None)
+class StreamingReplyTests(TestCase):
+
+    def setUp(self):
+        self.stub = StubServer(OpenRouterStubHandler, reply="Olá Maria, *bem-vinda* ao consultório.").start()
+        self.addCleanup(self.stub.stop)
+        self.settings_override = override_settings(OPENROUTER_BASE_URL=self.stub.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_stream_completion_reads_sse_chunks(self):
+        chunks = list(stream_completion([{'role': 'user', 'content': 'Oi'}]))
+
+        self.assertEqual(chunks, ['Olá ', 'Maria, ', '*bem-vinda* ', 'ao ', 'consultório.'])
+        self.assertTrue(self.stub.requests[0]['stream'])
+
+    @patch('telegram_bridge.streaming.edit_telegram_message', return_value=True)
+    @patch('telegram_bridge.streaming.send_telegram_message', return_value=42)
+    def test_first_chunk_is_sent_then_message_is_edited(self, mock_send, mock_edit):
+        """
+        O primeiro pedaço vai com sendMessage e o restante atualiza a mesma mensagem;
+        a última edição usa Markdown.
+        """
+        text = deliver_streaming_reply('123456', iter(['Olá ', 'Maria, ', '*bem-vinda*.']))
+
+        self.assertEqual(text, 'Olá Maria, *bem-vinda*.')
+        mock_send.assert_called_once_with('123456', 'Olá ', markdown=False, priority=PRIORITY_LOW)
+        self.assertEqual(mock_edit.call_args_list[0].args, ('123456', 42, 'Olá Maria, '))
+        mock_edit.assert_called_with(
+            '123456', 42, 'Olá Maria, *bem-vinda*.', parse_mode='Markdown', priority=PRIORITY_HIGH
+        )
+
+    @override_settings(TELEGRAM_STREAM_EDIT_INTERVAL=60)
+    @patch('telegram_bridge.streaming.edit_telegram_message', return_value=True)
+    @patch('telegram_bridge.streaming.send_telegram_message', return_value=42)
+    def test_edits_are_throttled(self, mock_send, mock_edit):
+        deliver_streaming_reply('123456', iter(['a ', 'b ', 'c ', 'd']))
+
+        # Só a mensagem inicial e a edição final.
+        mock_send.assert_called_once()
+        mock_edit.assert_called_once_with('123456', 42, 'a b c d', parse_mode='Markdown', priority=PRIORITY_HIGH)
+
+    @override_settings(AI_STREAMING_ENABLED=True)
+    @patch('telegram_bridge.streaming.edit_telegram_message', return_value=True)
+    @patch('telegram_bridge.streaming.send_telegram_message', return_value=42)
+    def test_pipeline_streams_and_stores_final_text_once(self, mock_send, mock_edit):
+        status = process_telegram_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(status, 'ok')
+        bot_messages = Message.objects.filter(sender='bot')
+        self.assertEqual([m.text for m in bot_messages], ["Olá Maria, *bem-vinda* ao consultório."])
+        mock_edit.assert_called_with(
+            '123456', 42, "Olá Maria, *bem-vinda* ao consultório.", parse_mode='Markdown', priority=PRIORITY_HIGH
+        )
+
+    @override_settings(AI_STREAMING_ENABLED=True)
+    @patch('telegram_bridge.streaming.aedit_telegram_message', new_callable=AsyncMock, return_value=True)
+    @patch('telegram_bridge.streaming.asend_telegram_message', new_callable=AsyncMock, return_value=42)
+    async def test_async_pipeline_streams(self, mock_send, mock_edit):
+        """
+        A versão assíncrona do pipeline consome o stream com httpx e entrega pelo mesmo fluxo de edições.
+        """
+        status = await aprocess_telegram_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(status, 'ok')
+        bot_texts = [m.text async for m in Message.objects.filter(sender='bot')]
+        self.assertEqual(bot_texts, ["Olá Maria, *bem-vinda* ao consultório."])
+        mock_send.assert_awaited_once_with('123456', 'Olá ', markdown=False, priority=PRIORITY_LOW)
+        mock_edit.assert_awaited_with(
+            '123456', 42, "Olá Maria, *bem-vinda* ao consultório.", parse_mode='Markdown', priority=PRIORITY_HIGH
+        )
+
+    @override_settings(AI_STREAMING_ENABLED=True)
+    @patch('chatbot.pipeline.chatbot_services.send_message_to_channel', return_value=43)
+    @patch('telegram_bridge.streaming.edit_telegram_message', return_value=True)
+    @patch('telegram_bridge.streaming.send_telegram_message', return_value=42)
+    def test_cached_reply_is_sent_whole(self, mock_stream_send, mock_edit, mock_send):
+        """
+        Uma resposta pronta (cache ou FAQ) não passa pelo streaming: uma única mensagem, sem edições.
+        """
+        with patch('chatbot.pipeline.response_cache.lookup', return_value="Rua das Flores, 100."):
+            status = process_telegram_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(status, 'ok')
+        mock_send.assert_called_once_with(channel='telegram', conversation_id='123456', text="Rua das Flores, 100.")
+        mock_stream_send.assert_not_called()
+        mock_edit.assert_not_called()
+        self.assertEqual(self.stub.requests, [])
+
+    @override_settings(AI_STREAMING_ENABLED=True, TELEGRAM_BOT_TOKEN='stub-token', OUTBOUND_RECIPIENT_RATE_LIMITS={})
+    def test_pipeline_streams_to_telegram_stub(self):
+        """
+        Sem mocks: a resposta chega ao Telegram simulado (TELEGRAM_API_BASE_URL), como no `loadtest`.
+        """
+        with StubServer(TelegramStubHandler) as telegram, override_settings(TELEGRAM_API_BASE_URL=telegram.url):
+            status = process_telegram_update(TELEGRAM_UPDATE)
+
+        self.assertEqual(status, 'ok')
+        self.assertEqual([recipient for recipient, _ in telegram.deliveries], ['123456'])
+        self.assertEqual(telegram.requests[-1]['text'], "Olá Maria, *bem-vinda* ao consultório.")
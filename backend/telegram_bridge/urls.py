@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = 'telegram_bridge'
 
 urlpatterns = [
-    path('webhook/', views.telegram_webhook_handler, name='webhook'),
+    path(
+        'webhook/',
+        views.async_telegram_webhook_handler if settings.ASYNC_WEBHOOKS else views.telegram_webhook_handler,
+        name='webhook',
+    ),
 ]
\ No newline at end of file
@@ -1,13 +1,55 @@
+import asyncio
 import logging
+import os
+import threading
+import time
+
+import httpx
 from django.conf import settings
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 
+from chatbot import outbound
+from chatbot.async_http import get_async_client
+from chatbot.http_client import get_session
+
 logger = logging.getLogger(__name__)
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_twilio_client():
+    """
+    Retorna o cliente do Twilio do processo, criado uma única vez. As requisições vão para
+    TWILIO_API_BASE_URL pela sessão HTTP compartilhada (chatbot/http_client.py), com o pool de api.twilio.com.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                http = TwilioHttpClient(pool_connections=False)
+                http.session = get_session()
+                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http)
+                client.api.base_url = settings.TWILIO_API_BASE_URL
+                _client = client
+    return _client
+
+
+def reset_client():
+    """
+    Descarta o cliente atual (usado nos testes).
+    """
+    global _client
+    with _client_lock:
+        _client = None
+
 
-def send_twilio_whatsapp_message(recipient_id, text):
+def _from_number():
     """
-    Envia uma mensagem de WhatsApp para um destinatário específico usando a API do Twilio.
+    Número remetente com o prefixo 'whatsapp:' exigido pela API, ou None se o Twilio não estiver configurado.
+    O 'recipient_id' (que vem do webhook como 'From') já vem no formato correto.
     """
     account_sid = settings.TWILIO_ACCOUNT_SID
     auth_token = settings.TWILIO_AUTH_TOKEN
@@ -15,18 +57,125 @@ def send_twilio_whatsapp_message(recipient_id, text):
 
     if not all([account_sid, auth_token, from_number_raw]):
         logger.error("As variáveis de ambiente do Twilio não estão configuradas corretamente.")
-        return
-
-    # Garante que o número 'from' tenha o prefixo 'whatsapp:' exigido pela API.
-    # O 'recipient_id' (que vem do webhook como 'From') já vem no formato correto.
+        return None
     if not from_number_raw.startswith('whatsapp:'):
-        from_number_formatted = f"whatsapp:{from_number_raw}"
-    else:
-        from_number_formatted = from_number_raw
+        return f"whatsapp:{from_number_raw}"
+    return from_number_raw
+
+
+def send_twilio_whatsapp_message(recipient_id, text, priority=outbound.PRIORITY_HIGH):
+    """
+    Envia uma mensagem de WhatsApp para um destinatário específico usando a API do Twilio,
+    dentro do limite de mensagens por segundo do remetente (provedor 'twilio' em chatbot/outbound.py).
+    Retorna o SID da mensagem (ou None em caso de falha).
+    """
+    from_number = _from_number()
+    if from_number is None:
+        return None
+
+    client = get_twilio_client()
+
+    def create():
+        try:
+            return client.messages.create(from_=from_number, body=text, to=recipient_id)
+        except TwilioRestException as e:
+            # 429 (Too Many Requests): o dispatcher espera e reenvia.
+            if e.status == 429:
+                raise outbound.Throttled() from e
+            raise
 
     try:
-        client = Client(account_sid, auth_token)
-        message = client.messages.create(from_=from_number_formatted, body=text, to=recipient_id)
+        message = outbound.send('twilio', recipient_id, create, priority)
         logger.info(f"Mensagem enviada para {recipient_id} via Twilio. SID: {message.sid}")
+        return message.sid
     except Exception as e:
-        logger.error(f"Erro ao enviar mensagem para o Twilio: {e}")
\ No newline at end of file
+        logger.error(f"Erro ao enviar mensagem para o Twilio: {e}")
+        return None
+
+
+async def _apost_message(from_number, recipient_id, text, priority):
+    """
+    Cria a mensagem via POST /Messages.json com o cliente httpx do event loop. O SDK do Twilio
+    só tem cliente assíncrono com aiohttp; aqui usamos o mesmo pool das demais chamadas assíncronas.
+    Retorna o SID; levanta httpx.HTTPError em caso de falha.
+    """
+    account_sid = settings.TWILIO_ACCOUNT_SID
+    url = f"{settings.TWILIO_API_BASE_URL}/2010-04-01/Accounts/{account_sid}/Messages.json"
+    data = {'From': from_number, 'To': recipient_id, 'Body': text}
+    client = get_async_client()
+    response = await outbound.asend(
+        'twilio', recipient_id,
+        lambda: client.post(url, data=data, auth=(account_sid, settings.TWILIO_AUTH_TOKEN)),
+        priority,
+    )
+    response.raise_for_status()
+    return response.json().get('sid')
+
+
+async def asend_twilio_whatsapp_message(recipient_id, text, priority=outbound.PRIORITY_HIGH):
+    """
+    Versão assíncrona de send_twilio_whatsapp_message.
+    """
+    from_number = _from_number()
+    if from_number is None:
+        return None
+
+    try:
+        sid = await _apost_message(from_number, recipient_id, text, priority)
+        logger.info(f"Mensagem enviada para {recipient_id} via Twilio. SID: {sid}")
+        return sid
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Erro HTTP ao enviar mensagem para o Twilio: {e.response.status_code} {e.response.text}")
+    except httpx.HTTPError as e:
+        logger.error(f"Erro de conexão ao enviar mensagem para o Twilio: {e}")
+    return None
+
+
+async def asend_bulk_whatsapp(messages, concurrency=None, priority=outbound.PRIORITY_NORMAL):
+    """
+    Envia muitas mensagens ((destinatário, texto), ...) ao mesmo tempo, até 'concurrency'
+    (TWILIO_BULK_CONCURRENCY) requisições em andamento; a vazão fica limitada pelo dispatcher
+    (OUTBOUND_RATE_LIMITS['twilio'], o limite da conta). Em vez de uma linha de log por mensagem,
+    retorna (e registra uma vez) um relatório: enviadas, falhas, SIDs, erros por destinatário,
+    duração e mensagens por segundo.
+    """
+    messages = list(messages)
+    report = {'sent': 0, 'failed': 0, 'sids': {}, 'errors': {}, 'elapsed': 0.0, 'throughput': 0.0}
+    from_number = _from_number()
+    if from_number is None:
+        report['failed'] = len(messages)
+        return report
+
+    semaphore = asyncio.Semaphore(concurrency or settings.TWILIO_BULK_CONCURRENCY)
+
+    async def send_one(recipient_id, text):
+        async with semaphore:
+            try:
+                report['sids'][recipient_id] = await _apost_message(from_number, recipient_id, text, priority)
+                report['sent'] += 1
+            except httpx.HTTPStatusError as e:
+                report['errors'][recipient_id] = f"{e.response.status_code} {e.response.text}"
+                report['failed'] += 1
+            except httpx.HTTPError as e:
+                report['errors'][recipient_id] = str(e) or type(e).__name__
+                report['failed'] += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(send_one(recipient_id, text) for recipient_id, text in messages))
+    report['elapsed'] = time.monotonic() - started
+    report['throughput'] = report['sent'] / report['elapsed'] if report['elapsed'] else 0.0
+    logger.info(
+        f"Envio em lote via Twilio: {report['sent']} enviada(s), {report['failed']} falha(s) "
+        f"em {report['elapsed']:.2f}s ({report['throughput']:.1f} msg/s)."
+    )
+    return report
+
+
+def _reset_client_in_child():
+    # O cliente guarda a sessão HTTP do processo pai, que não pode ser compartilhada com o filho.
+    global _client
+    _client = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_in_child)
@@ -1,3 +1,134 @@
-from django.test import TestCase
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import AsyncRequestFactory, TestCase, override_settings
+
+from chatbot import idempotency, outbound, services as chatbot_services
+from chatbot.http_client import get_session
+from chatbot.models import Message
+from chatbot.stub_servers import OpenRouterStubHandler, StubServer, TwilioStubHandler
+
+from . import services
+from .views import EMPTY_TWIML, async_twilio_webhook_handler
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(WEBHOOK_ASYNC_MODE=False, TWILIO_INBOX_ID=None)
+class AsyncTwilioWebhookTests(TestCase):
+
+    async def test_async_view_answers_inline(self):
+        """
+        A view assíncrona processa a mensagem sem bloquear: chama o OpenRouter via httpx e grava o histórico.
+        """
+        with StubServer(OpenRouterStubHandler, reply="Atendemos das 08:00 às 18:00.") as stub:
+            with override_settings(OPENROUTER_BASE_URL=stub.url):
+                request = AsyncRequestFactory().post(
+                    '/api/v1/twilio/webhook/', data={'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'}
+                )
+                response = await async_twilio_webhook_handler(request)
+
+        self.assertEqual(response.content.decode(), EMPTY_TWIML)
+        texts = [(m.sender, m.text) async for m in Message.objects.order_by('id')]
+        self.assertEqual(texts, [('user', 'Horário?'), ('bot', "Atendemos das 08:00 às 18:00.")])
+        self.assertEqual(stub.requests[0]['messages'][-1], {'role': 'user', 'content': 'Horário?'})
+
+
+TWILIO_TEST_SETTINGS = {
+    'TWILIO_ACCOUNT_SID': 'ACtest', 'TWILIO_AUTH_TOKEN': 'test-token', 'TWILIO_WHATSAPP_NUMBER': '+15550000000',
+}
+
+
+@override_settings(**TWILIO_TEST_SETTINGS)
+class TwilioSendTests(TestCase):
+
+    def setUp(self):
+        services.reset_client()
+        outbound.reset()
+        self.addCleanup(services.reset_client)
+        self.addCleanup(outbound.reset)
+
+    def test_client_is_reused_with_shared_session(self):
+        """
+        O cliente do Twilio é criado uma vez por processo e usa a sessão HTTP compartilhada.
+        """
+        client = services.get_twilio_client()
+        self.assertIs(services.get_twilio_client(), client)
+        self.assertIs(client.http_client.session, get_session())
+
+    @patch('chatbot.services.send_twilio_whatsapp_message', return_value='SM123')
+    def test_channel_dispatch(self, send):
+        self.assertEqual(chatbot_services.send_message_to_channel('twilio_whatsapp', 'whatsapp:+5511', 'Oi'), 'SM123')
+        send.assert_called_once_with('whatsapp:+5511', 'Oi')
+
+    def test_bulk_send_reports_once(self):
+        """
+        O envio em lote usa o caminho assíncrono, com várias requisições em andamento, e devolve um único relatório.
+        """
+        messages = [(f'whatsapp:+55119000{i:04d}', 'Lembrete da consulta') for i in range(30)]
+        with StubServer(TwilioStubHandler, latency=0.1) as stub:
+            with override_settings(TWILIO_API_BASE_URL=stub.url, OUTBOUND_RATE_LIMITS={}):
+                report = async_to_sync(services.asend_bulk_whatsapp)(messages, concurrency=10)
+
+        self.assertEqual((report['sent'], report['failed']), (30, 0))
+        self.assertEqual(len(set(report['sids'].values())), 30)
+        # 30 envios de 0,1s com 10 simultâneos: bem menos que os 3s de um envio por vez.
+        self.assertLess(report['elapsed'], 1.5)
+        self.assertEqual({r['From'] for r in stub.requests}, {'whatsapp:+15550000000'})
+
+    def test_bulk_send_collects_errors(self):
+        with StubServer(TwilioStubHandler, status=400) as stub:
+            with override_settings(TWILIO_API_BASE_URL=stub.url):
+                report = async_to_sync(services.asend_bulk_whatsapp)([('whatsapp:+5511', 'Oi')])
+
+        self.assertEqual((report['sent'], report['failed']), (0, 1))
+        self.assertIn('400', report['errors']['whatsapp:+5511'])
+
+
+@patch.dict('os.environ', {'OPENROUTER_API_KEY': 'fake-openrouter-key-for-testing'})
+@override_settings(WEBHOOK_ASYNC_MODE=False, TWILIO_INBOX_ID=None, **TWILIO_TEST_SETTINGS)
+class AsyncTwilioReplyTests(TestCase):
+
+    async def test_reply_is_sent_to_whatsapp(self):
+        with StubServer(OpenRouterStubHandler, reply="Atendemos das 08:00 às 18:00.") as openrouter, \
+                StubServer(TwilioStubHandler) as twilio:
+            with override_settings(OPENROUTER_BASE_URL=openrouter.url, TWILIO_API_BASE_URL=twilio.url):
+                request = AsyncRequestFactory().post(
+                    '/api/v1/twilio/webhook/', data={'From': 'whatsapp:+5511999998888', 'Body': 'Horário?'}
+                )
+                await async_twilio_webhook_handler(request)
+
+        self.assertEqual(twilio.requests, [{
+            'From': 'whatsapp:+15550000000', 'To': 'whatsapp:+5511999998888', 'Body': "Atendemos das 08:00 às 18:00.",
+        }])
+
+    @patch('chatbot.pipeline.aprocess_twilio_message', new_callable=AsyncMock)
+    async def test_retried_webhook_is_processed_once(self, mock_process):
+        """
+        O Twilio repete o webhook com o mesmo MessageSid: a repetição é respondida sem reprocessar.
+        """
+        idempotency.reset()
+        self.addCleanup(idempotency.reset)
+        data = {'From': 'whatsapp:+5511999998888', 'Body': 'Horário?', 'MessageSid': 'SM-retry-1'}
+        for _ in range(3):
+            request = AsyncRequestFactory().post('/api/v1/twilio/webhook/', data=data)
+            response = await async_twilio_webhook_handler(request)
+            self.assertEqual(response.content.decode(), EMPTY_TWIML)
+
+        mock_process.assert_awaited_once()
+
+    @patch('chatbot.pipeline.agenerate_reply', side_effect=RuntimeError('IA fora do ar'))
+    async def test_retry_after_the_message_was_saved_is_not_processed_again(self, mock_reply):
+        """
+        Se a falha veio depois de gravar a mensagem do usuário, a reserva fica: a repetição não a duplica.
+        """
+        idempotency.reset()
+        self.addCleanup(idempotency.reset)
+        data = {'From': 'whatsapp:+5511999998888', 'Body': 'Horário?', 'MessageSid': 'SM-retry-2'}
+        statuses = []
+        for _ in range(2):
+            response = await async_twilio_webhook_handler(AsyncRequestFactory().post('/api/v1/twilio/webhook/', data=data))
+            statuses.append(response.status_code)
+
+        self.assertEqual(statuses, [500, 200])
+        mock_reply.assert_awaited_once()
+        self.assertEqual(await Message.objects.filter(sender='user').acount(), 1)
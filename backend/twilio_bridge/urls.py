@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = 'twilio_bridge'
 
 urlpatterns = [
-    path('webhook/', views.twilio_webhook_handler, name='webhook'),
+    path(
+        'webhook/',
+        views.async_twilio_webhook_handler if settings.ASYNC_WEBHOOKS else views.twilio_webhook_handler,
+        name='webhook',
+    ),
 ]
\ No newline at end of file